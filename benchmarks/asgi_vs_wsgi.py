@@ -0,0 +1,173 @@
+"""
+Throughput of the WSGI PlanViewSet endpoints vs. the async ones.
+
+Seeds --plans plans, then runs the same workload against /v1/plan/ through the
+WSGI handler (a pool of --threads threads, like a threaded WSGI worker) and
+against /async/v1/plan/ through the ASGI handler (--concurrency requests in
+flight on one event loop). Requests go through Django's test clients, i.e. the
+full middleware and view stack without an HTTP server in front.
+
+RabbitMQ publishes are replaced by a no-op unless --rabbitmq is given, so the
+numbers compare the Redis and request handling paths. With --fake there is no
+network wait for the event loop to overlap, so that mode only shows the
+per-request overhead of each path; compare throughput against a real Redis.
+
+    python -m benchmarks.asgi_vs_wsgi --requests 5000 --threads 16 --concurrency 500
+    python -m benchmarks.asgi_vs_wsgi --fake     # fakeredis instead of a server
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.plans import build_plan
+
+HEADERS = {'Authorization': 'Bearer benchmark'}
+
+
+class NullPublisher:
+    def publish(self, body, routing_key=None, properties=None):
+        pass
+
+
+class AsyncNullPublisher:
+    async def publish(self, body, routing_key=None):
+        pass
+
+
+def summary(mode, operation, latencies, elapsed):
+    latencies = sorted(latencies)
+    return {
+        'mode': mode,
+        'operation': operation,
+        'requests': len(latencies),
+        'requests_per_second': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(statistics.median(latencies) * 1000, 3),
+        'p99_ms': round(latencies[int(len(latencies) * 0.99) - 1] * 1000, 3),
+    }
+
+
+def workload(operation, prefix, plans, requests):
+    # (method, path, body) for every request of one run
+    if operation == 'retrieve':
+        ids = itertools.cycle(f'benchmark-plan-{i}' for i in range(plans))
+        return [('get', f'{prefix}{next(ids)}/', None) for _ in range(requests)]
+    return [
+        ('post', prefix, json.dumps(build_plan(f'benchmark-{prefix.strip("/").replace("/", "-")}-{i}', 2)))
+        for i in range(requests)
+    ]
+
+
+def run_wsgi(operation, plans, requests, threads):
+    from django.test import Client
+
+    calls = workload(operation, '/v1/plan/', plans, requests)
+    local = threading.local()
+
+    def send(call):
+        method, path, body = call
+        if not hasattr(local, 'client'):
+            local.client = Client()
+        client = local.client
+        start = time.perf_counter()
+        if body is None:
+            response = getattr(client, method)(path, headers=HEADERS)
+        else:
+            response = getattr(client, method)(path, body, content_type='application/json', headers=HEADERS)
+        assert response.status_code < 300, response.content
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        latencies = list(pool.map(send, calls))
+    return summary('wsgi', operation, latencies, time.perf_counter() - start)
+
+
+async def run_asgi(operation, plans, requests, concurrency):
+    from django.test import AsyncClient
+
+    calls = workload(operation, '/async/v1/plan/', plans, requests)
+    client = AsyncClient()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def send(call):
+        method, path, body = call
+        async with semaphore:
+            start = time.perf_counter()
+            if body is None:
+                response = await getattr(client, method)(path, headers=HEADERS)
+            else:
+                response = await getattr(client, method)(path, body, content_type='application/json', headers=HEADERS)
+            assert response.status_code < 300, response.content
+            return time.perf_counter() - start
+
+    start = time.perf_counter()
+    latencies = await asyncio.gather(*(send(call) for call in calls))
+    return summary('asgi', operation, latencies, time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--plans', type=int, default=100)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--threads', type=int, default=16, help='WSGI worker threads')
+    parser.add_argument('--concurrency', type=int, default=200, help='in-flight requests on the event loop')
+    parser.add_argument('--fake', action='store_true', help='use fakeredis instead of the configured Redis')
+    parser.add_argument('--rabbitmq', action='store_true', help='publish to the configured RabbitMQ')
+    args = parser.parse_args()
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+    import django
+    django.setup()
+    from django.conf import settings
+    settings.ALLOWED_HOSTS = [*settings.ALLOWED_HOSTS, 'testserver']
+
+    if args.fake:
+        import django_redis
+        import fakeredis
+        server = fakeredis.FakeServer()
+        fake = fakeredis.FakeRedis(server=server)
+        django_redis.get_redis_connection = lambda *a, **k: fake
+
+    from plan import async_producer, async_storage, producer, storage
+    if args.fake:
+        async_storage.connect = lambda: fakeredis.FakeAsyncRedis(
+            server=server,
+            connection_pool_class=async_storage.aioredis.BlockingConnectionPool,
+            max_connections=async_storage.MAX_CONNECTIONS,
+        )
+
+    if not args.rabbitmq:
+        producer.get_publisher = NullPublisher
+        async_producer.get_async_publisher = AsyncNullPublisher
+
+    store = storage.get_plan_store()
+    for i in range(args.plans):
+        store.create(build_plan(f'benchmark-plan-{i}', 2))
+
+    results = []
+    for operation in ('retrieve', 'create'):
+        results.append(run_wsgi(operation, args.plans, args.requests, args.threads))
+        results.append(asyncio.run(run_asgi(operation, args.plans, args.requests, args.concurrency)))
+
+    for i in range(args.plans):
+        store.delete(f'benchmark-plan-{i}')
+    for prefix in ('v1-plan', 'async-v1-plan'):
+        for i in range(args.requests):
+            store.delete(f'benchmark-{prefix}-{i}')
+
+    print(json.dumps({
+        'plans': args.plans,
+        'threads': args.threads,
+        'concurrency': args.concurrency,
+        'results': results,
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""
+Bearer token check benchmark: verifying the JWT signature on every request
+vs. the verified-token cache of plan/auth.py.
+
+Signs one token with a key generated for the run and times --requests
+auth.authenticate calls both ways: with the cache emptied before each call
+(one signature verification per request) and with it kept (one per token).
+
+    python -m benchmarks.auth --algorithm RS256 --requests 20000
+"""
+import argparse
+import json
+import os
+import time
+
+
+def signing_keys(algorithm):
+    # (private key, public key) for algorithm
+    if algorithm.startswith('HS'):
+        secret = os.urandom(32).hex()
+        return secret, secret
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import ec, rsa
+    if algorithm.startswith('ES'):
+        curve = {'ES256': ec.SECP256R1, 'ES384': ec.SECP384R1, 'ES512': ec.SECP521R1}[algorithm]()
+        private = ec.generate_private_key(curve)
+    else:
+        private = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    public = private.public_key().public_bytes(
+        serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo
+    ).decode('ascii')
+    return private, public
+
+
+def timed(fn, requests):
+    start = time.perf_counter()
+    for _ in range(requests):
+        fn()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--algorithm', default='RS256', help='RS256, ES256, HS256, ...')
+    parser.add_argument('--requests', type=int, default=10000)
+    args = parser.parse_args()
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+    import django
+    django.setup()
+    import jwt
+    from django.conf import settings
+    from plan import auth
+
+    private, public = signing_keys(args.algorithm)
+    settings.PLAN_AUTH = {'ENABLED': True, 'KEYS': {'benchmark': public}, 'ALGORITHMS': [args.algorithm]}
+    token = jwt.encode(
+        {'exp': int(time.time()) + 3600, 'scope': 'plans:read plans:write'},
+        private,
+        algorithm=args.algorithm,
+        headers={'kid': 'benchmark'},
+    )
+    header = f'Bearer {token}'
+    cache = auth.get_token_cache(auth.get_config())
+
+    def uncached():
+        cache.entries.clear()
+        auth.authenticate(header, 'retrieve', 'GET')
+
+    verified = timed(uncached, args.requests)
+    cached = timed(lambda: auth.authenticate(header, 'retrieve', 'GET'), args.requests)
+
+    print(json.dumps({
+        'algorithm': args.algorithm,
+        'requests': args.requests,
+        'token_bytes': len(token),
+        'verify_us_per_request': round(verified / args.requests * 1e6, 2),
+        'cached_us_per_request': round(cached / args.requests * 1e6, 2),
+        'speedup': round(verified / cached, 2),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""
+Plan value formats: bytes per plan and encode/decode time for each
+PLAN_CODEC format.
+
+Builds --plans plans with --services linkedPlanServices each, trains a zstd
+dictionary on them in memory (as manage.py train_plan_dictionary does on
+stored plans), then round-trips every plan through each format and checks
+that it decodes to the same document.
+
+    python -m benchmarks.codec --plans 2000 --services 3
+"""
+import argparse
+import json
+import os
+import time
+
+from benchmarks.plans import build_plan
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--plans', type=int, default=1000)
+    parser.add_argument('--services', type=int, default=2)
+    parser.add_argument('--dictionary-size', type=int, default=16 * 1024)
+    parser.add_argument('--level', type=int, default=3)
+    args = parser.parse_args()
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+    import django
+    django.setup()
+    from django.conf import settings
+    from plan import codec
+
+    plans = []
+    for i in range(args.plans):
+        plan = build_plan(f'benchmark-codec-{i}', args.services)
+        plan['planCostShares']['copay'] = i % 500
+        plans.append(plan)
+
+    # Install the trained dictionary in this process instead of Redis
+    samples = [codec.msgpack.packb(plan) for plan in plans]
+    dictionary = codec.zstandard.train_dictionary(args.dictionary_size, samples)
+    codec.dictionaries.dictionaries[dictionary.dict_id()] = dictionary
+    codec.dictionaries.current = dictionary.dict_id()
+    codec.dictionaries.checked = float('inf')
+
+    results = []
+    for fmt in codec.FORMATS:
+        settings.PLAN_CODEC = {'FORMAT': fmt, 'ZSTD_LEVEL': args.level}
+        start = time.perf_counter()
+        values = [codec.encode(plan) for plan in plans]
+        encoded = time.perf_counter() - start
+        start = time.perf_counter()
+        decoded = [codec.decode(value) for value in values]
+        decode_time = time.perf_counter() - start
+        assert decoded == plans, fmt
+        results.append({
+            'format': fmt,
+            'bytes_per_plan': round(sum(map(len, values)) / len(values), 1),
+            'encode_us': round(encoded / len(plans) * 1e6, 2),
+            'decode_us': round(decode_time / len(plans) * 1e6, 2),
+        })
+
+    baseline = results[0]['bytes_per_plan']
+    for result in results:
+        result['size_vs_json'] = round(baseline / result['bytes_per_plan'], 2)
+
+    print(json.dumps({
+        'plans': args.plans,
+        'services': args.services,
+        'dictionary_bytes': len(dictionary.as_bytes()),
+        'results': results,
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""
+Conditional GET benchmark: stored ETags vs. recomputing them per request.
+
+Seeds one plan with --services linkedPlanServices, then answers --requests
+If-None-Match checks both ways: the old path (HGET the plan, json.loads,
+json.dumps, MD5) and the stored-ETag path used by PlanViewSet.retrieve (one
+HGET of the ETag hash).
+
+    python -m benchmarks.etag --services 50 --requests 20000
+    python -m benchmarks.etag --fake        # fakeredis instead of a server
+"""
+import argparse
+import hashlib
+import json
+import os
+import time
+
+from benchmarks.plans import build_plan
+
+
+def legacy_etag(redis_conn, key, pk):
+    plan = redis_conn.hget(key, pk)
+    data = json.loads(plan)
+    etag = hashlib.md5(json.dumps(data).encode('utf-8')).hexdigest()
+    return f'W/"{etag}"'
+
+
+def timed(fn, requests):
+    start = time.perf_counter()
+    for _ in range(requests):
+        fn()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--services', type=int, default=20)
+    parser.add_argument('--requests', type=int, default=10000)
+    parser.add_argument('--fake', action='store_true', help='use fakeredis instead of the configured Redis')
+    args = parser.parse_args()
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+    if args.fake:
+        import django_redis
+        import fakeredis
+        fake = fakeredis.FakeRedis()
+        django_redis.get_redis_connection = lambda *a, **k: fake
+
+    import django
+    django.setup()
+    from plan import storage
+
+    store = storage.HashPlanStore(storage.get_redis_connection("default"))
+    pk = 'benchmark-etag-plan'
+    store.create(build_plan(pk, args.services))
+    stored = store.get_etag(pk)
+    assert stored == legacy_etag(store.redis, storage.CACHE_KEY, pk)
+
+    plan_bytes = len(store.redis.hget(storage.CACHE_KEY, pk))
+    legacy = timed(lambda: legacy_etag(store.redis, storage.CACHE_KEY, pk), args.requests)
+    precomputed = timed(lambda: store.get_etag(pk), args.requests)
+
+    store.delete(pk)
+
+    print(json.dumps({
+        'services': args.services,
+        'requests': args.requests,
+        'plan_bytes': plan_bytes,
+        'etag_bytes': len(stored),
+        'legacy_us_per_request': round(legacy / args.requests * 1e6, 2),
+        'stored_us_per_request': round(precomputed / args.requests * 1e6, 2),
+        'speedup': round(legacy / precomputed, 2),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
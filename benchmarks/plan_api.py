@@ -0,0 +1,198 @@
+"""
+Latency and throughput of the PlanViewSet endpoints.
+
+Seeds a catalog of --catalog plans, then drives create, retrieve, list, patch
+and delete through the full DRF stack (APIClient) for every --services size.
+Plans are built from JSON_Template.json. RabbitMQ is replaced by an in-memory
+publisher that only counts messages. Redis is fakeredis unless --redis-url
+points at a server; that database must be empty, or --flush given to clear it.
+
+Results (p50/p95/p99 in ms and requests per second per operation, plus the
+settings and commit they were measured with) are printed and, with --output,
+saved as JSON. --compare prints the change against an earlier result file.
+
+    python -m benchmarks.plan_api --services 1 10 50 --requests 500 --output run.json
+    python -m benchmarks.plan_api --redis-url redis://localhost:6379/15 --flush --compare run.json
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import subprocess
+import time
+
+from benchmarks.plans import build_plan
+
+
+class CountingPublisher:
+    # In-memory broker: producer.get_publisher() keeps it while pid matches
+    pid = os.getpid()
+
+    def __init__(self):
+        self.messages = 0
+
+    def publish(self, body, routing_key=None, properties=None):
+        self.messages += 1
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def percentile(latencies, q):
+    return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+
+def summarize(latencies, elapsed):
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'requests_per_second': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+    }
+
+
+def timed_requests(calls, expected_status):
+    latencies = []
+    start = time.perf_counter()
+    for call in calls:
+        request_start = time.perf_counter()
+        response = call()
+        latencies.append(time.perf_counter() - request_start)
+        assert response.status_code == expected_status, (response.status_code, getattr(response, 'data', None))
+    return summarize(latencies, time.perf_counter() - start)
+
+
+def run_size(client, services, catalog, requests, rng):
+    prefix = f'benchmark-api-{services}'
+    for i in range(catalog):
+        response = client.post('/v1/plan/', build_plan(f'{prefix}-catalog-{i}', services), format='json')
+        assert response.status_code == 201, response.data
+
+    created = [build_plan(f'{prefix}-new-{i}', services) for i in range(requests)]
+    catalog_ids = [f'{prefix}-catalog-{rng.randrange(catalog)}' for _ in range(requests)]
+    plan_types = ['inNetwork', 'outOfNetwork']
+
+    results = {
+        'create': timed_requests(
+            (lambda plan=plan: client.post('/v1/plan/', plan, format='json') for plan in created), 201),
+        'retrieve': timed_requests(
+            (lambda pk=pk: client.get(f'/v1/plan/{pk}/') for pk in catalog_ids), 200),
+        'list': timed_requests(
+            (lambda: client.get('/v1/plan/', {'limit': 100}) for _ in range(max(1, requests // 10))), 200),
+        'patch': timed_requests(
+            (lambda pk=pk, i=i: client.patch(
+                f'/v1/plan/{pk}/',
+                json.dumps({'planType': plan_types[i % 2]}),
+                content_type='application/merge-patch+json',
+            ) for i, pk in enumerate(catalog_ids)), 200),
+        'delete': timed_requests(
+            (lambda plan=plan: client.delete(f"/v1/plan/{plan['objectId']}/") for plan in created), 204),
+    }
+
+    for i in range(catalog):
+        client.delete(f'/v1/plan/{prefix}-catalog-{i}/')
+    return results
+
+
+def environment(args):
+    from django.conf import settings
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'redis': args.redis_url or 'fakeredis',
+        'catalog': args.catalog,
+        'requests': args.requests,
+        'seed': args.seed,
+        'PLAN_STORAGE': getattr(settings, 'PLAN_STORAGE', 'hash'),
+        'PLAN_CODEC': getattr(settings, 'PLAN_CODEC', {}).get('FORMAT', 'json'),
+        'PLAN_VALIDATION_ENGINE': getattr(settings, 'PLAN_VALIDATION_ENGINE', 'drf'),
+        'PLAN_CACHE': getattr(settings, 'PLAN_CACHE', {}).get('ENABLED', False),
+    }
+
+
+def compare(results, baseline):
+    # Percent change per services size, operation and metric
+    changes = {}
+    for services, operations in results.items():
+        for operation, metrics in operations.items():
+            before = baseline.get('results', {}).get(services, {}).get(operation)
+            if not before:
+                continue
+            changes.setdefault(services, {})[operation] = {
+                metric: f"{(value - before[metric]) / before[metric] * 100:+.1f}%"
+                for metric, value in metrics.items()
+                if metric != 'requests' and before.get(metric)
+            }
+    return changes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--services', type=int, nargs='+', default=[1, 10], help='linkedPlanServices per plan')
+    parser.add_argument('--catalog', type=int, default=200, help='plans stored before measuring')
+    parser.add_argument('--requests', type=int, default=300, help='requests per operation')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--redis-url', help='Redis database to use instead of fakeredis')
+    parser.add_argument('--flush', action='store_true', help='clear the --redis-url database first')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='earlier results file to compare against')
+    args = parser.parse_args()
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+    import django_redis
+    if args.redis_url:
+        import redis
+        redis_conn = redis.Redis.from_url(args.redis_url)
+        if args.flush:
+            redis_conn.flushdb()
+        elif redis_conn.dbsize():
+            parser.error(f"{args.redis_url} is not empty; pass --flush to clear it")
+    else:
+        import fakeredis
+        redis_conn = fakeredis.FakeRedis()
+    django_redis.get_redis_connection = lambda *a, **k: redis_conn
+
+    import django
+    django.setup()
+    from django.conf import settings
+    settings.ALLOWED_HOSTS = [*settings.ALLOWED_HOSTS, 'testserver']
+    from rest_framework.test import APIClient
+    from plan import producer
+
+    publisher = CountingPublisher()
+    producer._publisher = publisher
+
+    client = APIClient()
+    client.credentials(HTTP_AUTHORIZATION='Bearer benchmark')
+    rng = random.Random(args.seed)
+    results = {
+        str(services): run_size(client, services, args.catalog, args.requests, rng)
+        for services in args.services
+    }
+
+    report = {'environment': environment(args), 'messages_published': publisher.messages, 'results': results}
+    if args.compare:
+        with open(args.compare) as baseline:
+            report['change'] = compare(results, json.load(baseline))
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
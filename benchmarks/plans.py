@@ -0,0 +1,21 @@
+import copy
+import json
+from pathlib import Path
+
+TEMPLATE = Path(__file__).resolve().parent.parent / 'JSON_Template.json'
+
+
+def build_plan(object_id, services=1):
+    """A plan shaped like JSON_Template.json with `services` linkedPlanServices."""
+    template = json.loads(TEMPLATE.read_text())
+    plan = copy.deepcopy(template)
+    plan['objectId'] = object_id
+    service = template['linkedPlanServices'][0]
+    plan['linkedPlanServices'] = []
+    for i in range(services):
+        item = copy.deepcopy(service)
+        item['objectId'] = f'{object_id}-ps-{i}'
+        item['linkedService']['objectId'] = f'{object_id}-s-{i}'
+        item['planserviceCostShares']['objectId'] = f'{object_id}-mcs-{i}'
+        plan['linkedPlanServices'].append(item)
+    return plan
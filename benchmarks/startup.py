@@ -0,0 +1,63 @@
+"""
+Process startup time: how long a fresh interpreter takes to be ready to
+serve or consume, with no service reachable.
+
+Each run starts a new Python process that times django.setup(), loading the
+URLconf (which imports every view module), and importing the consumer and
+the management commands' modules. Nothing may connect while this happens;
+with Redis, RabbitMQ and Elasticsearch down a run that tried would fail or
+hang instead of reporting. Medians over --runs are printed as JSON.
+
+    python -m benchmarks.startup --runs 10
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+PROBE = r'''
+import json, os, time
+start = time.perf_counter()
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+import django
+django.setup()
+setup = time.perf_counter()
+from django.urls import resolve
+resolve('/v1/plan/')
+urls = time.perf_counter()
+import plan.consumer, plan.reconcile, plan.outbox
+modules = time.perf_counter()
+print(json.dumps({
+    'django_setup_ms': (setup - start) * 1000,
+    'urlconf_ms': (urls - setup) * 1000,
+    'consumer_ms': (modules - urls) * 1000,
+    'total_ms': (modules - start) * 1000,
+}))
+'''
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--timeout', type=float, default=30.0, help='seconds before a run counts as hung')
+    args = parser.parse_args()
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    runs = []
+    for _ in range(args.runs):
+        output = subprocess.run(
+            [sys.executable, '-c', PROBE], cwd=root, capture_output=True, text=True, check=True, timeout=args.timeout,
+        ).stdout
+        runs.append(json.loads(output))
+
+    print(json.dumps({
+        'runs': args.runs,
+        'python': sys.version.split()[0],
+        **{phase: round(statistics.median(run[phase] for run in runs), 1) for phase in runs[0]},
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""
+Plan validation microbenchmark: the DRF serializer vs. the compiled validator.
+
+Times both engines on valid plans of each --services size. That they accept
+and reject the same plans is checked by plan/tests/test_validation.py.
+
+    python -m benchmarks.validation --services 1 10 100 --iterations 2000
+"""
+import argparse
+import json
+import os
+import time
+
+from benchmarks.plans import build_plan
+
+
+def timed(fn, data, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn(data)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--services', type=int, nargs='+', default=[1, 10, 100])
+    parser.add_argument('--iterations', type=int, default=1000)
+    args = parser.parse_args()
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+    import django
+    django.setup()
+    from plan.serializers import PlanSerializer
+    from plan.validation import CompiledValidator, drf_validate
+
+    compiled = CompiledValidator(PlanSerializer)
+
+    results = []
+    for services in args.services:
+        data = build_plan(f'bench-{services}', services)
+        drf = timed(lambda d: drf_validate(PlanSerializer, d), data, args.iterations)
+        fast = timed(compiled, data, args.iterations)
+        results.append({
+            'services': services,
+            'iterations': args.iterations,
+            'drf_us_per_plan': round(drf / args.iterations * 1e6, 2),
+            'compiled_us_per_plan': round(fast / args.iterations * 1e6, 2),
+            'speedup': round(drf / fast, 2),
+        })
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -145,3 +145,117 @@ ELASTICSEARCH_DSL={
         'http_auth': ('elastic', 'BuZWUREG')
     }
 }
+
+RABBITMQ = {
+    'HOST': 'localhost',
+    'PORT': 5672,
+    'QUEUE': 'index_queue',
+    # Messages are partitioned by plan over QUEUE.0 .. QUEUE.<SHARDS-1>, each
+    # consumed by one run_consumer process; 1 keeps the single QUEUE
+    'SHARDS': 1,
+    # Channels (each on its own connection) shared by request threads
+    'CHANNEL_POOL_SIZE': 4,
+    # Publisher confirms are awaited once per batch instead of per message
+    'CONFIRM_DELIVERY': True,
+    'CONFIRM_BATCH_SIZE': 50,
+    'CONFIRM_TIMEOUT': 5.0,
+}
+
+# manage.py run_consumer: messages RabbitMQ delivers to each process before
+# they are acked (after their Elasticsearch write), and the indexing threads
+# and processes they are spread over
+PLAN_CONSUMER = {
+    'PREFETCH_COUNT': 500,
+    'WORKERS': 4,
+    'PROCESSES': 1,
+    # A message that fails to index is retried after 5, 10, 20, ... seconds
+    # through delay queues, then moved to <queue>.dead (manage.py dead_letters)
+    'MAX_RETRIES': 5,
+    'RETRY_BASE_DELAY': 5.0,
+}
+
+# Transactional outbox (see plan/outbox.py): with ENABLED, writes append
+# their index message to a Redis stream in the same script as the write, and
+# manage.py relay_outbox publishes the stream to RabbitMQ
+PLAN_OUTBOX = {
+    'ENABLED': False,
+    'GROUP': 'relay',
+    'BATCH_SIZE': 500,
+    'BLOCK_MS': 1000,
+}
+
+# Bearer tokens (see plan/auth.py): with ENABLED, tokens are JWTs verified
+# against KEYS (kid: PEM public key or HS secret) and need READ_SCOPE for
+# GET requests and WRITE_SCOPE otherwise; SCOPES overrides them per action.
+# Verified tokens are cached per process (up to CACHE_SIZE) until they
+# expire. Without ENABLED any Bearer token is accepted.
+PLAN_AUTH = {
+    'ENABLED': False,
+    'KEYS': {},
+    'ALGORITHMS': ['RS256'],
+    'ISSUER': None,
+    'AUDIENCE': None,
+    'LEEWAY': 30,
+    'READ_SCOPE': 'plans:read',
+    'WRITE_SCOPE': 'plans:write',
+    'SCOPES': {},
+    'CACHE_SIZE': 10000,
+}
+
+# /readyz (see plan/health.py) returns 503 while a REQUIRED service is down.
+# None means redis, plus rabbitmq unless PLAN_OUTBOX is enabled; all
+# services are reported either way. TIMEOUT bounds the checks in seconds.
+PLAN_HEALTH = {
+    'REQUIRED': None,
+    'TIMEOUT': 2.0,
+}
+
+# 'drf' validates plans with PlanSerializer; 'compiled' uses the generated
+# fast-path validator in plan/validation.py (same results and error bodies)
+PLAN_VALIDATION_ENGINE = 'drf'
+
+# 'hash' keeps each plan as one JSON value in the plans hash; 'graph' splits
+# plans into one key per object (objectType:objectId), sharing objects that
+# several plans reference; changing a shared object queues the other plans
+# referencing it for indexing again. The two layouts are not migrated between.
+PLAN_STORAGE = 'hash'
+
+# GET /v1/plan/_search. Pages are served from a point-in-time kept open for
+# PIT_KEEP_ALIVE; result pages are cached in Redis for CACHE_TTL seconds
+# (0 disables the cache) and dropped by the consumer REFRESH_INTERVAL (the
+# index's refresh_interval) after it indexed a change.
+PLAN_SEARCH = {
+    'INDEX': 'plans',
+    'PAGE_SIZE': 20,
+    'MAX_PAGE_SIZE': 500,
+    'PIT_KEEP_ALIVE': '2m',
+    'CACHE_TTL': 30,
+    'REFRESH_INTERVAL': 1.0,
+}
+
+# Per-process cache of rendered plans for retrieve, invalidated through
+# Redis pub/sub on every plan write. Counters: GET /v1/plan/_cache/
+PLAN_CACHE = {
+    'ENABLED': False,
+    'MAX_ENTRIES': 10000,
+    'MAX_BYTES': 64 * 1024 * 1024,
+    'TTL': 60,
+}
+
+# Format of new values in the plans hash: 'json', 'orjson', 'msgpack' or
+# 'zstd' (MessagePack compressed with a dictionary trained by
+# manage.py train_plan_dictionary). Values in any format stay readable;
+# manage.py migrate_plan_codec rewrites existing ones. Graph storage
+# (PLAN_STORAGE = 'graph') always stores JSON.
+PLAN_CODEC = {
+    'FORMAT': 'json',
+    'ZSTD_LEVEL': 3,
+}
+
+# Per-stage latency histograms for the plan API, served in the Prometheus
+# text format at /metrics (see plan/metrics.py). With ENABLED off nothing is
+# timed and /metrics returns 404.
+PLAN_METRICS = {
+    'ENABLED': True,
+    'BUCKETS': (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0),
+}
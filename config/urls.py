@@ -1,7 +1,14 @@
 from django.contrib import admin
 from django.urls import path, include
 
+from plan.health import liveness, readiness
+from plan.metrics import metrics_view
+
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('v1/', include('plan.urls')),
+    path('async/v1/', include('plan.async_urls')),
+    path('metrics', metrics_view, name='metrics'),
+    path('healthz', liveness, name='liveness'),
+    path('readyz', readiness, name='readiness'),
 ]
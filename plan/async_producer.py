@@ -0,0 +1,72 @@
+"""
+aio-pika publisher for the async views. Messages are identical to the ones
+plan/producer.py publishes; connections and channels come from per-event-loop
+pools sized by the RABBITMQ settings.
+"""
+import asyncio
+import weakref
+
+from plan.metrics import timed
+from plan.producer import delta_message, get_config, queue_message, routing_key
+from plan.sharding import shard_queues
+
+# Connections per event loop; channels are multiplexed over them
+CONNECTION_POOL_SIZE = 2
+
+
+class AsyncPublisher:
+    def __init__(self, config=None):
+        # aio-pika is imported by the first async publish, not with the views
+        from aio_pika.pool import Pool
+
+        self.config = config or get_config()
+        self.connections = Pool(self.connect, max_size=CONNECTION_POOL_SIZE)
+        self.channels = Pool(self.open_channel, max_size=self.config['CHANNEL_POOL_SIZE'])
+        self.declared = False
+
+    async def connect(self):
+        import aio_pika
+        return await aio_pika.connect_robust(host=self.config['HOST'], port=self.config['PORT'])
+
+    async def open_channel(self):
+        async with self.connections.acquire() as connection:
+            # With confirms, publish() returns once the broker has the message
+            channel = await connection.channel(publisher_confirms=self.config['CONFIRM_DELIVERY'])
+        if not self.declared:
+            for name in shard_queues(self.config['QUEUE'], self.config['SHARDS']):
+                await channel.declare_queue(name)
+            self.declared = True
+        return channel
+
+    async def publish(self, body, routing_key=None):
+        import aio_pika
+        async with self.channels.acquire() as channel:
+            await channel.default_exchange.publish(
+                aio_pika.Message(body.encode('utf-8')),
+                routing_key=routing_key or self.config['QUEUE'],
+                timeout=self.config['CONFIRM_TIMEOUT'],
+            )
+
+    async def close(self):
+        await self.channels.close()
+        await self.connections.close()
+
+
+_publishers = weakref.WeakKeyDictionary()
+
+
+def get_async_publisher():
+    loop = asyncio.get_running_loop()
+    if loop not in _publishers:
+        _publishers[loop] = AsyncPublisher()
+    return _publishers[loop]
+
+
+@timed('publish')
+async def send_to_queue(document, operation):
+    await get_async_publisher().publish(queue_message(document, operation), routing_key(document.get('objectId')))
+
+
+@timed('publish')
+async def send_delta_to_queue(object_id, delta, etag=None):
+    await get_async_publisher().publish(delta_message(object_id, delta, etag), routing_key(object_id))
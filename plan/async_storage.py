@@ -0,0 +1,248 @@
+"""
+redis.asyncio versions of the plan stores, for the async views.
+
+They reuse the key layout, Lua scripts and (de)serialization of
+plan/storage.py and only replace the calls that touch Redis. Clients are
+kept per event loop, since asyncio connections cannot be shared between
+loops. The zstd dictionaries that plan/codec.py would fetch with the sync
+django_redis client are loaded through the async one before encoding or
+returning values.
+"""
+import asyncio
+import json
+import weakref
+
+import redis.asyncio as aioredis
+from django.conf import settings
+
+from plan import codec, scripts
+from plan.async_producer import send_to_queue
+from plan.metrics import timed
+from plan.storage import (
+    CACHE_KEY,
+    ETAG_KEY,
+    GraphPlanStore,
+    HashPlanStore,
+    blob_etag,
+    digest_bucket,
+    encode_plan,
+)
+
+# Connections per event loop
+MAX_CONNECTIONS = 100
+
+
+class AsyncHashPlanStore(HashPlanStore):
+    async def run(self, script, pk, *args):
+        bucket = digest_bucket(pk)
+        result = await script(keys=self.script_keys(bucket), args=[pk, *args, bucket])
+        if result[0] == scripts.ETAG_MISSING:
+            await self.get_etag(pk)
+            result = await script(keys=self.script_keys(bucket), args=[pk, *args, bucket])
+        return result
+
+    async def backfill_etag(self, pk, plan):
+        await codec.dictionaries.aload(self.redis, [plan])
+        etag = blob_etag(codec.to_json(plan))
+        await self.redis.hsetnx(ETAG_KEY, pk, etag)
+        return etag
+
+    @timed('redis')
+    async def get_etag(self, pk):
+        etag = await self.redis.hget(ETAG_KEY, pk)
+        if etag:
+            return etag.decode('utf-8')
+        plan = await self.redis.hget(CACHE_KEY, pk)
+        if plan:
+            return await self.backfill_etag(pk, plan)
+        return None
+
+    @timed('redis')
+    async def get(self, pk):
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hget(CACHE_KEY, pk)
+            pipe.hget(ETAG_KEY, pk)
+            plan, etag = await pipe.execute()
+        if not plan:
+            return None, None
+        if not etag:
+            return plan, await self.backfill_etag(pk, plan)
+        await codec.dictionaries.aload(self.redis, [plan])
+        return plan, etag.decode('utf-8')
+
+    @timed('redis')
+    async def all(self):
+        plans = await self.redis.hgetall(CACHE_KEY)
+        await codec.dictionaries.aload(self.redis, plans.values())
+        return {key.decode('utf-8'): value for key, value in plans.items()}
+
+    @timed('redis')
+    async def scan(self, cursor, count):
+        next_cursor, plans = await self.redis.hscan(CACHE_KEY, cursor, count=count)
+        await codec.dictionaries.aload(self.redis, plans.values())
+        return next_cursor, {key.decode('utf-8'): value for key, value in plans.items()}
+
+    @timed('redis')
+    async def create(self, data, outbox=''):
+        await codec.dictionaries.aload(self.redis, encoding=True)
+        plan, etag = encode_plan(data)
+        code, *_ = await self.run(self.create_script, data['objectId'], plan, etag, outbox)
+        return code, etag
+
+    @timed('redis')
+    async def replace(self, pk, data, expected_etag='', previous=None, outbox=''):
+        await codec.dictionaries.aload(self.redis, encoding=True)
+        plan, etag = encode_plan(data)
+        code, *_ = await self.run(self.replace_script, pk, expected_etag or '', plan, etag, outbox)
+        return code, etag
+
+    @timed('redis')
+    async def delete(self, pk, if_match='', if_none_match='', outbox=''):
+        code, *deleted = await self.run(self.delete_script, pk, if_match or '', if_none_match or '', outbox)
+        if code != scripts.OK:
+            return code, None
+        await codec.dictionaries.aload(self.redis, deleted[:1])
+        return code, codec.decode(deleted[0])
+
+
+class AsyncGraphPlanStore(GraphPlanStore):
+    async def load_objects(self, keys):
+        if not keys:
+            return {}
+        values = await self.redis.mget(keys)
+        return {key: json.loads(value) for key, value in zip(keys, values) if value is not None}
+
+    async def refresh_etag(self, pk, plan):
+        keys, args, etag = self.fill_etag_args(pk, plan)
+        await self.fill_etag_script(keys=keys, args=args)
+        return etag
+
+    @timed('redis')
+    async def get_etag(self, pk):
+        etag = await self.redis.hget(ETAG_KEY, pk)
+        if etag is None:
+            return None
+        if etag:
+            return etag.decode('utf-8')
+        return (await self.get(pk))[1]
+
+    @timed('redis')
+    async def get(self, pk):
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.get(self.record_key(pk))
+            pipe.hget(ETAG_KEY, pk)
+            record, etag = await pipe.execute()
+        if not record:
+            return None, None
+        data = self.assemble(record, await self.load_objects(json.loads(record)['keys']))
+        plan = json.dumps(data).encode('utf-8')
+        if not etag:
+            return plan, await self.refresh_etag(pk, plan)
+        return plan, etag.decode('utf-8')
+
+    async def load_plans(self, ids):
+        records = await self.redis.mget([self.record_key(pk) for pk in ids]) if ids else []
+        records = {pk: record for pk, record in zip(ids, records) if record}
+        objects = await self.load_objects(self.record_keys(*records.values()))
+        return {
+            pk: json.dumps(self.assemble(record, objects)).encode('utf-8')
+            for pk, record in records.items()
+        }
+
+    @timed('redis')
+    async def scan(self, cursor, count):
+        next_cursor, etags = await self.redis.hscan(ETAG_KEY, cursor, count=count)
+        return next_cursor, await self.load_plans([key.decode('utf-8') for key in etags])
+
+    async def queue_affected(self, ids, outbox):
+        if outbox or not ids:
+            return
+        plans = await self.load_plans([pk.decode('utf-8') for pk in ids])
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for pk, plan in plans.items():
+                keys, args, _ = self.fill_etag_args(pk, plan)
+                await self.fill_etag_script(keys=keys, args=args, client=pipe)
+            await pipe.execute()
+        for plan in plans.values():
+            await send_to_queue(json.loads(plan), 'update')
+
+    @timed('redis')
+    async def all(self):
+        plans = {}
+        cursor = 0
+        while True:
+            cursor, page = await self.scan(cursor, 500)
+            plans.update(page)
+            if not cursor:
+                return plans
+
+    async def write(self, mode, pk, data, expected_etag='', previous=None, outbox=''):
+        refreshed = False
+        while True:
+            current = await self.redis.get(self.record_key(pk)) if mode == 'replace' else None
+            keys, args, etag = self.write_args(mode, pk, data, expected_etag, previous, outbox, current)
+            code, *affected = await self.write_script(keys=keys, args=args)
+            if code == scripts.ETAG_MISSING and not refreshed:
+                await self.get(pk)
+                refreshed = True
+            elif code != scripts.RECORD_CHANGED:
+                break
+        await self.queue_affected(affected, outbox)
+        return code, etag
+
+    @timed('redis')
+    async def create(self, data, outbox=''):
+        return await self.write('create', data['objectId'], data, outbox=outbox)
+
+    @timed('redis')
+    async def replace(self, pk, data, expected_etag='', previous=None, outbox=''):
+        return await self.write('replace', pk, data, expected_etag, previous, outbox)
+
+    @timed('redis')
+    async def delete(self, pk, if_match='', if_none_match='', outbox=''):
+        refreshed = False
+        while True:
+            current = await self.redis.get(self.record_key(pk))
+            keys, args = self.delete_args(pk, if_match, if_none_match, outbox, current)
+            code, *values = await self.delete_script(keys=keys, args=args)
+            if code == scripts.ETAG_MISSING and not refreshed:
+                await self.get(pk)
+                refreshed = True
+            elif code != scripts.RECORD_CHANGED:
+                break
+        if code != scripts.OK:
+            return code, None
+        objects = {key: json.loads(value) for key, value in zip(self.record_keys(current), values) if value is not None}
+        return code, self.assemble(current, objects)
+
+
+STORES = {
+    'hash': AsyncHashPlanStore,
+    'graph': AsyncGraphPlanStore,
+}
+
+_clients = weakref.WeakKeyDictionary()
+_stores = weakref.WeakKeyDictionary()
+
+
+def connect():
+    # Requests beyond MAX_CONNECTIONS wait for a free connection
+    pool = aioredis.BlockingConnectionPool.from_url(
+        settings.CACHES['default']['LOCATION'],
+        max_connections=MAX_CONNECTIONS,
+    )
+    return aioredis.Redis(connection_pool=pool)
+
+
+def get_async_redis():
+    loop = asyncio.get_running_loop()
+    if loop not in _clients:
+        _clients[loop] = connect()
+    return _clients[loop]
+
+
+def get_async_plan_store():
+    loop = asyncio.get_running_loop()
+    if loop not in _stores:
+        _stores[loop] = STORES[getattr(settings, 'PLAN_STORAGE', 'hash')](get_async_redis())
+    return _stores[loop]
@@ -0,0 +1,7 @@
+from django.urls import path
+from . import async_views
+
+urlpatterns = [
+    path('plan/', async_views.plan_collection, name='async-plan-list'),
+    path('plan/<str:pk>/', async_views.plan_detail, name='async-plan-detail'),
+]
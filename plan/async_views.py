@@ -0,0 +1,281 @@
+"""
+Async plan endpoints, mounted under /async/v1/ next to the PlanViewSet ones.
+
+Same request/response contract as plan/views.py, but Redis and RabbitMQ are
+awaited (redis.asyncio, aio-pika) so that under ASGI one worker can keep many
+requests in flight without a thread each. DRF views cannot be async, so these
+are plain Django views rendering with DRF's JSONRenderer for identical bodies.
+"""
+import functools
+import json
+from datetime import date
+
+from django.http import HttpResponse, HttpResponseNotAllowed
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework import serializers, status
+from rest_framework.renderers import JSONRenderer
+
+from plan import auth, metrics, outbox, scripts
+from plan.async_producer import send_delta_to_queue, send_to_queue
+from plan.async_storage import get_async_plan_store
+from plan.cache import get_plan_cache
+from plan.changes import plan_delta
+from plan.codec import decode
+from plan.validation import validate_plan
+from plan.views import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, PATCH_ATTEMPTS, apply_patch
+
+SCRIPT_ERRORS = {
+    scripts.NOT_FOUND: ("Plan not found", status.HTTP_404_NOT_FOUND),
+    scripts.EXISTS: ("Plan with ID: {pk} already exists", status.HTTP_409_CONFLICT),
+    scripts.PRECONDITION_FAILED: ("Precondition Failed", status.HTTP_412_PRECONDITION_FAILED),
+}
+
+# PlanViewSet action names by method, for PLAN_AUTH['SCOPES']
+COLLECTION_ACTIONS = {'GET': 'list', 'POST': 'create'}
+DETAIL_ACTIONS = {'GET': 'retrieve', 'PUT': 'update', 'PATCH': 'partial_update', 'DELETE': 'destroy'}
+
+
+def json_response(data, status_code=status.HTTP_200_OK, etag=None):
+    response = HttpResponse(JSONRenderer().render(data), status=status_code, content_type=JSONRenderer.media_type)
+    if etag:
+        response['ETag'] = etag
+    return response
+
+
+def message_response(message, status_code, etag=None):
+    return json_response({"message": message, "status_code": status_code}, status_code, etag)
+
+
+def script_error_response(code, pk):
+    message, status_code = SCRIPT_ERRORS[code]
+    return message_response(message.format(pk=pk), status_code)
+
+
+def check_bearer_token(request, action):
+    with metrics.stage('auth'):
+        try:
+            auth.authenticate(request.headers.get('Authorization'), action, request.method)
+        except auth.AuthenticationError as exc:
+            response = message_response(exc.message, exc.status_code)
+            for header, value in exc.headers.items():
+                response[header] = value
+            return response
+    return None
+
+
+def timed_request(actions):
+    """
+    Times the view like PlanViewSet.dispatch, labelled with the PlanViewSet
+    action the method maps to in actions.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            timer = metrics.start_request()
+            if timer is None:
+                return await view(request, *args, **kwargs)
+            status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
+            try:
+                response = await view(request, *args, **kwargs)
+                status_code = response.status_code
+                return response
+            finally:
+                metrics.finish_request(timer, actions.get(request.method) or request.method.lower(), status_code)
+        return wrapper
+    return decorator
+
+
+def parse_body(request):
+    try:
+        return json.loads(request.body), None
+    except ValueError as exc:
+        return None, json_response({"detail": f"JSON parse error - {exc}"}, status.HTTP_400_BAD_REQUEST)
+
+
+def validated_plan(data):
+    validated_data, errors = validate_plan(data)
+    if errors:
+        return None, json_response(
+            {
+                "message": "Missing or invalid fields in request body",
+                "status_code": 400,
+                "errors": errors
+            },
+            status.HTTP_400_BAD_REQUEST
+        )
+    # Convert date objects to strings
+    for key, value in validated_data.items():
+        if isinstance(value, date):
+            validated_data[key] = value.isoformat()
+    return validated_data, None
+
+
+@csrf_exempt
+@timed_request(COLLECTION_ACTIONS)
+async def plan_collection(request):
+    auth_response = check_bearer_token(request, COLLECTION_ACTIONS.get(request.method))
+    if auth_response:
+        return auth_response
+    if request.method == 'GET':
+        return await list_plans(request)
+    if request.method == 'POST':
+        return await create_plan(request)
+    return HttpResponseNotAllowed(['GET', 'POST'])
+
+
+@csrf_exempt
+@timed_request(DETAIL_ACTIONS)
+async def plan_detail(request, pk):
+    auth_response = check_bearer_token(request, DETAIL_ACTIONS.get(request.method))
+    if auth_response:
+        return auth_response
+    handler = {
+        'GET': retrieve_plan,
+        'PUT': update_plan,
+        'PATCH': partial_update_plan,
+        'DELETE': destroy_plan,
+    }.get(request.method)
+    if handler is None:
+        return HttpResponseNotAllowed(['GET', 'PUT', 'PATCH', 'DELETE'])
+    return await handler(request, pk)
+
+
+async def list_plans(request):
+    store = get_async_plan_store()
+    if 'cursor' not in request.GET and 'limit' not in request.GET:
+        plans = await store.all()
+        return json_response({key: decode(value) for key, value in plans.items()})
+
+    try:
+        cursor = int(request.GET.get('cursor') or 0)
+        limit = int(request.GET.get('limit') or DEFAULT_PAGE_SIZE)
+    except ValueError:
+        cursor = limit = -1
+    if cursor < 0 or not 0 < limit <= MAX_PAGE_SIZE:
+        return message_response(
+            f"cursor must be a non-negative integer and limit between 1 and {MAX_PAGE_SIZE}",
+            status.HTTP_400_BAD_REQUEST
+        )
+    next_cursor, plans = await store.scan(cursor, limit)
+    return json_response({
+        "plans": {key: decode(value) for key, value in plans.items()},
+        "next_cursor": str(next_cursor) if next_cursor else None
+    })
+
+
+async def retrieve_plan(request, pk):
+    cache = get_plan_cache()
+    cached = cache.get(pk) if cache is not None else None
+    if cached is None:
+        generation = cache.generation if cache is not None else None
+        plan, weak_etag = await get_async_plan_store().get(pk)
+        if not plan:
+            return message_response("Plan not found", status.HTTP_404_NOT_FOUND)
+        body = JSONRenderer().render(decode(plan))
+        if cache is not None:
+            cache.put(pk, body, weak_etag, generation)
+    else:
+        body, weak_etag = cached
+
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match and if_none_match == weak_etag:
+        return HttpResponse(status=status.HTTP_304_NOT_MODIFIED)
+
+    if_match = request.headers.get('If-Match')
+    if if_match and if_match != weak_etag:
+        return message_response("Precondition Failed", status.HTTP_412_PRECONDITION_FAILED)
+
+    response = HttpResponse(body, content_type=JSONRenderer.media_type)
+    response['ETag'] = weak_etag
+    return response
+
+
+async def create_plan(request):
+    data, error_response = parse_body(request)
+    if error_response:
+        return error_response
+    validated_data, error_response = validated_plan(data)
+    if error_response:
+        return error_response
+
+    object_id = validated_data['objectId']
+    message = outbox.entry(validated_data, 'create')
+    code, weak_etag = await get_async_plan_store().create(validated_data, outbox=message)
+    if code != scripts.OK:
+        return script_error_response(code, object_id)
+
+    if not message:
+        await send_to_queue(validated_data, 'create')
+    return message_response(f"Plan with ID: {object_id} saved", status.HTTP_201_CREATED, weak_etag)
+
+
+async def update_plan(request, pk):
+    data, error_response = parse_body(request)
+    if error_response:
+        return error_response
+    validated_data, error_response = validated_plan(data)
+    if error_response:
+        return error_response
+
+    if_match = request.headers.get('If-Match')
+    message = outbox.entry(validated_data, 'update')
+    code, weak_etag = await get_async_plan_store().replace(pk, validated_data, if_match, outbox=message)
+    if code != scripts.OK:
+        return script_error_response(code, pk)
+
+    if not message:
+        await send_to_queue(validated_data, 'update')
+    return message_response(f"Plan with ID: {pk} updated", status.HTTP_200_OK, weak_etag)
+
+
+async def partial_update_plan(request, pk):
+    store = get_async_plan_store()
+    if_match = request.headers.get('If-Match')
+    data, error_response = parse_body(request)
+    if error_response:
+        return error_response
+    for _ in range(PATCH_ATTEMPTS):
+        plan, weak_etag = await store.get(pk)
+        if not plan:
+            return message_response("Plan not found", status.HTTP_404_NOT_FOUND)
+
+        if if_match and if_match != weak_etag:
+            return message_response("Precondition Failed", status.HTTP_412_PRECONDITION_FAILED)
+
+        try:
+            plan_data, errors = apply_patch(pk, decode(plan), request.content_type, data)
+        except serializers.ValidationError as exc:
+            return json_response(exc.detail, status.HTTP_400_BAD_REQUEST)
+        if errors:
+            return json_response(errors, status.HTTP_400_BAD_REQUEST)
+
+        previous = decode(plan)
+        delta = plan_delta(previous, plan_data)
+        message = outbox.delta_entry(pk, delta, plan_data) if delta else ''
+        code, weak_etag = await store.replace(pk, plan_data, weak_etag, previous=previous, outbox=message)
+        if code != scripts.PRECONDITION_FAILED or if_match:
+            break
+    else:
+        return message_response(
+            f"Plan with ID: {pk} was modified concurrently, retry the request", status.HTTP_409_CONFLICT,
+        )
+    if code != scripts.OK:
+        return script_error_response(code, pk)
+
+    if delta:
+        if not message:
+            await send_delta_to_queue(pk, delta, weak_etag)
+    return message_response(f"Plan with ID: {pk} partially updated", status.HTTP_200_OK, weak_etag)
+
+
+async def destroy_plan(request, pk):
+    if_match = request.headers.get('If-Match')
+    if_not_match = request.headers.get('If-None-Match')
+    message = outbox.entry({'objectId': pk}, 'delete')
+    code, plan_data = await get_async_plan_store().delete(pk, if_match, if_not_match, outbox=message)
+    if code != scripts.OK:
+        return script_error_response(code, pk)
+
+    if not message:
+        await send_to_queue(plan_data, 'delete')
+    return HttpResponse(status=status.HTTP_204_NO_CONTENT)
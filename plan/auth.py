@@ -0,0 +1,205 @@
+"""
+Bearer token verification for the plan endpoints.
+
+With PLAN_AUTH['ENABLED'], tokens are JWTs verified in process against the
+keys in PLAN_AUTH['KEYS'] (by the token's kid), with the configured
+algorithms, issuer and audience, and must carry an exp claim. Each action
+then needs a scope from the token's scope (space separated) or scp claim:
+READ_SCOPE for GET requests, WRITE_SCOPE otherwise, unless SCOPES names one
+for the action.
+
+Verified tokens are kept in a per-process LRU keyed by their SHA-256 digest
+until their exp, so a client reusing a token pays for the signature check
+once; scopes are still checked on every request. Tokens that fail
+verification are not cached. Without ENABLED any Bearer token is accepted,
+as before.
+
+PyJWT (with cryptography for RS/ES/PS keys) is only needed, and imported,
+when ENABLED.
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+DEFAULTS = {
+    'ENABLED': False,
+    # kid: PEM public key, or shared secret for HS algorithms. A token
+    # without a kid is checked against the only key, if there is one.
+    'KEYS': {},
+    'ALGORITHMS': ['RS256'],
+    'ISSUER': None,
+    'AUDIENCE': None,
+    # Seconds of clock skew allowed on exp and nbf
+    'LEEWAY': 30,
+    'READ_SCOPE': 'plans:read',
+    'WRITE_SCOPE': 'plans:write',
+    # action: scope, overriding READ_SCOPE and WRITE_SCOPE
+    'SCOPES': {},
+    'CACHE_SIZE': 10000,
+}
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+def get_config():
+    config = dict(DEFAULTS)
+    config.update(getattr(settings, 'PLAN_AUTH', {}))
+    return config
+
+
+class AuthenticationError(Exception):
+    def __init__(self, message, status_code=401, challenge='Bearer'):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+        self.headers = {'WWW-Authenticate': challenge}
+
+
+class TokenCache:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, digest):
+        with self.lock:
+            entry = self.entries.get(digest)
+            if entry is None:
+                return None
+            expires, scopes = entry
+            if expires <= time.time():
+                del self.entries[digest]
+                return None
+            self.entries.move_to_end(digest)
+            return scopes
+
+    def put(self, digest, expires, scopes):
+        with self.lock:
+            self.entries[digest] = (expires, scopes)
+            self.entries.move_to_end(digest)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+_cache = None
+# Parsed keys by (algorithm, key): loading a PEM key costs about as much as
+# a verification
+_keys = {}
+_lock = threading.Lock()
+
+
+def _reset_after_fork():
+    global _cache, _keys, _lock
+    _cache = None
+    _keys = {}
+    _lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def get_token_cache(config):
+    global _cache
+    if _cache is None:
+        with _lock:
+            if _cache is None:
+                _cache = TokenCache(config['CACHE_SIZE'])
+    return _cache
+
+
+def signing_key(config, token):
+    import jwt
+    header = jwt.get_unverified_header(token)
+    algorithm = header.get('alg')
+    if algorithm not in config['ALGORITHMS']:
+        raise jwt.InvalidAlgorithmError(f"Algorithm {algorithm!r} is not allowed")
+    keys = config['KEYS']
+    kid = header.get('kid')
+    if kid is None and len(keys) == 1:
+        kid = next(iter(keys))
+    if kid not in keys:
+        raise jwt.InvalidTokenError(f"Unknown key id {kid!r}")
+    key = _keys.get((algorithm, keys[kid]))
+    if key is None:
+        key = _keys[(algorithm, keys[kid])] = jwt.get_algorithm_by_name(algorithm).prepare_key(keys[kid])
+    return key, algorithm
+
+
+def token_scopes(claims):
+    import jwt
+    scopes = claims.get('scope', claims.get('scp', ()))
+    if isinstance(scopes, str):
+        scopes = scopes.split()
+    if not isinstance(scopes, (list, tuple)) or not all(isinstance(scope, str) for scope in scopes):
+        raise jwt.InvalidTokenError("Invalid scope claim")
+    return frozenset(scopes)
+
+
+def verify(config, token):
+    """
+    Returns the scopes of a valid token, from the cache if it was verified
+    before. Raises jwt.InvalidTokenError otherwise.
+    """
+    import jwt
+    cache = get_token_cache(config)
+    digest = hashlib.sha256(token.encode('utf-8')).digest()
+    scopes = cache.get(digest)
+    if scopes is not None:
+        return scopes
+
+    key, algorithm = signing_key(config, token)
+    claims = jwt.decode(
+        token,
+        key,
+        algorithms=[algorithm],
+        issuer=config['ISSUER'],
+        audience=config['AUDIENCE'],
+        leeway=config['LEEWAY'],
+        options={'require': ['exp']},
+    )
+    scopes = token_scopes(claims)
+    cache.put(digest, claims['exp'], scopes)
+    return scopes
+
+
+def required_scope(config, action, method):
+    scope = config['SCOPES'].get(action)
+    if scope is None:
+        scope = config['READ_SCOPE'] if method in SAFE_METHODS else config['WRITE_SCOPE']
+    return scope
+
+
+def authenticate(authorization, action, method):
+    """
+    Checks the Authorization header of a request for action. Raises
+    AuthenticationError with the status code and message to answer with.
+    """
+    if not authorization or not authorization.startswith('Bearer '):
+        raise AuthenticationError("Authorization token missing or invalid")
+    config = get_config()
+    if not config['ENABLED']:
+        return
+    try:
+        import jwt
+    except ImportError:
+        raise ImproperlyConfigured("PLAN_AUTH needs the 'PyJWT' package (pip install 'PyJWT[crypto]')")
+
+    try:
+        scopes = verify(config, authorization[len('Bearer '):].strip())
+    except jwt.ExpiredSignatureError:
+        raise AuthenticationError("Authorization token has expired", challenge='Bearer error="invalid_token"')
+    except jwt.InvalidTokenError:
+        raise AuthenticationError("Authorization token missing or invalid", challenge='Bearer error="invalid_token"')
+
+    scope = required_scope(config, action, method)
+    if scope and scope not in scopes:
+        raise AuthenticationError(
+            f"Authorization token lacks the {scope} scope",
+            status_code=403,
+            challenge=f'Bearer error="insufficient_scope", scope="{scope}"',
+        )
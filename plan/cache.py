@@ -0,0 +1,175 @@
+"""
+Per-process read-through cache for retrieve.
+
+Entries hold the rendered JSON response body and the ETag of a plan, bounded
+by entry count and total body size (LRU) and by a TTL. Every plan write
+publishes the plan's objectId on scripts.INVALIDATION_CHANNEL from inside its
+Lua script; each process runs a subscriber thread that drops those entries.
+While the subscriber is not connected nothing is cached, since
+invalidations could be missed.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import redis
+from django.conf import settings
+from django_redis import get_redis_connection
+
+from plan import scripts
+
+DEFAULTS = {
+    'ENABLED': False,
+    'MAX_ENTRIES': 10000,
+    'MAX_BYTES': 64 * 1024 * 1024,
+    'TTL': 60,
+}
+
+# Seconds between attempts to resubscribe after losing the connection
+RECONNECT_DELAY = 1.0
+
+
+def get_config():
+    config = dict(DEFAULTS)
+    config.update(getattr(settings, 'PLAN_CACHE', {}))
+    return config
+
+
+class PlanCache:
+    def __init__(self, max_entries, max_bytes, ttl):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        # Bumped by every invalidation, so that a plan read from Redis before
+        # an invalidation is not cached after it
+        self.generation = 0
+        self.listening = False
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, pk):
+        with self.lock:
+            entry = self.entries.get(pk)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires, body, etag = entry
+            if expires <= time.monotonic():
+                self.remove(pk)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(pk)
+            self.hits += 1
+            return body, etag
+
+    def put(self, pk, body, etag, generation):
+        if len(body) > self.max_bytes:
+            return
+        with self.lock:
+            if not self.listening or generation != self.generation:
+                return
+            self.remove(pk)
+            self.entries[pk] = (time.monotonic() + self.ttl, body, etag)
+            self.size += len(body)
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                _, (_, evicted, _) = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def remove(self, pk):
+        entry = self.entries.pop(pk, None)
+        if entry is not None:
+            self.size -= len(entry[1])
+        return entry is not None
+
+    def invalidate(self, pk):
+        with self.lock:
+            self.generation += 1
+            if self.remove(pk):
+                self.invalidations += 1
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "listening": self.listening,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+            }
+
+    def listen(self, redis_conn):
+        while True:
+            pubsub = redis_conn.pubsub()
+            try:
+                pubsub.subscribe(scripts.INVALIDATION_CHANNEL)
+                for message in pubsub.listen():
+                    if message['type'] == 'subscribe':
+                        # Anything written before this point may have been
+                        # missed, so caching starts again from empty
+                        self.clear()
+                        self.listening = True
+                    elif message['type'] == 'message':
+                        self.invalidate(message['data'].decode('utf-8'))
+            except redis.RedisError:
+                pass
+            finally:
+                with self.lock:
+                    self.listening = False
+                self.clear()
+                pubsub.close()
+            time.sleep(RECONNECT_DELAY)
+
+    def start(self, redis_conn):
+        thread = threading.Thread(target=self.listen, args=(redis_conn,), name='plan-cache-invalidation', daemon=True)
+        thread.start()
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def _reset_after_fork():
+    # The subscriber thread is not carried over into a forked child
+    global _cache, _cache_lock
+    _cache = None
+    _cache_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def get_plan_cache():
+    """
+    Returns this process's PlanCache, or None when PLAN_CACHE is disabled.
+    """
+    global _cache
+    config = get_config()
+    if not config['ENABLED']:
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                cache = PlanCache(config['MAX_ENTRIES'], config['MAX_BYTES'], config['TTL'])
+                cache.start(get_redis_connection("default"))
+                _cache = cache
+    return _cache
@@ -0,0 +1,63 @@
+"""
+Structural diff between two versions of a plan, expressed as the join
+documents the indexer has to touch (see the my_join_field relations in
+plan/consumer.py).
+"""
+
+SERVICE_CHILDREN = ('linkedService', 'planserviceCostShares')
+
+
+def child_document(relation, parent_id, document):
+    return {'relation': relation, 'parent': parent_id, 'document': document}
+
+
+def plan_delta(previous, current):
+    """
+    Returns the changed top-level plan fields, the child documents to upsert
+    and the ids of child documents to delete (leaves before their parents),
+    or None when nothing changed.
+    """
+    object_id = current['objectId']
+    plan_fields = {key: value for key, value in current.items() if previous.get(key) != value}
+    if not plan_fields:
+        return None
+
+    upserts = []
+    deletes = []
+
+    old_cost_shares = previous.get('planCostShares') or {}
+    new_cost_shares = current.get('planCostShares') or {}
+    if old_cost_shares != new_cost_shares:
+        if new_cost_shares:
+            upserts.append(child_document('planCostShares', object_id, new_cost_shares))
+        if old_cost_shares.get('objectId') not in (None, new_cost_shares.get('objectId')):
+            deletes.append(old_cost_shares['objectId'])
+
+    old_services = {service['objectId']: service for service in previous.get('linkedPlanServices', [])}
+    new_services = {service['objectId']: service for service in current.get('linkedPlanServices', [])}
+
+    for service_id, service in new_services.items():
+        old_service = old_services.get(service_id)
+        if old_service == service:
+            continue
+        # The linkedPlanServices document embeds its children, so it changes
+        # whenever they do
+        upserts.append(child_document('linkedPlanServices', object_id, service))
+        for relation in SERVICE_CHILDREN:
+            old_child = (old_service or {}).get(relation) or {}
+            new_child = service.get(relation) or {}
+            if old_child != new_child:
+                if new_child:
+                    upserts.append(child_document(relation, service_id, new_child))
+                if old_child.get('objectId') not in (None, new_child.get('objectId')):
+                    deletes.append(old_child['objectId'])
+
+    for service_id, old_service in old_services.items():
+        if service_id not in new_services:
+            deletes.extend(
+                old_service[relation]['objectId']
+                for relation in SERVICE_CHILDREN if (old_service.get(relation) or {}).get('objectId')
+            )
+            deletes.append(service_id)
+
+    return {'plan': plan_fields, 'upserts': upserts, 'deletes': deletes}
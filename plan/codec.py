@@ -0,0 +1,216 @@
+"""
+Value formats for the plans hash.
+
+PLAN_CODEC['FORMAT'] selects how new values are written:
+
+    json     json.dumps text (the original format)
+    orjson   JSON text written by orjson
+    msgpack  MSGPACK_TAG + MessagePack
+    zstd     ZSTD_TAG + a zstd frame of the MessagePack encoding, compressed
+             with the current trained dictionary if there is one
+
+JSON values are written untagged, so anything not starting with a tag byte is
+JSON (plans are objects and always start with '{'). Every format can be read
+whatever FORMAT is set to, which keeps mixed data readable during a
+migration (manage.py migrate_plan_codec). A plan a binary format cannot
+represent, such as an integer beyond 64 bits, is written as JSON instead.
+
+orjson, msgpack and zstandard are optional; reading or writing a value that
+needs a missing one raises ImproperlyConfigured naming the package.
+"""
+import json
+import re
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django_redis import get_redis_connection
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MSGPACK_TAG = b'\x01'
+ZSTD_TAG = b'\x02'
+
+# Trained zstd dictionaries by id, and the id new values are compressed with
+DICTIONARIES_KEY = 'plan_codec:dictionaries'
+CURRENT_DICTIONARY_KEY = 'plan_codec:dictionary'
+
+# Seconds a process keeps using the current dictionary id before checking
+# whether a newer one was trained
+DICTIONARY_REFRESH = 60
+
+DEFAULTS = {
+    'FORMAT': 'json',
+    'ZSTD_LEVEL': 3,
+}
+
+FORMATS = ('json', 'orjson', 'msgpack', 'zstd')
+
+
+def get_config():
+    config = dict(DEFAULTS)
+    config.update(getattr(settings, 'PLAN_CODEC', {}))
+    if config['FORMAT'] not in FORMATS:
+        raise ImproperlyConfigured(f"PLAN_CODEC['FORMAT'] must be one of {', '.join(FORMATS)}")
+    return config
+
+
+def require(module, package):
+    if module is None:
+        raise ImproperlyConfigured(f"Plan values in this format need the '{package}' package (pip install {package})")
+    return module
+
+
+def json_dumps(data):
+    return json.dumps(data).encode('utf-8')
+
+
+# orjson reads integers beyond 64 bits as floats, so values with a run of
+# that many digits anywhere are left to json
+LONG_NUMBER = re.compile(rb'\d{19}')
+
+
+def json_loads(value):
+    if orjson is None or LONG_NUMBER.search(value):
+        return json.loads(value)
+    try:
+        return orjson.loads(value)
+    except orjson.JSONDecodeError:
+        # e.g. NaN, which json accepts
+        return json.loads(value)
+
+
+class Dictionaries:
+    """
+    Per-process cache of trained zstd dictionaries (immutable once stored)
+    and per-thread compressors, since zstandard's are not thread-safe.
+    """
+
+    def __init__(self):
+        self.dictionaries = {}
+        self.local = threading.local()
+        self.current = None
+        self.checked = 0
+
+    def add(self, dict_id, data):
+        if data is None:
+            raise ValueError(f"Unknown plan codec dictionary {dict_id}")
+        self.dictionaries[dict_id] = require(zstandard, 'zstandard').ZstdCompressionDict(data)
+
+    def get(self, dict_id):
+        if dict_id not in self.dictionaries:
+            self.add(dict_id, get_redis_connection("default").hget(DICTIONARIES_KEY, dict_id))
+        return self.dictionaries[dict_id]
+
+    def set_current(self, current):
+        self.current = int(current) if current else 0
+        self.checked = time.monotonic()
+
+    def current_id(self):
+        if time.monotonic() - self.checked > DICTIONARY_REFRESH:
+            self.set_current(get_redis_connection("default").get(CURRENT_DICTIONARY_KEY))
+        return self.current
+
+    async def aload(self, redis, values=(), encoding=False):
+        """
+        Loads through redis, a redis.asyncio client, the dictionaries that
+        decoding values needs (and with encoding, the current one when
+        FORMAT is zstd), so that current_id() and get() find them cached
+        instead of blocking the event loop on django_redis.
+        """
+        needed = {dictionary_id(value) for value in values if value[:1] == ZSTD_TAG}
+        if encoding and get_config()['FORMAT'] == 'zstd':
+            if time.monotonic() - self.checked > DICTIONARY_REFRESH:
+                self.set_current(await redis.get(CURRENT_DICTIONARY_KEY))
+            needed.add(self.current)
+        missing = sorted(needed - {0} - self.dictionaries.keys())
+        if missing:
+            for dict_id, data in zip(missing, await redis.hmget(DICTIONARIES_KEY, missing)):
+                self.add(dict_id, data)
+
+    def compressor(self, level):
+        dict_id = self.current_id()
+        compressors = self.local.__dict__.setdefault('compressors', {})
+        key = (dict_id, level)
+        if key not in compressors:
+            dict_data = self.get(dict_id) if dict_id else None
+            compressors[key] = require(zstandard, 'zstandard').ZstdCompressor(level=level, dict_data=dict_data)
+        return compressors[key]
+
+    def decompressor(self, frame):
+        dict_id = require(zstandard, 'zstandard').get_frame_parameters(frame).dict_id
+        decompressors = self.local.__dict__.setdefault('decompressors', {})
+        if dict_id not in decompressors:
+            dict_data = self.get(dict_id) if dict_id else None
+            decompressors[dict_id] = zstandard.ZstdDecompressor(dict_data=dict_data)
+        return decompressors[dict_id]
+
+
+dictionaries = Dictionaries()
+
+
+def encode(data, json_value=None, fmt=None):
+    """
+    Encodes a plan in the configured (or given) format. json_value, if the
+    caller already has json.dumps of the plan, is reused for 'json'.
+    """
+    config = get_config()
+    fmt = fmt or config['FORMAT']
+    if fmt == 'json':
+        return json_value if json_value is not None else json_dumps(data)
+    try:
+        if fmt == 'orjson':
+            return require(orjson, 'orjson').dumps(data)
+        packed = require(msgpack, 'msgpack').packb(data)
+        if fmt == 'msgpack':
+            return MSGPACK_TAG + packed
+        return ZSTD_TAG + dictionaries.compressor(config['ZSTD_LEVEL']).compress(packed)
+    except (TypeError, OverflowError):
+        return json_value if json_value is not None else json_dumps(data)
+
+
+def value_format(value):
+    tag = value[:1]
+    if tag == MSGPACK_TAG:
+        return 'msgpack'
+    if tag == ZSTD_TAG:
+        return 'zstd'
+    return 'json'
+
+
+def dictionary_id(value):
+    # Dictionary a ZSTD_TAG value was compressed with (0 for none)
+    return require(zstandard, 'zstandard').get_frame_parameters(value[1:]).dict_id
+
+
+def decode(value):
+    tag = value[:1]
+    if tag == MSGPACK_TAG:
+        return require(msgpack, 'msgpack').unpackb(value[1:])
+    if tag == ZSTD_TAG:
+        frame = value[1:]
+        return require(msgpack, 'msgpack').unpackb(dictionaries.decompressor(frame).decompress(frame))
+    return json_loads(value)
+
+
+def to_json(value):
+    """
+    Returns a stored value as JSON text, as is when it already is JSON.
+    """
+    if value[:1] in (MSGPACK_TAG, ZSTD_TAG):
+        return json_dumps(decode(value))
+    return value
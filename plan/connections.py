@@ -0,0 +1,87 @@
+"""
+Registry of the clients for the services the plan API depends on.
+
+Importing a plan module connects to nothing and imports no client library
+that is not needed yet: get(name) creates a service's client on first use,
+and forked children start without any. check(name) reports whether a service
+is reachable, for the /readyz endpoint (see plan/health.py).
+
+    redis          the django_redis "default" connection
+    elasticsearch  client for ELASTICSEARCH_DSL['default']
+    rabbitmq       this process's plan/producer.py Publisher
+"""
+import os
+import threading
+import time
+
+from django.conf import settings
+from django_redis import get_redis_connection
+
+
+class Service:
+    def __init__(self, connect, ping, cached=True):
+        self.connect = connect
+        self.ping = ping
+        # Services whose connect() already keeps one client per process are
+        # not cached again here
+        self.cached = cached
+
+
+def connect_elasticsearch():
+    from elasticsearch import Elasticsearch
+    options = settings.ELASTICSEARCH_DSL['default']
+    hosts = options['hosts']
+    if isinstance(hosts, str):
+        hosts = [hosts]
+    hosts = [host if '://' in host else f'http://{host}' for host in hosts]
+    return Elasticsearch(hosts=hosts, basic_auth=options.get('http_auth'))
+
+
+def connect_rabbitmq():
+    from plan.producer import get_publisher
+    return get_publisher()
+
+
+SERVICES = {
+    'redis': Service(lambda: get_redis_connection("default"), lambda client, timeout: client.ping(), cached=False),
+    'elasticsearch': Service(connect_elasticsearch, lambda client, timeout: client.options(request_timeout=timeout).info()),
+    'rabbitmq': Service(connect_rabbitmq, lambda client, timeout: client.check(), cached=False),
+}
+
+_clients = {}
+_lock = threading.Lock()
+
+
+def _reset_after_fork():
+    # Clients hold sockets of the parent's connections
+    global _clients, _lock
+    _clients = {}
+    _lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def get(name):
+    client = _clients.get(name)
+    if client is None:
+        service = SERVICES[name]
+        if not service.cached:
+            return service.connect()
+        with _lock:
+            client = _clients.get(name)
+            if client is None:
+                client = _clients[name] = service.connect()
+    return client
+
+
+def check(name, timeout=2.0):
+    """
+    Pings a service and returns its status and latency, or the error.
+    """
+    start = time.perf_counter()
+    try:
+        SERVICES[name].ping(get(name), timeout)
+    except Exception as exc:
+        return {"status": "error", "error": f"{type(exc).__name__}: {exc}"}
+    return {"status": "ok", "latency_ms": round((time.perf_counter() - start) * 1000, 2)}
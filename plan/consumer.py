@@ -1,16 +1,92 @@
-import pika
+"""
+Indexes queued plan messages into Elasticsearch as parent/child join
+documents.
+
+run() consumes with manual acks: a message is acked only after every bulk
+action it produced was written. Up to prefetch_count messages are in flight,
+spread over a pool of worker threads by plan id, so messages for one plan
+are still indexed in order.
+
+A message that fails (Elasticsearch refused one of its documents, or stayed
+unavailable through the in-place retries) is acked and published to a retry
+queue, <queue>.retry.<ms>, whose TTL dead-letters it back to <queue> after
+RETRY_BASE_DELAY * 2**n seconds. After MAX_RETRIES retries, or straight
+away if it cannot be parsed, it goes to <queue>.dead instead, with the
+error in its headers, for manage.py dead_letters to inspect and replay.
+Either way the queue keeps moving.
+
+run_processes() (manage.py run_consumer, or python -m plan.consumer) splits
+the shard queues of plan/sharding.py over several such consumers; as every
+plan has one shard and every shard one consumer, that order holds across
+processes too. Importing this module connects to nothing, and the index is
+created by manage.py create_plan_index, not by the consumer.
+"""
+import functools
 import json
-from elasticsearch import Elasticsearch
-
-# Initialize the Elasticsearch client
-es = Elasticsearch(
-    hosts=[{
-        'host': 'localhost',
-        'port': 9200,
-        'scheme': 'http'
-    }],
-    basic_auth=('elastic', 'BuZWUREG')
-)
+import multiprocessing
+import os
+import queue
+import signal
+import sys
+import threading
+import time
+import zlib
+
+import pika
+from elasticsearch import ApiError, TransportError
+
+from plan import connections, search
+from plan.sharding import shard_queues
+from plan.storage import digest_bucket, etag_digest, plan_etag
+
+DEFAULTS = {
+    'HOST': 'localhost',
+    'PORT': 5672,
+    'QUEUE': 'index_queue',
+    'SHARDS': 1,
+    # Unacked messages RabbitMQ delivers to one consumer process
+    'PREFETCH_COUNT': 500,
+    # Indexing threads per process
+    'WORKERS': 4,
+    'PROCESSES': 1,
+    # Retries of a failed message, RETRY_BASE_DELAY seconds apart and
+    # doubling, before it is dead-lettered
+    'MAX_RETRIES': 5,
+    'RETRY_BASE_DELAY': 5.0,
+}
+
+# Message headers set on retried and dead-lettered messages
+ATTEMPTS_HEADER = 'x-attempts'
+ERROR_HEADER = 'x-error'
+QUEUE_HEADER = 'x-original-queue'
+FAILED_AT_HEADER = 'x-failed-at'
+
+# Elasticsearch requests that fail with a connection error, 429 or 5xx are
+# retried in place, RETRY_DELAY seconds apart and doubling, so later
+# messages for the same plan cannot overtake them. Only after MAX_ATTEMPTS
+# are the messages involved sent to a retry queue.
+MAX_ATTEMPTS = 5
+RETRY_DELAY = 1.0
+
+def get_es():
+    # Every consumer process opens its own connections (see plan/connections.py)
+    return connections.get('elasticsearch')
+
+def is_transient(exc):
+    if isinstance(exc, ApiError):
+        return exc.status_code == 429 or exc.status_code >= 500
+    return isinstance(exc, TransportError)
+
+def retrying(request, **kwargs):
+    for attempt in range(MAX_ATTEMPTS):
+        try:
+            return request(**kwargs)
+        except (ApiError, TransportError) as exc:
+            if not is_transient(exc) or attempt == MAX_ATTEMPTS - 1:
+                raise
+            print(f" [!] Elasticsearch request failed, retrying: {exc}")
+            time.sleep(RETRY_DELAY * 2 ** attempt)
+
 
 # Define the index settings and mappings
 index_name = 'plans'
@@ -65,118 +141,674 @@ index_settings = {
             "objectId": {"type": "text"},
             "objectType": {"type": "text"},
             "planType": {"type": "text"},
-            "creationDate": {"type": "date", "format": "yyyy-MM-dd"}
+            "creationDate": {"type": "date", "format": "yyyy-MM-dd"},
+            "planDigest": {
+                "properties": {
+                    "etag": {"type": "keyword"},
+                    "value": {"type": "long"},
+                    "bucket": {"type": "integer"}
+                }
+            }
         }
     }
 }
 
-# Create the index with the defined settings and mappings
-if not es.indices.exists(index=index_name):
-    es.indices.create(index=index_name, body=index_settings)
+# Plan documents carry planDigest: the ETag of the plan version indexed, a
+# 32-bit value taken from it and the plan's bucket (see plan/storage.py).
+# manage.py reconcile_plans compares the values per bucket range with the
+# sums Redis keeps to find where the index drifted from Redis.
+def plan_digest(object_id, etag):
+    return {"etag": etag, "value": etag_digest(etag), "bucket": digest_bucket(object_id)}
 
-def index_document(document, parent_id=None):
-    object_id = document.get('objectId')
-    if parent_id:
-        es.index(index=index_name, id=object_id, body=document, routing=parent_id)
+# index_name is an alias of a versioned index, <index_name>-<UTC time>, so
+# manage.py reindex_plans can build a new one and switch to it atomically
+def versioned_index_name():
+    return f"{index_name}-{time.strftime('%Y%m%d%H%M%S', time.gmtime())}"
+
+def create_index(name, settings=None, aliased=False):
+    # The defined mappings, with settings overridden e.g. for a bulk load
+    body = dict(index_settings, settings=dict(index_settings['settings'], **(settings or {})))
+    if aliased:
+        body['aliases'] = {index_name: {}}
+    get_es().indices.create(index=name, body=body)
+
+def ensure_index():
+    """
+    Creates the index with the defined settings and mappings, behind the
+    index_name alias, and returns its name; None if it already exists.
+    """
+    if get_es().indices.exists(index=index_name):
+        return None
+    name = versioned_index_name()
+    create_index(name, aliased=True)
+    return name
+
+def switch_alias(name):
+    """
+    Points the index_name alias at index name, in one atomic update, and
+    returns the indices it pointed to before.
+    """
+    es = get_es()
+    actions = [{"add": {"index": name, "alias": index_name}}]
+    if es.indices.exists_alias(name=index_name):
+        previous = list(es.indices.get_alias(name=index_name))
+        actions += [{"remove": {"index": old, "alias": index_name}} for old in previous if old != name]
+    elif es.indices.exists(index=index_name):
+        # An index created before index_name became an alias is replaced
+        previous = [index_name]
+        actions.append({"remove_index": {"index": index_name}})
     else:
-        es.index(index=index_name, id=object_id, body=document)
-
-# In plan/producer.py
-def delete_document(object_id):
-    # Delete all child documents of type 'planCostShares'
-    query_planCostShares = {
-        "query": {
-            "parent_id": {
-                "type": "planCostShares",
-                "id": object_id
-            }
-        }
-    }
-    es.delete_by_query(index='plans', body=query_planCostShares)
-
-    # Delete all child documents of type 'linkedPlanServices'
-    query_linkedPlanServices = {
-        "query": {
-            "parent_id": {
-                "type": "linkedPlanServices",
-                "id": object_id
-            }
-        }
-    }
-    es.delete_by_query(index='plans', body=query_linkedPlanServices)
-
-    # Retrieve IDs of 'linkedPlanServices' documents
-    response = es.search(index='plans', body=query_linkedPlanServices, _source=False)
-    linked_service_ids = [hit['_id'] for hit in response['hits']['hits']]
-
-    for service_id in linked_service_ids:
-        # Delete 'linkedService' documents
-        query_linkedService = {
-            "query": {
-                "parent_id": {
-                    "type": "linkedService",
-                    "id": service_id
-                }
-            }
+        previous = []
+    es.indices.update_aliases(actions=actions)
+    return [old for old in previous if old != name]
+
+# Batches are flushed to the _bulk API when any of these limits is reached
+BATCH_MAX_ACTIONS = 1000
+BATCH_MAX_BYTES = 5 * 1024 * 1024
+BATCH_MAX_WAIT = 1.0
+
+def index_action(document, routing=None, index=index_name):
+    # Grandchildren are routed by the plan id rather than their direct
+    # parent's, so that a whole plan tree lives on the plan's shard.
+    header = {"_index": index, "_id": document.get('objectId')}
+    if routing:
+        header["routing"] = routing
+    return json.dumps({"index": header}), json.dumps(document)
+
+def plan_actions(document, index=index_name):
+    # Computed over the plan as stored, before any field is added to it
+    document['planDigest'] = plan_digest(document['objectId'], plan_etag(document))
+    document['my_join_field'] = {"name": "plan"}
+    actions = [index_action(document, index=index)]
+
+    # Index planCostShares
+    plan_cost_shares = document.get('planCostShares')
+    if plan_cost_shares:
+        plan_cost_shares['my_join_field'] = {"name": "planCostShares", "parent": document['objectId']}
+        actions.append(index_action(plan_cost_shares, routing=document['objectId'], index=index))
+
+    # Index linkedPlanServices
+    linked_plan_services = document.get('linkedPlanServices', [])
+    for service in linked_plan_services:
+        service['my_join_field'] = {"name": "linkedPlanServices", "parent": document['objectId']}
+        actions.append(index_action(service, routing=document['objectId'], index=index))
+
+        # Index linkedService
+        linked_service = service.get('linkedService')
+        if linked_service:
+            linked_service['my_join_field'] = {"name": "linkedService", "parent": service['objectId']}
+            actions.append(index_action(linked_service, routing=document['objectId'], index=index))
+
+        # Index planserviceCostShares
+        planservice_cost_shares = service.get('planserviceCostShares')
+        if planservice_cost_shares:
+            planservice_cost_shares['my_join_field'] = {"name": "planserviceCostShares", "parent": service['objectId']}
+            actions.append(index_action(planservice_cost_shares, routing=document['objectId'], index=index))
+
+    return actions
+
+class BulkIndexer:
+    """
+    Collects the join documents of many queued messages and sends them to
+    Elasticsearch as one _bulk request. Each item in the bulk response is
+    mapped back to the message that produced it, so failures are reported
+    (and messages acked or rejected through the acknowledger) per message
+    rather than per batch.
+
+    While a batch fills up, a full create/update of a plan drops the
+    actions of its earlier messages in the batch that only wrote documents
+    the new version rewrites in full (earlier versions, deltas without
+    deletes), so only the latest version is indexed. Those messages are
+    acked with the batch.
+
+    Cached search results are dropped (plan/search.py) once what a flush
+    wrote has become searchable, PLAN_SEARCH['REFRESH_INTERVAL'] later.
+    Until then, refresh() makes it searchable on demand, for a lookup that
+    has to see it.
+    """
+
+    def __init__(self, acknowledger=None, max_actions=BATCH_MAX_ACTIONS, max_bytes=BATCH_MAX_BYTES, max_wait=BATCH_MAX_WAIT):
+        self.acknowledger = acknowledger
+        self.max_actions = max_actions
+        self.max_bytes = max_bytes
+        self.max_wait = max_wait
+        self.actions = []
+        self.messages = {}
+        self.plans = set()
+        # message_id: (plan id, ids of the documents it writes) for messages
+        # a later full version of the plan can replace
+        self.writes = {}
+        self.coalesced = set()
+        self.size = 0
+        self.started = None
+        # Monotonic times after which written documents are searchable: the
+        # earliest not yet passed on to the search cache, and the latest
+        self.searchable_at = None
+        self.last_searchable_at = None
+        # Monotonic time before which the index may still miss documents
+        # written through this indexer. A consumer that just started cannot
+        # tell what its predecessor wrote, so it starts out unrefreshed.
+        self.unrefreshed_until = time.monotonic() + search.get_config()['REFRESH_INTERVAL']
+
+    def __len__(self):
+        return len(self.actions)
+
+    def add(self, message_id, plan_ids, description, actions, writes=None):
+        if not self.messages:
+            self.started = time.monotonic()
+        self.messages[message_id] = description
+        self.plans.update(plan_ids)
+        if writes is not None:
+            self.writes[message_id] = (plan_ids[0], writes)
+        for header, body in actions:
+            self.actions.append((message_id, header, body))
+            self.size += len(header) + 1 + (len(body) + 1 if body is not None else 0)
+        if len(self.actions) >= self.max_actions or self.size >= self.max_bytes:
+            self.flush()
+
+    def coalesce(self, plan_id, written):
+        # Drops the actions of pending messages for plan_id whose documents
+        # are all among the ids written (in full) by a newer message
+        replaced = {
+            message_id for message_id, (pending_plan, ids) in self.writes.items()
+            if pending_plan == plan_id and ids <= written
         }
-        es.delete_by_query(index='plans', body=query_linkedService)
-
-        # Delete 'planserviceCostShares' documents
-        query_planserviceCostShares = {
-            "query": {
-                "parent_id": {
-                    "type": "planserviceCostShares",
-                    "id": service_id
+        if not replaced:
+            return
+        for message_id in replaced:
+            del self.writes[message_id]
+        self.coalesced |= replaced
+        self.actions = [action for action in self.actions if action[0] not in replaced]
+        self.size = sum(len(header) + 1 + (len(body) + 1 if body is not None else 0) for _, header, body in self.actions)
+
+    def seconds_until_due(self):
+        if not self.messages:
+            return self.max_wait
+        return max(0, self.started + self.max_wait - time.monotonic())
+
+    def is_due(self):
+        return bool(self.messages) and self.seconds_until_due() == 0
+
+    def seconds_until_searchable(self):
+        if self.searchable_at is None:
+            return self.max_wait
+        return max(0, self.searchable_at - time.monotonic())
+
+    def written(self):
+        config = search.get_config()
+        if not config['CACHE_TTL']:
+            return
+        self.last_searchable_at = time.monotonic() + config['REFRESH_INTERVAL']
+        if self.searchable_at is None:
+            self.searchable_at = self.last_searchable_at
+
+    def drop_search_cache(self):
+        now = time.monotonic()
+        if self.searchable_at is None or self.searchable_at > now:
+            return
+        try:
+            search.invalidate()
+        except Exception as exc:
+            print(f" [!] Could not drop cached search results, retrying: {exc!r}")
+            self.searchable_at = now + search.get_config()['REFRESH_INTERVAL']
+            return
+        # Documents written since are not searchable yet
+        self.searchable_at = self.last_searchable_at if self.last_searchable_at > now else None
+
+    def refresh(self):
+        if time.monotonic() < self.unrefreshed_until:
+            retrying(get_es().indices.refresh, index=index_name)
+            self.unrefreshed_until = 0
+
+    def settle(self, message_id, error=None):
+        if self.acknowledger is None:
+            return
+        if error is None:
+            self.acknowledger.ack(message_id)
+        else:
+            self.acknowledger.fail(message_id, error)
+
+    def flush(self):
+        if not self.messages:
+            return {}
+        actions, messages, coalesced = self.actions, self.messages, self.coalesced
+        self.actions, self.messages, self.size, self.started = [], {}, 0, None
+        self.plans, self.writes, self.coalesced = set(), {}, set()
+
+        try:
+            failures = self.send(actions)
+        except Exception as exc:
+            # Anything else going wrong retries the batch as well, rather
+            # than leaving its messages unacked
+            print(f" [!] Bulk request failed, retrying {len(messages)} messages later: {exc!r}")
+            for message_id in messages:
+                self.settle(message_id, f"Bulk request failed: {exc!r}")
+            return {message_id: [] for message_id in messages}
+        finally:
+            # Whatever reached the index is searchable after its next refresh
+            self.unrefreshed_until = time.monotonic() + search.get_config()['REFRESH_INTERVAL']
+
+        for message_id, description in messages.items():
+            if message_id in coalesced:
+                print(f" [x] Coalesced {description} into a later version")
+                self.settle(message_id)
+            elif message_id in failures:
+                for document_id, error in failures[message_id]:
+                    print(f" [!] Failed to index document {document_id} for {description}: {error}")
+                self.settle(message_id, '; '.join(
+                    f"{document_id}: {json.dumps(error)}" for document_id, error in failures[message_id]
+                ))
+            else:
+                print(f" [x] Processed {description}")
+                self.settle(message_id)
+        if len(failures) < len(messages):
+            self.written()
+        return failures
+
+    def send(self, actions):
+        # Returns message_id: [(document id, error)] for the refused actions
+        failures = {}
+        attempt = 0
+        while actions:
+            lines = [line for _, header, body in actions for line in (header, body) if line is not None]
+            response = retrying(get_es().bulk, operations=lines)
+
+            # Actions Elasticsearch was too busy for are sent again, in order
+            throttled = []
+            if response['errors']:
+                attempt += 1
+                for action, item in zip(actions, response['items']):
+                    result = next(iter(item.values()))
+                    if result.get('status') == 429 and attempt < MAX_ATTEMPTS:
+                        throttled.append(action)
+                    elif 'error' in result:
+                        failures.setdefault(action[0], []).append((result['_id'], result['error']))
+            if throttled:
+                time.sleep(RETRY_DELAY * 2 ** (attempt - 1))
+            actions = throttled
+        return failures
+
+# Upper bound on the join documents fetched for a single plan tree
+MAX_TREE_SIZE = 10000
+
+def delete_action(object_id, routing, index=index_name):
+    return json.dumps({"delete": {"_index": index, "_id": object_id, "routing": routing}}), None
+
+def plan_tree_ids(document):
+    object_id = document.get('objectId')
+    ids = [object_id]
+    plan_cost_shares = document.get('planCostShares')
+    if isinstance(plan_cost_shares, dict):
+        ids.append(plan_cost_shares.get('objectId'))
+    services = document.get('linkedPlanServices')
+    for service in services if isinstance(services, list) else []:
+        if not isinstance(service, dict):
+            continue
+        ids.append(service.get('objectId'))
+        for child in ('linkedService', 'planserviceCostShares'):
+            if isinstance(service.get(child), dict):
+                ids.append(service[child].get('objectId'))
+    return [_id for _id in ids if _id and isinstance(_id, str)]
+
+def plan_tree_query(object_id):
+    # Matches the plan, its children and the children of its
+    # linkedPlanServices in one query.
+    return {
+        "bool": {
+            "should": [
+                {"ids": {"values": [object_id]}},
+                {"parent_id": {"type": "planCostShares", "id": object_id}},
+                {"parent_id": {"type": "linkedPlanServices", "id": object_id}},
+                {
+                    "has_parent": {
+                        "parent_type": "linkedPlanServices",
+                        "query": {"parent_id": {"type": "linkedPlanServices", "id": object_id}}
+                    }
                 }
-            }
+            ]
         }
-        es.delete_by_query(index='plans', body=query_planserviceCostShares)
+    }
+
+def delete_actions(document, index=index_name):
+    object_id = document.get('objectId')
+    ids = plan_tree_ids(document)
 
-    # Delete the parent 'plan' document
-    es.delete(index='plans', id=object_id)
+    # Children removed from the plan by earlier updates are no longer in the
+    # message, so the indexed tree is looked up as well. Every document of a
+    # plan is routed by the plan id, so this stays on one shard.
+    response = retrying(
+        get_es().search,
+        index=index,
+        query=plan_tree_query(object_id),
+        routing=object_id,
+        size=MAX_TREE_SIZE,
+        source=False,
+    )
+    ids.extend(hit['_id'] for hit in response['hits']['hits'])
 
-def callback(ch, method, properties, body):
-    message = json.loads(body)
+    # Delete leaves before their parents
+    return [delete_action(_id, object_id, index=index) for _id in reversed(dict.fromkeys(ids))]
+
+def update_action(document, routing):
+    # Partial update; the document is created if it is not indexed yet
+    header = {"_index": index_name, "_id": document.get('objectId'), "routing": routing}
+    return json.dumps({"update": header}), json.dumps({"doc": document, "doc_as_upsert": True})
+
+def delta_actions(message):
+    # Only the join documents named in the delta are touched. The plan
+    # document itself gets the changed top-level fields, which include the
+    # nested copies of any changed children.
+    object_id = message['document']['objectId']
+    actions = []
+    plan_fields = dict(message['plan'])
+    if message.get('etag'):
+        plan_fields['planDigest'] = plan_digest(object_id, message['etag'])
+    if plan_fields:
+        plan_fields.update(objectId=object_id, my_join_field={"name": "plan"})
+        actions.append(update_action(plan_fields, object_id))
+    for upsert in message['upserts']:
+        document = upsert['document']
+        document['my_join_field'] = {"name": upsert['relation'], "parent": upsert['parent']}
+        actions.append(update_action(document, object_id))
+    actions.extend(delete_action(_id, object_id) for _id in message['deletes'])
+    return actions
+
+def message_documents(message):
+    # Bulk ingestion publishes many plans in one message
+    if 'documents' in message:
+        return message['documents']
+    return [message['document']]
+
+def handle_message(indexer, message_id, message):
     operation = message['operation']
-    document = message['document']
-    object_id = document.get('objectId')
-    
-    if operation == 'delete':
-        delete_document(object_id)
+    documents = message_documents(message)
+    if 'documents' in message:
+        description = f"{operation} operation for {len(documents)} documents"
+    else:
+        description = f"{operation} operation for document with ID {documents[0].get('objectId')}"
+    plan_ids = [document.get('objectId') for document in documents]
+
+    # All actions are built before any is added, so a failed lookup leaves
+    # nothing of this message in the batch and it can simply be retried
+    writes = None
+    if operation == 'delta':
+        actions = delta_actions(message)
+        if not message['deletes']:
+            writes = {plan_ids[0], *(upsert['document'].get('objectId') for upsert in message['upserts'])}
+    elif operation == 'delete':
+        actions = []
+        for document in documents:
+            # The tree is looked up with a search, which only sees documents
+            # the index has refreshed: those of this plan still waiting in the
+            # batch are written first, and whatever this consumer wrote
+            # lately is refreshed. Every message of a plan is consumed here
+            # (plan/sharding.py), so that covers all of its documents.
+            if document.get('objectId') in indexer.plans:
+                indexer.flush()
+            indexer.refresh()
+            actions.extend(delete_actions(document))
     else:
-        document['my_join_field'] = {"name": "plan"}
-        index_document(document)
-        
-        # Index planCostShares
-        plan_cost_shares = document.get('planCostShares')
-        if plan_cost_shares:
-            plan_cost_shares['my_join_field'] = {"name": "planCostShares", "parent": document['objectId']}
-            index_document(plan_cost_shares, parent_id=document['objectId'])
-        
-        # Index linkedPlanServices
-        linked_plan_services = document.get('linkedPlanServices', [])
-        for service in linked_plan_services:
-            service['my_join_field'] = {"name": "linkedPlanServices", "parent": document['objectId']}
-            index_document(service, parent_id=document['objectId'])
-            
-            # Index linkedService
-            linked_service = service.get('linkedService')
-            if linked_service:
-                linked_service['my_join_field'] = {"name": "linkedService", "parent": service['objectId']}
-                index_document(linked_service, parent_id=service['objectId'])
-            
-            # Index planserviceCostShares
-            planservice_cost_shares = service.get('planserviceCostShares')
-            if planservice_cost_shares:
-                planservice_cost_shares['my_join_field'] = {"name": "planserviceCostShares", "parent": service['objectId']}
-                index_document(planservice_cost_shares, parent_id=service['objectId'])
-
-    print(f" [x] Processed {operation} operation for document with ID {object_id}")
-
-connection = pika.BlockingConnection(pika.ConnectionParameters('localhost'))
-channel = connection.channel()
-channel.queue_declare(queue='index_queue')
-channel.basic_consume(queue='index_queue', on_message_callback=callback, auto_ack=True)
-
-print(' [*] Waiting for messages. To exit press CTRL+C')
-channel.start_consuming()
+        actions = [action for document in documents for action in plan_actions(document)]
+        if len(documents) == 1:
+            writes = set(plan_tree_ids(documents[0]))
+            indexer.coalesce(plan_ids[0], writes)
+    indexer.add(message_id, plan_ids, description, actions, writes)
+
+def retry_queue(queue_name, delay):
+    return f'{queue_name}.retry.{int(delay * 1000)}'
+
+def dead_queue(queue_name):
+    return f'{queue_name}.dead'
+
+def retry_delays(max_retries, base_delay):
+    return [base_delay * 2 ** retry for retry in range(max_retries)]
+
+def declare_queues(channel, queue_name, delays):
+    channel.queue_declare(queue=queue_name)
+    channel.queue_declare(queue=dead_queue(queue_name), durable=True)
+    for delay in delays:
+        # Expired messages are dead-lettered back onto the work queue
+        channel.queue_declare(queue=retry_queue(queue_name, delay), durable=True, arguments={
+            'x-message-ttl': int(delay * 1000),
+            'x-dead-letter-exchange': '',
+            'x-dead-letter-routing-key': queue_name,
+        })
+
+# Settling outcomes of a split delivery, weakest first
+OUTCOMES = ('ack', 'retry', 'dead')
+
+class ChannelAcknowledger:
+    """
+    Settles deliveries from worker threads. BlockingConnection is not
+    thread-safe, so the calls are handed to the connection's thread. Failed
+    messages are published (with confirms) to their retry or dead queue
+    before the delivery is acked.
+
+    A bulk message whose plans belong to different workers is handled as
+    one part per worker, with (delivery_tag, worker) message ids; the
+    delivery is settled once every part is, with the worst outcome of its
+    parts.
+    """
+
+    def __init__(self, connection, channel, delays):
+        self.connection = connection
+        self.channel = channel
+        self.delays = delays
+        self.publish_channel = connection.channel()
+        self.publish_channel.confirm_delivery()
+        # delivery_tag: (queue, body, headers), only used on the connection thread
+        self.deliveries = {}
+        self.parts = {}
+        self.lock = threading.Lock()
+
+    def track(self, delivery_tag, queue_name, body, headers):
+        self.deliveries[delivery_tag] = (queue_name, body, headers or {})
+
+    def expect_parts(self, delivery_tag, count):
+        with self.lock:
+            self.parts[delivery_tag] = [count, 'ack', None]
+
+    def ack(self, message_id):
+        self.settle(message_id, 'ack')
+
+    def fail(self, message_id, error, retry=True):
+        self.settle(message_id, 'retry' if retry else 'dead', error)
+
+    def settle(self, message_id, outcome, error=None):
+        delivery_tag = message_id
+        if isinstance(message_id, tuple):
+            delivery_tag = message_id[0]
+            with self.lock:
+                state = self.parts[delivery_tag]
+                state[0] -= 1
+                if OUTCOMES.index(outcome) > OUTCOMES.index(state[1]):
+                    state[1], state[2] = outcome, error
+                if state[0]:
+                    return
+                _, outcome, error = self.parts.pop(delivery_tag)
+        self.connection.add_callback_threadsafe(functools.partial(self.finish, delivery_tag, outcome, error))
+
+    def finish(self, delivery_tag, outcome, error):
+        queue_name, body, headers = self.deliveries.pop(delivery_tag)
+        if outcome != 'ack':
+            attempts = headers.get(ATTEMPTS_HEADER, 0) + 1
+            if outcome == 'retry' and attempts <= len(self.delays):
+                target = retry_queue(queue_name, self.delays[attempts - 1])
+            else:
+                target = dead_queue(queue_name)
+            print(f" [!] Sending message {delivery_tag} to {target} (attempt {attempts}): {error}")
+            try:
+                self.publish_channel.basic_publish(exchange='', routing_key=target, body=body, properties=pika.BasicProperties(
+                    delivery_mode=pika.DeliveryMode.Persistent,
+                    headers={
+                        **headers,
+                        ATTEMPTS_HEADER: attempts,
+                        ERROR_HEADER: str(error)[:4096],
+                        QUEUE_HEADER: queue_name,
+                        FAILED_AT_HEADER: int(time.time()),
+                    },
+                ))
+            except (pika.exceptions.NackError, pika.exceptions.UnroutableError) as exc:
+                # Not stored anywhere else yet, so the broker keeps it instead
+                print(f" [!] Could not move message {delivery_tag} to {target}, requeueing: {exc!r}")
+                self.channel.basic_reject(delivery_tag=delivery_tag, requeue=True)
+                return
+        self.channel.basic_ack(delivery_tag=delivery_tag)
+
+STOP = object()
+
+class Worker(threading.Thread):
+    """
+    Indexes the messages of the plans hashed to it, in delivery order, with
+    its own BulkIndexer.
+    """
+
+    def __init__(self, acknowledger):
+        super().__init__(daemon=True)
+        self.acknowledger = acknowledger
+        self.indexer = BulkIndexer(acknowledger)
+        self.queue = queue.Queue()
+
+    def run(self):
+        while True:
+            timeout = min(self.indexer.seconds_until_due(), self.indexer.seconds_until_searchable())
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            if item is STOP:
+                self.flush()
+                if self.indexer.searchable_at is not None:
+                    time.sleep(self.indexer.seconds_until_searchable())
+                    self.indexer.drop_search_cache()
+                return
+            if item is not None:
+                delivery_tag, message = item
+                try:
+                    handle_message(self.indexer, delivery_tag, message)
+                except (ApiError, TransportError) as exc:
+                    print(f" [!] Failed to process message {delivery_tag}: {exc}")
+                    self.acknowledger.fail(delivery_tag, str(exc))
+                except Exception as exc:
+                    # Anything else is a message this code cannot handle;
+                    # the thread must survive it, or its plans stall
+                    print(f" [!] Malformed message {delivery_tag}: {exc!r}")
+                    self.acknowledger.fail(delivery_tag, f"Malformed message: {exc!r}", retry=False)
+            if self.indexer.is_due():
+                self.flush()
+            self.indexer.drop_search_cache()
+
+    def flush(self):
+        # BulkIndexer.flush retries the batch on any error it can settle;
+        # this only keeps the thread alive if settling itself fails
+        try:
+            self.indexer.flush()
+        except Exception as exc:
+            print(f" [!] Failed to flush batch: {exc!r}")
+
+def run(host=DEFAULTS['HOST'], port=DEFAULTS['PORT'], queue_names=(DEFAULTS['QUEUE'],),
+        prefetch_count=DEFAULTS['PREFETCH_COUNT'], workers=DEFAULTS['WORKERS'],
+        max_retries=DEFAULTS['MAX_RETRIES'], retry_base_delay=DEFAULTS['RETRY_BASE_DELAY']):
+    """
+    Consumes queue_names until SIGINT or SIGTERM, then stops taking
+    deliveries, lets the workers flush what they hold and sends their acks.
+    """
+    connection = pika.BlockingConnection(pika.ConnectionParameters(host=host, port=port))
+    channel = connection.channel()
+    delays = retry_delays(max_retries, retry_base_delay)
+    for queue_name in queue_names:
+        declare_queues(channel, queue_name, delays)
+    channel.basic_qos(prefetch_count=prefetch_count)
+    acknowledger = ChannelAcknowledger(connection, channel, delays)
+    pool = [Worker(acknowledger) for _ in range(workers)]
+    for worker in pool:
+        worker.start()
+
+    def worker_for(document):
+        return zlib.crc32(str(document.get('objectId')).encode('utf-8')) % len(pool)
+
+    def on_message(ch, method, properties, body):
+        delivery_tag = method.delivery_tag
+        acknowledger.track(delivery_tag, method.routing_key, body, properties.headers)
+        try:
+            message = json.loads(body)
+            documents = message_documents(message)
+            # Messages of one plan always go to the same worker, keeping their order
+            parts = {}
+            for document in documents:
+                parts.setdefault(worker_for(document), []).append(document)
+        except (ValueError, KeyError, TypeError, AttributeError) as exc:
+            print(f" [!] Malformed message {delivery_tag}: {exc}")
+            acknowledger.finish(delivery_tag, 'dead', f"Malformed message: {exc!r}")
+            return
+        if len(parts) <= 1:
+            pool[worker_for(documents[0]) if documents else 0].queue.put((delivery_tag, message))
+            return
+        acknowledger.expect_parts(delivery_tag, len(parts))
+        for worker, part in parts.items():
+            pool[worker].queue.put(((delivery_tag, worker), dict(message, documents=part)))
+
+    stopping = []
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda signum, frame: stopping.append(signum))
+
+    consumer_tags = [
+        channel.basic_consume(queue=queue_name, on_message_callback=on_message, auto_ack=False)
+        for queue_name in queue_names
+    ]
+    print(f' [*] Waiting for messages on {", ".join(queue_names)} with {workers} workers, '
+          f'prefetch {prefetch_count}. To exit press CTRL+C')
+    while not stopping:
+        connection.process_data_events(time_limit=1)
+
+    for consumer_tag in consumer_tags:
+        channel.basic_cancel(consumer_tag)
+    for worker in pool:
+        worker.queue.put(STOP)
+    while any(worker.is_alive() for worker in pool):
+        connection.process_data_events(time_limit=0.1)
+    connection.process_data_events(time_limit=0)
+    connection.close()
+
+def run_processes(processes=DEFAULTS['PROCESSES'], queue_name=DEFAULTS['QUEUE'], shards=DEFAULTS['SHARDS'], **options):
+    """
+    Runs consumers for the shard queues of queue_name, each process with its
+    own connections and its own share of the shards, and forwards
+    SIGINT/SIGTERM to them. A shard is only ever consumed by one process.
+    """
+    # Documents written to a missing index would get dynamic mappings
+    # without the join field, so the index must be created first
+    if not get_es().indices.exists(index=index_name):
+        raise SystemExit(f" [!] Index {index_name} does not exist; create it with manage.py create_plan_index")
+    queue_names = shard_queues(queue_name, shards)
+    if processes > len(queue_names):
+        print(f" [!] {len(queue_names)} queue shard(s) can only keep {len(queue_names)} process(es) busy")
+        processes = len(queue_names)
+    if processes == 1:
+        return run(queue_names=queue_names, **options)
+
+    children = [
+        multiprocessing.Process(target=run, kwargs=dict(options, queue_names=queue_names[index::processes]))
+        for index in range(processes)
+    ]
+    for child in children:
+        child.start()
+
+    def stop(signum, frame):
+        for child in children:
+            if child.is_alive():
+                os.kill(child.pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    for child in children:
+        child.join()
+
+def main():
+    # python -m plan.consumer [run_consumer options]
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+    from django.core.management import execute_from_command_line
+    execute_from_command_line(['manage.py', 'run_consumer', *sys.argv[1:]])
+
+if __name__ == '__main__':
+    main()
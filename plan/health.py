@@ -0,0 +1,64 @@
+"""
+Liveness and readiness endpoints for orchestrators.
+
+/healthz only answers that the process serves requests; it checks no
+dependency, so an outage of one does not get every worker restarted.
+/readyz pings each service of plan/connections.py concurrently, bounded by
+PLAN_HEALTH['TIMEOUT'], and reports them one by one. It returns 503 when a
+service in PLAN_HEALTH['REQUIRED'] is down; by default Redis, plus RabbitMQ
+unless writes go through the outbox. Elasticsearch only backs search, so it
+is reported but does not take the API out of rotation.
+"""
+import concurrent.futures
+
+from django.conf import settings
+from django.http import JsonResponse
+
+from plan import connections, outbox
+
+DEFAULTS = {
+    # None: redis, and rabbitmq unless PLAN_OUTBOX is enabled
+    'REQUIRED': None,
+    'TIMEOUT': 2.0,
+}
+
+
+def get_config():
+    config = dict(DEFAULTS)
+    config.update(getattr(settings, 'PLAN_HEALTH', {}))
+    return config
+
+
+def required_services(config):
+    if config['REQUIRED'] is not None:
+        return set(config['REQUIRED'])
+    return {'redis'} if outbox.enabled() else {'redis', 'rabbitmq'}
+
+
+def liveness(request):
+    return JsonResponse({"status": "ok"})
+
+
+def readiness(request):
+    config = get_config()
+    required = required_services(config)
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(connections.SERVICES))
+    futures = {name: executor.submit(connections.check, name, config['TIMEOUT']) for name in connections.SERVICES}
+    # A check stuck on a dead socket is abandoned, not waited for
+    executor.shutdown(wait=False)
+
+    concurrent.futures.wait(futures.values(), timeout=config['TIMEOUT'])
+
+    services = {}
+    for name, future in futures.items():
+        if future.done():
+            result = future.result()
+        else:
+            result = {"status": "error", "error": f"No answer within {config['TIMEOUT']}s"}
+        services[name] = dict(result, required=name in required)
+
+    ready = all(services[name]['status'] == 'ok' for name in required if name in services)
+    return JsonResponse(
+        {"status": "ready" if ready else "unavailable", "services": services},
+        status=200 if ready else 503,
+    )
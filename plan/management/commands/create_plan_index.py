@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from plan import consumer
+
+
+class Command(BaseCommand):
+    help = "Creates the Elasticsearch plans index and its alias if they do not exist yet."
+
+    def handle(self, *args, **options):
+        name = consumer.ensure_index()
+        if name is None:
+            self.stdout.write(f"Index {consumer.index_name} already exists")
+        else:
+            self.stdout.write(self.style.SUCCESS(f"Created index {name} as {consumer.index_name}"))
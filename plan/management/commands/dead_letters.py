@@ -0,0 +1,94 @@
+import datetime
+import json
+
+import pika
+from django.core.management.base import BaseCommand
+
+from plan import consumer, producer
+from plan.sharding import shard_queues
+
+# Headers the consumer adds while retrying; a replayed message starts afresh
+RETRY_HEADERS = (
+    consumer.ATTEMPTS_HEADER,
+    consumer.ERROR_HEADER,
+    consumer.QUEUE_HEADER,
+    consumer.FAILED_AT_HEADER,
+    'x-death',
+)
+
+
+def describe(body):
+    try:
+        message = json.loads(body)
+        documents = consumer.message_documents(message)
+        plan_id = documents[0].get('objectId') if len(documents) == 1 else None
+        operation = message.get('operation')
+    except (ValueError, KeyError, TypeError, AttributeError, IndexError):
+        return None, 'unparseable'
+    if plan_id is None:
+        return None, f"{operation} of {len(documents)} plans"
+    return plan_id, f"{operation} of {plan_id}"
+
+
+class Command(BaseCommand):
+    help = "Lists, replays or purges messages the consumer moved to the dead-letter queues."
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', nargs='?', choices=['list', 'replay', 'purge'], default='list')
+        parser.add_argument('--plan', help='only messages for this plan objectId')
+        parser.add_argument('--limit', type=int, default=100, help='messages to list, replay or purge per queue')
+
+    def handle(self, *args, **options):
+        config = producer.get_config()
+        connection = pika.BlockingConnection(pika.ConnectionParameters(host=config['HOST'], port=config['PORT']))
+        channel = connection.channel()
+        channel.confirm_delivery()
+        handled = 0
+        try:
+            for queue_name in shard_queues(config['QUEUE'], config['SHARDS']):
+                handled += self.handle_queue(channel, queue_name, options)
+        finally:
+            # Messages fetched but not acked (listed, or for other plans) go
+            # back to their dead-letter queue
+            connection.close()
+
+        verb = {'list': 'Listed', 'replay': 'Replayed', 'purge': 'Purged'}[options['action']]
+        self.stdout.write(self.style.SUCCESS(f"{verb} {handled} dead-lettered message(s)"))
+
+    def handle_queue(self, channel, queue_name, options):
+        dead = consumer.dead_queue(queue_name)
+        channel.queue_declare(queue=dead, durable=True)
+        handled = 0
+        while handled < options['limit']:
+            method, properties, body = channel.basic_get(dead)
+            if method is None:
+                break
+            plan_id, description = describe(body)
+            if options['plan'] and plan_id != options['plan']:
+                continue
+            handled += 1
+
+            headers = properties.headers or {}
+            failed_at = headers.get(consumer.FAILED_AT_HEADER)
+            if failed_at:
+                failed_at = datetime.datetime.fromtimestamp(failed_at, datetime.timezone.utc).isoformat(timespec='seconds')
+            self.stdout.write(
+                f"{dead}: {description}, {headers.get(consumer.ATTEMPTS_HEADER, 0)} attempt(s), "
+                f"failed at {failed_at}: {headers.get(consumer.ERROR_HEADER)}"
+            )
+
+            if options['action'] == 'replay':
+                # Routed for the current SHARDS, which may have changed
+                target = producer.routing_key(plan_id) if plan_id else headers.get(consumer.QUEUE_HEADER, queue_name)
+                channel.basic_publish(
+                    exchange='',
+                    routing_key=target,
+                    body=body,
+                    properties=pika.BasicProperties(
+                        headers={key: value for key, value in headers.items() if key not in RETRY_HEADERS}
+                    ),
+                )
+                channel.basic_ack(delivery_tag=method.delivery_tag)
+            elif options['action'] == 'purge':
+                channel.basic_ack(delivery_tag=method.delivery_tag)
+        return handled
@@ -0,0 +1,70 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django_redis import get_redis_connection
+
+from plan import codec, scripts
+from plan.storage import CACHE_KEY
+
+
+class Command(BaseCommand):
+    help = "Rewrites the values of the plans hash in the PLAN_CODEC format (or --format)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=codec.FORMATS, help="target format (default: PLAN_CODEC['FORMAT'])")
+        parser.add_argument('--batch', type=int, default=500, help='plans per HSCAN batch')
+        parser.add_argument('--cursor', type=int, default=0, help='HSCAN cursor to resume from')
+        parser.add_argument('--sleep', type=float, default=0.0, help='seconds to pause between batches')
+        parser.add_argument('--dry-run', action='store_true', help='only count the values to rewrite')
+
+    def handle(self, *args, **options):
+        if getattr(settings, 'PLAN_STORAGE', 'hash') != 'hash':
+            raise CommandError("Plan codecs only apply to PLAN_STORAGE = 'hash'")
+        target = options['format'] or codec.get_config()['FORMAT']
+        # orjson writes plain JSON, so JSON values are already in that format
+        target_format = 'json' if target == 'orjson' else target
+        current_dictionary = codec.dictionaries.current_id() if target == 'zstd' else None
+
+        redis_conn = get_redis_connection("default")
+        recode = redis_conn.register_script(scripts.RECODE_PLAN)
+        cursor = options['cursor']
+        scanned = rewritten = skipped = saved = 0
+        while True:
+            cursor, plans = redis_conn.hscan(CACHE_KEY, cursor, count=options['batch'])
+            pipe = redis_conn.pipeline(transaction=False)
+            pending = []
+            for pk, value in plans.items():
+                scanned += 1
+                if codec.value_format(value) == target_format and (
+                        target_format != 'zstd' or codec.dictionary_id(value) == current_dictionary):
+                    continue
+                encoded = codec.encode(codec.decode(value), fmt=target)
+                if codec.value_format(encoded) != target_format:
+                    # Not representable in the target format; stays as JSON
+                    continue
+                pending.append(len(value) - len(encoded))
+                recode(keys=[CACHE_KEY], args=[pk, value, encoded], client=pipe)
+
+            if pending and not options['dry_run']:
+                for (code, *_), difference in zip(pipe.execute(), pending):
+                    if code == scripts.OK:
+                        rewritten += 1
+                        saved += difference
+                    else:
+                        # Written by a request since the scan; already current
+                        skipped += 1
+            elif options['dry_run']:
+                rewritten += len(pending)
+                saved += sum(pending)
+
+            self.stdout.write(f"cursor {cursor}: {scanned} scanned, {rewritten} rewritten, {skipped} skipped")
+            if not cursor:
+                break
+            if options['sleep']:
+                time.sleep(options['sleep'])
+
+        verb = "Would rewrite" if options["dry_run"] else "Rewrote"
+        self.stdout.write(self.style.SUCCESS(
+            f"{verb} {rewritten} of {scanned} plans as {target} ({-saved:+d} bytes)"
+        ))
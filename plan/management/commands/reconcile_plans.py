@@ -0,0 +1,53 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django_redis import get_redis_connection
+
+from plan import reconcile
+from plan.storage import get_plan_store
+
+
+class Command(BaseCommand):
+    help = "Finds plans whose Elasticsearch documents differ from Redis and queues them for indexing again."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--buckets', type=int, default=1024, help='objectId buckets compared (a power of two)')
+        parser.add_argument('--dry-run', action='store_true', help='only report the plans that differ')
+
+    def handle(self, *args, **options):
+        try:
+            shift = reconcile.bucket_shift(options['buckets'])
+        except ValueError as exc:
+            raise CommandError(str(exc))
+        redis_conn = get_redis_connection("default")
+        store = get_plan_store()
+
+        start = time.monotonic()
+        if reconcile.build_digests(redis_conn):
+            self.stdout.write(f"Built the stored bucket sums ({time.monotonic() - start:.2f}s)")
+        indexed = reconcile.indexed_summary(shift)
+        stored = reconcile.stored_summary(redis_conn, shift)
+        mismatched = reconcile.mismatched_buckets(stored, indexed)
+        self.stdout.write(
+            f"{sum(count for count, _ in stored.values())} stored and {sum(count for count, _ in indexed.values())} "
+            f"indexed plans, {len(mismatched)} of {options['buckets']} buckets differ "
+            f"({time.monotonic() - start:.2f}s)"
+        )
+        if not mismatched:
+            self.stdout.write(self.style.SUCCESS("Index is in sync"))
+            return
+
+        changed, deleted = reconcile.differences(redis_conn, store, mismatched, shift)
+        self.stdout.write(
+            f"{len(changed)} plans missing or outdated in the index, {len(deleted)} deleted plans still indexed "
+            f"({time.monotonic() - start:.2f}s)"
+        )
+        for pk in changed[:20]:
+            self.stdout.write(f"  outdated: {pk}")
+        for pk in deleted[:20]:
+            self.stdout.write(f"  deleted: {pk}")
+        if options['dry_run']:
+            return
+
+        queued = reconcile.requeue(store, changed, deleted)
+        self.stdout.write(self.style.SUCCESS(f"Queued {queued} plans for indexing"))
@@ -0,0 +1,180 @@
+import collections
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+from django_redis import get_redis_connection
+from elasticsearch import ApiError, TransportError
+
+from plan import codec, consumer, reconcile, search
+from plan.storage import get_plan_store
+
+# Progress of the running reindex: the index it writes to, the scan cursor
+# up to which every plan is written ('done' once the scan is complete) and
+# the number of plans written
+CHECKPOINT_KEY = 'plan_reindex'
+
+DONE = 'done'
+
+# objectId buckets compared when catching the new index up with the writes
+# made during the rebuild
+CATCH_UP_BUCKETS = 1024
+
+
+def bulk(actions):
+    """
+    Writes actions with one _bulk request, sending documents Elasticsearch
+    was too busy for again, and returns the documents that failed.
+    """
+    failures = []
+    for attempt in range(consumer.MAX_ATTEMPTS):
+        lines = [line for header, body in actions for line in (header, body) if line is not None]
+        response = consumer.retrying(consumer.get_es().bulk, operations=lines)
+        if not response['errors']:
+            return failures
+        throttled = []
+        for action, item in zip(actions, response['items']):
+            result = next(iter(item.values()))
+            if result.get('status') == 429 and attempt < consumer.MAX_ATTEMPTS - 1:
+                throttled.append(action)
+            elif 'error' in result:
+                failures.append((result['_id'], result['error']))
+        if not throttled:
+            return failures
+        time.sleep(consumer.RETRY_DELAY * 2 ** attempt)
+        actions = throttled
+    return failures
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuilds the Elasticsearch plans index from Redis into a new versioned index, catches it up with "
+        "the writes made meanwhile, then points the plans alias at it. Resumes an interrupted run."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch', type=int, default=500, help='plans per scan batch and bulk request')
+        parser.add_argument('--workers', type=int, default=4, help='bulk requests in flight')
+        parser.add_argument('--restart', action='store_true', help='discard the checkpoint of an interrupted run')
+        parser.add_argument('--delete-old', action='store_true', help='delete the indices the alias pointed to')
+
+    def handle(self, *args, **options):
+        redis_conn = get_redis_connection("default")
+        es = consumer.get_es()
+        store = get_plan_store()
+        if reconcile.build_digests(redis_conn):
+            self.stdout.write("Built the stored bucket sums")
+        checkpoint = {key.decode('utf-8'): value.decode('utf-8') for key, value in redis_conn.hgetall(CHECKPOINT_KEY).items()}
+        if checkpoint and not options['restart']:
+            index = checkpoint['index']
+            if not es.indices.exists(index=index):
+                raise CommandError(f"Index {index} of the interrupted run is gone; run again with --restart")
+            cursor, indexed = checkpoint['cursor'], int(checkpoint['plans'])
+            self.stdout.write(f"Resuming into {index} at cursor {cursor}, {indexed} plans indexed")
+        else:
+            index = consumer.versioned_index_name()
+            # Refreshing is off during the load and restored before the switch
+            consumer.create_index(index, settings={'refresh_interval': '-1'})
+            cursor, indexed = '0', 0
+            redis_conn.delete(CHECKPOINT_KEY)
+            redis_conn.hset(CHECKPOINT_KEY, mapping={'index': index, 'cursor': cursor, 'plans': indexed})
+            self.stdout.write(f"Indexing into {index}")
+
+        if cursor != DONE:
+            indexed = self.load(redis_conn, index, int(cursor), indexed, options)
+
+        es.indices.put_settings(index=index, settings={'index': {'refresh_interval': None}})
+        # The consumers keep indexing into the old index until the switch:
+        # plans written or deleted after the scan read them are copied into
+        # the new index first
+        changed, deleted = self.catch_up(redis_conn, store, index)
+        self.copy(store, index, changed, deleted, options)
+        self.stdout.write(f"Caught up with {len(changed)} changed and {len(deleted)} deleted plans")
+        es.indices.refresh(index=index)
+        previous = consumer.switch_alias(index)
+        redis_conn.delete(CHECKPOINT_KEY)
+        search.invalidate()
+        # Writes indexed into the old index between the catch-up and the
+        # switch are queued again; from now on the consumers index into the
+        # new one
+        changed, deleted = self.catch_up(redis_conn, store, index)
+        if changed or deleted:
+            queued = reconcile.requeue(store, changed, deleted)
+            self.stdout.write(f"Queued {queued} plans written during the switch for indexing")
+        if options['delete_old']:
+            for old in previous:
+                es.indices.delete(index=old)
+        self.stdout.write(self.style.SUCCESS(
+            f"Indexed {indexed} plans into {index}; {consumer.index_name} now points to it"
+            + (f" (previously {', '.join(previous)})" if previous else "")
+        ))
+
+    def catch_up(self, redis_conn, store, index):
+        """
+        Compares index with Redis like reconcile_plans, and returns the plans
+        it lacks or has an outdated version of and the plans deleted since.
+        """
+        shift = reconcile.bucket_shift(CATCH_UP_BUCKETS)
+        consumer.get_es().indices.refresh(index=index)
+        mismatched = reconcile.mismatched_buckets(
+            reconcile.stored_summary(redis_conn, shift), reconcile.indexed_summary(shift, index),
+        )
+        if not mismatched:
+            return [], []
+        return reconcile.differences(redis_conn, store, mismatched, shift, index)
+
+    def copy(self, store, index, changed, deleted, options):
+        actions = []
+        for pk in changed:
+            plan, _ = store.get(pk)
+            if plan:
+                actions.extend(consumer.plan_actions(codec.decode(plan), index=index))
+            else:
+                deleted.append(pk)
+        for pk in deleted:
+            if store.get_etag(pk) is None:
+                actions.extend(consumer.delete_actions({'objectId': pk}, index=index))
+        for start in range(0, len(actions), options['batch']):
+            try:
+                failures = bulk(actions[start:start + options['batch']])
+            except (ApiError, TransportError) as exc:
+                raise CommandError(f"Bulk request failed, run again to resume: {exc}")
+            if failures:
+                raise CommandError(f"{len(failures)} document(s) failed to index, run again to resume: " + '; '.join(
+                    f"{document_id}: {json.dumps(error)}" for document_id, error in failures[:5]
+                ))
+
+    def load(self, redis_conn, index, cursor, indexed, options):
+        store = get_plan_store()
+        # (future, cursor after the batch, plans in it), in scan order: the
+        # checkpoint only moves past batches whose every earlier batch is
+        # written too
+        in_flight = collections.deque()
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            while True:
+                cursor, plans = store.scan(cursor, options['batch'])
+                actions = [
+                    action for value in plans.values()
+                    for action in consumer.plan_actions(codec.decode(value), index=index)
+                ]
+                in_flight.append((executor.submit(bulk, actions) if actions else None, cursor, len(plans)))
+
+                while in_flight and (
+                        not cursor or len(in_flight) > options['workers']
+                        or in_flight[0][0] is None or in_flight[0][0].done()):
+                    future, batch_cursor, count = in_flight.popleft()
+                    try:
+                        failures = future.result() if future else []
+                    except (ApiError, TransportError) as exc:
+                        raise CommandError(f"Bulk request failed, run again to resume: {exc}")
+                    if failures:
+                        raise CommandError(f"{len(failures)} document(s) failed to index, run again to resume: " + '; '.join(
+                            f"{document_id}: {json.dumps(error)}" for document_id, error in failures[:5]
+                        ))
+                    indexed += count
+                    redis_conn.hset(CHECKPOINT_KEY, mapping={'cursor': batch_cursor or DONE, 'plans': indexed})
+                    self.stdout.write(f"cursor {batch_cursor}: {indexed} plans indexed")
+
+                if not cursor:
+                    return indexed
@@ -0,0 +1,39 @@
+import signal
+import time
+
+from django.core.management.base import BaseCommand
+from django_redis import get_redis_connection
+
+from plan import outbox, producer
+
+# Seconds to wait before retrying after RabbitMQ rejected or lost a batch
+RETRY_DELAY = 1.0
+
+
+class Command(BaseCommand):
+    help = "Publishes the plan outbox stream to RabbitMQ until interrupted."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--name', default='relay', help='consumer name within the stream group')
+        parser.add_argument('--batch-size', type=int, help='entries published per round trip')
+
+    def handle(self, *args, **options):
+        config = outbox.get_config()
+        if options['batch_size']:
+            config['BATCH_SIZE'] = options['batch_size']
+        relay = outbox.Relay(get_redis_connection("default"), producer.get_publisher(), options['name'], config)
+        relay.ensure_group()
+
+        stopping = []
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *_: stopping.append(True))
+
+        relayed = 0
+        while not stopping:
+            try:
+                relayed += relay.relay_batch()
+            except (producer.PublishError, *producer.CONNECTION_ERRORS) as exc:
+                self.stderr.write(f"Publishing failed, retrying: {exc}")
+                time.sleep(RETRY_DELAY)
+        producer.close()
+        self.stdout.write(self.style.SUCCESS(f"Relayed {relayed} outbox entries"))
@@ -0,0 +1,29 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from plan import consumer, producer
+
+
+class Command(BaseCommand):
+    help = "Indexes plans from the RabbitMQ queue into Elasticsearch until interrupted."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--prefetch', type=int, help='unacked messages per process')
+        parser.add_argument('--workers', type=int, help='indexing threads per process')
+        parser.add_argument('--processes', type=int, help='consumer processes, at most one per queue shard')
+
+    def handle(self, *args, **options):
+        config = dict(consumer.DEFAULTS)
+        config.update(getattr(settings, 'PLAN_CONSUMER', {}))
+        rabbitmq = producer.get_config()
+        consumer.run_processes(
+            options['processes'] or config['PROCESSES'],
+            host=rabbitmq['HOST'],
+            port=rabbitmq['PORT'],
+            queue_name=rabbitmq['QUEUE'],
+            shards=rabbitmq['SHARDS'],
+            prefetch_count=options['prefetch'] or config['PREFETCH_COUNT'],
+            workers=options['workers'] or config['WORKERS'],
+            max_retries=config['MAX_RETRIES'],
+            retry_base_delay=config['RETRY_BASE_DELAY'],
+        )
@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand, CommandError
+from django_redis import get_redis_connection
+
+from plan import codec
+from plan.storage import CACHE_KEY
+
+
+class Command(BaseCommand):
+    help = "Trains a zstd dictionary on stored plans for PLAN_CODEC['FORMAT'] = 'zstd'."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--samples', type=int, default=2000, help='plans to train on')
+        parser.add_argument('--size', type=int, default=16 * 1024, help='dictionary size in bytes')
+        parser.add_argument('--no-activate', action='store_true', help='store the dictionary without using it for new values')
+
+    def handle(self, *args, **options):
+        zstandard = codec.require(codec.zstandard, 'zstandard')
+        msgpack = codec.require(codec.msgpack, 'msgpack')
+        redis_conn = get_redis_connection("default")
+
+        samples = []
+        cursor = 0
+        while len(samples) < options['samples']:
+            cursor, plans = redis_conn.hscan(CACHE_KEY, cursor, count=500)
+            samples.extend(msgpack.packb(codec.decode(value)) for value in plans.values())
+            if not cursor:
+                break
+        samples = samples[:options['samples']]
+        if len(samples) < 10:
+            raise CommandError(f"Need at least 10 stored plans to train a dictionary, found {len(samples)}")
+
+        dictionary = zstandard.train_dictionary(options['size'], samples)
+        dict_id = dictionary.dict_id()
+        redis_conn.hset(codec.DICTIONARIES_KEY, dict_id, dictionary.as_bytes())
+        if not options['no_activate']:
+            redis_conn.set(codec.CURRENT_DICTIONARY_KEY, dict_id)
+
+        level = codec.get_config()['ZSTD_LEVEL']
+        compressor = zstandard.ZstdCompressor(level=level, dict_data=dictionary)
+        packed = sum(len(sample) for sample in samples)
+        compressed = sum(len(compressor.compress(sample)) + 1 for sample in samples)
+        self.stdout.write(self.style.SUCCESS(
+            f"Trained dictionary {dict_id} ({len(dictionary.as_bytes())} bytes) on {len(samples)} plans: "
+            f"{packed / len(samples):.0f} bytes msgpack -> {compressed / len(samples):.0f} bytes zstd per plan"
+            + ("" if options['no_activate'] else "; now used for new values")
+        ))
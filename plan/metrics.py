@@ -0,0 +1,225 @@
+"""
+Per-stage latency histograms for the PlanViewSet actions, exposed in the
+Prometheus text format at /metrics.
+
+PlanViewSet.dispatch, and plan/async_views.py for the async endpoints, start
+a timer for each request; code marked with stage() or @timed() adds the time
+it spends to that request's stage:
+
+    auth      check_bearer_token
+    validate  validate_plan
+    etag      serializing the plan and computing its ETag
+    redis     plan store calls and search invalidation
+    publish   send_to_queue and friends
+    other     whatever is left (parsing, patching, building the response)
+
+Stage times are exclusive: a stage nested inside another (e.g. etag inside a
+store write) is not counted again in the outer one, so a request's stages add
+up to its total. Each request observes plan_request_duration_seconds with
+action and status labels, and plan_stage_duration_seconds per stage with
+action, status and stage labels.
+
+With PLAN_METRICS['ENABLED'] off no timer is started, and every stage is a
+single ContextVar lookup. Histograms are per process: scrape each worker, or
+run one worker per pod.
+"""
+import bisect
+import contextlib
+import contextvars
+import functools
+import inspect
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.http import Http404, HttpResponse
+
+DEFAULTS = {
+    'ENABLED': True,
+    # Upper bounds in seconds
+    'BUCKETS': (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0),
+}
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+_current = contextvars.ContextVar('plan_metrics_timer', default=None)
+_null_stage = contextlib.nullcontext()
+
+
+def get_config():
+    config = dict(DEFAULTS)
+    config.update(getattr(settings, 'PLAN_METRICS', {}))
+    return config
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames, buckets):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, labels, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                # One count per bucket, then +Inf, then the sum
+                series = self.series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def render(self):
+        with self.lock:
+            series = {labels: list(values) for labels, values in self.series.items()}
+        lines = [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} histogram',
+        ]
+        bounds = [repr(float(bound)) for bound in self.buckets] + ['+Inf']
+        for labels, values in sorted(series.items()):
+            label_text = ','.join(f'{name}="{value}"' for name, value in zip(self.labelnames, labels))
+            cumulative = 0
+            for bound, count in zip(bounds, values):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{label_text},le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_sum{{{label_text}}} {values[-1]}')
+            lines.append(f'{self.name}_count{{{label_text}}} {cumulative}')
+        return lines
+
+
+class Registry:
+    def __init__(self, buckets):
+        self.requests = Histogram(
+            'plan_request_duration_seconds',
+            'Time spent in a PlanViewSet action.',
+            ('action', 'status'),
+            buckets,
+        )
+        self.stages = Histogram(
+            'plan_stage_duration_seconds',
+            'Time spent in each stage of a PlanViewSet action.',
+            ('action', 'status', 'stage'),
+            buckets,
+        )
+
+    def render(self):
+        return '\n'.join(self.requests.render() + self.stages.render()) + '\n'
+
+
+class RequestTimer:
+    __slots__ = ('start', 'stages', 'stack', 'token')
+
+    def __init__(self):
+        self.stages = {}
+        # Time spent in nested stages, per open stage
+        self.stack = []
+        self.start = time.perf_counter()
+
+
+class Stage:
+    __slots__ = ('timer', 'name', 'start')
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.timer.stack.append(0.0)
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.start
+        timer = self.timer
+        nested = timer.stack.pop()
+        if timer.stack:
+            timer.stack[-1] += elapsed
+        timer.stages[self.name] = timer.stages.get(self.name, 0.0) + elapsed - nested
+
+
+def stage(name):
+    timer = _current.get()
+    if timer is None:
+        return _null_stage
+    return Stage(timer, name)
+
+
+def timed(name):
+    """
+    Decorator counting every call of the function (or, for a coroutine
+    function, the time until it returns) as stage name.
+    """
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                timer = _current.get()
+                if timer is None:
+                    return await func(*args, **kwargs)
+                with Stage(timer, name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            timer = _current.get()
+            if timer is None:
+                return func(*args, **kwargs)
+            with Stage(timer, name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry():
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = Registry(get_config()['BUCKETS'])
+    return _registry
+
+
+def _reset_after_fork():
+    # Workers forked from a preloaded master start with empty histograms
+    global _registry, _registry_lock
+    _registry = None
+    _registry_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def start_request():
+    """
+    Starts timing a request, or returns None if metrics are disabled.
+    """
+    if not getattr(settings, 'PLAN_METRICS', DEFAULTS).get('ENABLED', DEFAULTS['ENABLED']):
+        return None
+    timer = RequestTimer()
+    timer.token = _current.set(timer)
+    return timer
+
+
+def finish_request(timer, action, status_code):
+    total = time.perf_counter() - timer.start
+    _current.reset(timer.token)
+    registry = get_registry()
+    status_label = str(status_code)
+    registry.requests.observe((action, status_label), total)
+    timer.stages['other'] = max(total - sum(timer.stages.values()), 0.0)
+    for name, elapsed in timer.stages.items():
+        registry.stages.observe((action, status_label, name), elapsed)
+
+
+def metrics_view(request):
+    if not get_config()['ENABLED']:
+        raise Http404
+    return HttpResponse(get_registry().render(), content_type=CONTENT_TYPE)
@@ -0,0 +1,129 @@
+"""
+Transactional outbox for index messages, on a Redis stream.
+
+With PLAN_OUTBOX['ENABLED'] the views no longer publish to RabbitMQ after a
+write. The write scripts append the queue message to the plan_outbox stream
+instead, in the same script call as the write, so a change is recorded for
+indexing if and only if it was stored, and a write never waits for the
+broker. manage.py relay_outbox reads the stream through a consumer group,
+publishes each entry to its shard queue and removes it once the broker has
+confirmed it.
+
+Graph storage also appends an entry with a refresh field, and no message,
+for each plan whose shared objects a write changed; the relay reads that
+plan when it relays the entry and publishes an update for it.
+
+Entries are relayed at least once: a relay that stops between publishing and
+acknowledging an entry publishes it again on restart, and the consumer's
+writes are idempotent. Run a single relay (a second one with the same
+--name only takes over its pending entries), since entries for one plan must
+be published in stream order. While no relay runs the stream keeps growing;
+it is never trimmed, as that would drop unpublished changes.
+"""
+import json
+
+from django.conf import settings
+from redis.exceptions import ResponseError
+
+from plan.producer import delta_message, queue_message, routing_key
+from plan.storage import OUTBOX_KEY, get_plan_store, plan_etag
+
+DEFAULTS = {
+    'ENABLED': False,
+    'GROUP': 'relay',
+    # Entries read and published per round trip
+    'BATCH_SIZE': 500,
+    # How long a relay waits for new entries, in milliseconds
+    'BLOCK_MS': 1000,
+}
+
+
+def get_config():
+    config = dict(DEFAULTS)
+    config.update(getattr(settings, 'PLAN_OUTBOX', {}))
+    return config
+
+
+def enabled():
+    return get_config()['ENABLED']
+
+
+def entry(document, operation):
+    """
+    Outbox message for a write, or '' (no entry) if the outbox is disabled.
+    """
+    if not enabled():
+        return ''
+    return queue_message(document, operation)
+
+
+def delta_entry(object_id, delta, data):
+    # data is the patched plan; the entry is written before its ETag is
+    # known, so it is computed here
+    if not enabled():
+        return ''
+    return delta_message(object_id, delta, plan_etag(data))
+
+
+class Relay:
+    def __init__(self, redis_conn, publisher, name, config=None):
+        self.redis = redis_conn
+        self.publisher = publisher
+        self.name = name
+        self.config = config or get_config()
+        # Entries this consumer read before a restart or a failed publish are
+        # relayed before any new ones
+        self.pending = True
+
+    def ensure_group(self):
+        try:
+            self.redis.xgroup_create(OUTBOX_KEY, self.config['GROUP'], id='0', mkstream=True)
+        except ResponseError as exc:
+            if 'BUSYGROUP' not in str(exc):
+                raise
+
+    def read(self, stream_id, block=None):
+        response = self.redis.xreadgroup(
+            self.config['GROUP'], self.name, {OUTBOX_KEY: stream_id},
+            count=self.config['BATCH_SIZE'], block=block,
+        )
+        return response[0][1] if response else []
+
+    def relay_batch(self):
+        """
+        Publishes one batch of entries and returns how many were relayed.
+        """
+        entries = []
+        draining = False
+        if self.pending:
+            entries = self.read('0')
+            draining = self.pending = bool(entries)
+        if not entries:
+            entries = self.read('>', self.config['BLOCK_MS'])
+        if not entries:
+            return 0
+
+        self.pending = True
+        for _, fields in entries:
+            # Entries deleted while pending come back without fields
+            if not fields:
+                continue
+            object_id = fields[b'plan'].decode('utf-8')
+            if b'refresh' in fields:
+                # Deleted since: its delete entry follows
+                plan, _ = get_plan_store().get(object_id)
+                if plan:
+                    self.publisher.publish(queue_message(json.loads(plan), 'update'), routing_key(object_id))
+            else:
+                self.publisher.publish(fields[b'message'].decode('utf-8'), routing_key(object_id))
+        # Raises PublishError unless the broker confirmed every message, in
+        # which case the batch stays pending and is published again
+        self.publisher.flush()
+
+        ids = [entry_id for entry_id, _ in entries]
+        pipe = self.redis.pipeline()
+        pipe.xack(OUTBOX_KEY, self.config['GROUP'], *ids)
+        pipe.xdel(OUTBOX_KEY, *ids)
+        pipe.execute()
+        self.pending = draining
+        return len(entries)
@@ -0,0 +1,9 @@
+from rest_framework.parsers import JSONParser
+
+
+class MergePatchParser(JSONParser):
+    media_type = 'application/merge-patch+json'
+
+
+class JSONPatchParser(JSONParser):
+    media_type = 'application/json-patch+json'
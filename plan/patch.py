@@ -0,0 +1,122 @@
+"""
+JSON Merge Patch (RFC 7396) and JSON Patch (RFC 6902) for plan documents.
+"""
+import copy
+
+
+class PatchError(Exception):
+    pass
+
+
+def merge_patch(target, patch):
+    if not isinstance(patch, dict):
+        return copy.deepcopy(patch)
+    result = dict(target) if isinstance(target, dict) else {}
+    for key, value in patch.items():
+        if value is None:
+            result.pop(key, None)
+        else:
+            result[key] = merge_patch(result.get(key), value)
+    return result
+
+
+def parse_pointer(pointer):
+    if not isinstance(pointer, str) or (pointer and not pointer.startswith('/')):
+        raise PatchError(f"Invalid JSON pointer: {pointer!r}")
+    if not pointer:
+        return []
+    return [token.replace('~1', '/').replace('~0', '~') for token in pointer[1:].split('/')]
+
+
+def array_index(container, token, allow_end=False):
+    if allow_end and token == '-':
+        return len(container)
+    if not token.isdigit() or (token != '0' and token.startswith('0')):
+        raise PatchError(f"Invalid array index: {token!r}")
+    index = int(token)
+    if index > len(container) or (index == len(container) and not allow_end):
+        raise PatchError(f"Array index out of range: {token}")
+    return index
+
+
+def resolve(document, tokens):
+    for token in tokens:
+        if isinstance(document, dict):
+            if token not in document:
+                raise PatchError(f"Path not found: /{'/'.join(tokens)}")
+            document = document[token]
+        elif isinstance(document, list):
+            document = document[array_index(document, token)]
+        else:
+            raise PatchError(f"Path not found: /{'/'.join(tokens)}")
+    return document
+
+
+def add(document, tokens, value):
+    if not tokens:
+        return value
+    parent = resolve(document, tokens[:-1])
+    if isinstance(parent, dict):
+        parent[tokens[-1]] = value
+    elif isinstance(parent, list):
+        parent.insert(array_index(parent, tokens[-1], allow_end=True), value)
+    else:
+        raise PatchError(f"Cannot add to a scalar at /{'/'.join(tokens[:-1])}")
+    return document
+
+
+def remove(document, tokens):
+    if not tokens:
+        raise PatchError("Cannot remove the whole document")
+    parent = resolve(document, tokens[:-1])
+    if isinstance(parent, dict):
+        if tokens[-1] not in parent:
+            raise PatchError(f"Path not found: /{'/'.join(tokens)}")
+        return parent.pop(tokens[-1])
+    if isinstance(parent, list):
+        return parent.pop(array_index(parent, tokens[-1]))
+    raise PatchError(f"Path not found: /{'/'.join(tokens)}")
+
+
+def json_patch(document, operations):
+    if not isinstance(operations, list):
+        raise PatchError("A JSON Patch document must be an array of operations")
+
+    # Operations apply to a copy, so a failing patch leaves nothing changed
+    document = copy.deepcopy(document)
+    for operation in operations:
+        if not isinstance(operation, dict) or 'op' not in operation or 'path' not in operation:
+            raise PatchError("Each operation needs an 'op' and a 'path'")
+        op = operation['op']
+        path = parse_pointer(operation['path'])
+        if op in ('add', 'replace', 'test') and 'value' not in operation:
+            raise PatchError(f"'{op}' operation needs a 'value'")
+        if op in ('move', 'copy'):
+            if 'from' not in operation:
+                raise PatchError(f"'{op}' operation needs a 'from'")
+            source = parse_pointer(operation['from'])
+
+        if op == 'add':
+            document = add(document, path, copy.deepcopy(operation['value']))
+        elif op == 'remove':
+            remove(document, path)
+        elif op == 'replace':
+            resolve(document, path)
+            if path:
+                remove(document, path)
+            document = add(document, path, copy.deepcopy(operation['value']))
+        elif op == 'move':
+            if path[:len(source)] == source and path != source:
+                raise PatchError("Cannot move a value into one of its children")
+            value = resolve(document, source)
+            if source:
+                remove(document, source)
+            document = add(document, path, value)
+        elif op == 'copy':
+            document = add(document, path, copy.deepcopy(resolve(document, source)))
+        elif op == 'test':
+            if resolve(document, path) != operation['value']:
+                raise PatchError(f"Test failed at {operation['path']}")
+        else:
+            raise PatchError(f"Unknown operation: {op!r}")
+    return document
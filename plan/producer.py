@@ -1,13 +1,371 @@
-import pika
+import atexit
 import json
+import logging
+import os
+import queue
+import threading
+import time
 
-def send_to_queue(document, operation):
+import pika
+from django.conf import settings
+
+from plan.metrics import timed
+from plan.sharding import shard_queue, shard_queues
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'HOST': 'localhost',
+    'PORT': 5672,
+    'QUEUE': 'index_queue',
+    # Queues messages are partitioned over by plan (see plan/sharding.py)
+    'SHARDS': 1,
+    'CHANNEL_POOL_SIZE': 4,
+    'CONFIRM_DELIVERY': True,
+    'CONFIRM_BATCH_SIZE': 50,
+    'CONFIRM_TIMEOUT': 5.0,
+    'CHECKOUT_TIMEOUT': 5.0,
+    'HEARTBEAT': 60,
+}
+
+CONNECTION_ERRORS = (
+    pika.exceptions.AMQPConnectionError,
+    pika.exceptions.AMQPChannelError,
+    pika.exceptions.StreamLostError,
+)
+
+
+class PublishError(Exception):
+    pass
+
+
+def get_config():
+    config = dict(DEFAULTS)
+    config.update(getattr(settings, 'RABBITMQ', {}))
+    return config
+
+
+class PooledChannel:
+    """
+    One connection and one channel owned by the pool. BlockingConnection is
+    not thread-safe, so every pooled channel gets its own connection and is
+    only ever used by the thread that checked it out.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.connection = None
+        self.channel = None
+        self.next_tag = 1
+        self.unconfirmed = {}
+        self.nacked = []
+
+    def connect(self):
+        self.connection = pika.BlockingConnection(pika.ConnectionParameters(
+            host=self.config['HOST'],
+            port=self.config['PORT'],
+            heartbeat=self.config['HEARTBEAT'],
+        ))
+        self.channel = self.connection.channel()
+        for name in shard_queues(self.config['QUEUE'], self.config['SHARDS']):
+            self.channel.queue_declare(queue=name)
+        self.next_tag = 1
+        self.nacked = []
+        if self.config['CONFIRM_DELIVERY']:
+            # BlockingChannel.confirm_delivery() waits for every single
+            # publish. Enabling confirms on the underlying channel instead lets
+            # acks accumulate so they can be awaited once per batch. _impl is
+            # not public API, hence the pika pin in the Pipfile and the check
+            # in plan/tests/test_producer.py.
+            selected = []
+            self.channel._impl.confirm_delivery(
+                ack_nack_callback=self.on_confirm,
+                callback=lambda frame: selected.append(frame),
+            )
+            while not selected:
+                self.connection.process_data_events(time_limit=self.config['CONFIRM_TIMEOUT'])
+
+    @property
+    def is_open(self):
+        return self.connection is not None and self.connection.is_open and self.channel.is_open
+
+    def ensure_open(self):
+        if not self.is_open:
+            # Delivery tags restart with the new channel, so the old ones
+            # are dropped once their messages are taken for republishing
+            pending = list(self.unconfirmed.values())
+            self.unconfirmed = {}
+            self.discard()
+            self.connect()
+            # Anything the broker never confirmed on the dead connection is
+            # published again, so delivery stays at-least-once.
+            for routing_key, body, properties in pending:
+                self.basic_publish(routing_key, body, properties)
+
+    def on_confirm(self, frame):
+        method = frame.method
+        if method.multiple:
+            tags = [tag for tag in self.unconfirmed if tag <= method.delivery_tag]
+        else:
+            tags = [method.delivery_tag]
+        for tag in tags:
+            message = self.unconfirmed.pop(tag, None)
+            if isinstance(method, pika.spec.Basic.Nack) and message is not None:
+                self.nacked.append(message)
+
+    def basic_publish(self, routing_key, body, properties=None):
+        self.channel.basic_publish(exchange='', routing_key=routing_key, body=body, properties=properties)
+        if self.config['CONFIRM_DELIVERY']:
+            self.unconfirmed[self.next_tag] = (routing_key, body, properties)
+            self.next_tag += 1
+
+    def publish(self, routing_key, body, properties=None):
+        try:
+            self.ensure_open()
+            # Non-blocking poll: services heartbeats and collects acks that
+            # have already arrived without waiting for anything.
+            self.connection.process_data_events(time_limit=0)
+            self.basic_publish(routing_key, body, properties)
+        except CONNECTION_ERRORS:
+            self.discard()
+            self.ensure_open()
+            self.basic_publish(routing_key, body, properties)
+
+    @property
+    def confirm_due(self):
+        return self.config['CONFIRM_DELIVERY'] and len(self.unconfirmed) >= self.config['CONFIRM_BATCH_SIZE']
+
+    def wait_for_confirms(self):
+        if not self.config['CONFIRM_DELIVERY'] or self.connection is None:
+            return
+        # One deadline for the whole wait, however often the connection is
+        # lost and the unconfirmed messages are published again
+        deadline = time.monotonic() + self.config['CONFIRM_TIMEOUT']
+        while self.unconfirmed:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise PublishError(f"{len(self.unconfirmed)} message(s) not confirmed by the broker")
+            try:
+                self.connection.process_data_events(time_limit=remaining)
+            except CONNECTION_ERRORS:
+                self.discard()
+                self.ensure_open()
+
+        if self.nacked:
+            nacked, self.nacked = self.nacked, []
+            raise PublishError(f"{len(nacked)} message(s) rejected by the broker")
+
+    def discard(self):
+        connection, self.connection, self.channel = self.connection, None, None
+        if connection is not None and connection.is_open:
+            try:
+                connection.close()
+            except CONNECTION_ERRORS:
+                pass
+
+    def close(self):
+        try:
+            if self.is_open:
+                self.wait_for_confirms()
+        finally:
+            self.discard()
+
+
+class Publisher:
+    """
+    Long-lived, per-process publisher for index_queue messages.
+
+    Channels are created lazily and reused across requests, so the request
+    path only pays for a basic_publish. Once a channel has CONFIRM_BATCH_SIZE
+    unconfirmed messages it is handed to a background thread that awaits
+    their confirms before returning it to the pool, so no request waits for
+    them or fails for earlier messages; failures there are logged and kept
+    for flush(), which also awaits every outstanding confirm and raises
+    PublishError for anything not confirmed since the last flush().
+    """
+
+    def __init__(self, config=None):
+        self.config = config or get_config()
+        self.pid = os.getpid()
+        self.pool = queue.LifoQueue()
+        self.channels = []
+        self.lock = threading.Lock()
+        # Not self.lock: flush() holds that while waiting for the channels
+        # being confirmed
+        self.confirm_lock = threading.Lock()
+        self.confirms = queue.Queue()
+        self.confirmer = None
+        # Background confirm failures since the last flush()
+        self.errors = []
+        for _ in range(self.config['CHANNEL_POOL_SIZE']):
+            channel = PooledChannel(self.config)
+            self.channels.append(channel)
+            self.pool.put(channel)
+
+    def checkout(self):
+        try:
+            return self.pool.get(timeout=self.config['CHECKOUT_TIMEOUT'])
+        except queue.Empty:
+            raise PublishError("Timed out waiting for a free publisher channel")
+
+    def publish(self, body, routing_key=None, properties=None):
+        channel = self.checkout()
+        confirm = False
+        try:
+            channel.publish(routing_key or self.config['QUEUE'], body, properties)
+            confirm = channel.confirm_due
+        finally:
+            if confirm:
+                self.confirm_in_background(channel)
+            else:
+                self.pool.put(channel)
+
+    def confirm_in_background(self, channel):
+        if self.confirmer is None:
+            with self.confirm_lock:
+                if self.confirmer is None:
+                    self.confirmer = threading.Thread(target=self.confirm_batches, name='plan-publish-confirms', daemon=True)
+                    self.confirmer.start()
+        self.confirms.put(channel)
+
+    def confirm_batches(self):
+        while True:
+            channel = self.confirms.get()
+            try:
+                channel.wait_for_confirms()
+            except (PublishError, *CONNECTION_ERRORS) as exc:
+                logger.warning("Publishing to RabbitMQ failed: %r", exc)
+                with self.confirm_lock:
+                    self.errors.append(exc)
+            finally:
+                self.pool.put(channel)
+
+    def check(self):
+        """
+        Opens a pooled channel's connection if it is not open and services
+        it; raises if the broker cannot be reached.
+        """
+        channel = self.checkout()
+        try:
+            channel.ensure_open()
+            channel.connection.process_data_events(time_limit=0)
+        finally:
+            self.pool.put(channel)
+
+    def flush(self):
+        with self.lock:
+            channels = [self.checkout() for _ in self.channels]
+        errors = []
+        try:
+            for channel in channels:
+                try:
+                    channel.wait_for_confirms()
+                except PublishError as exc:
+                    errors.append(exc)
+        finally:
+            for channel in channels:
+                self.pool.put(channel)
+        with self.confirm_lock:
+            errors, self.errors = self.errors + errors, []
+        if errors:
+            raise PublishError('; '.join(str(exc) for exc in errors))
+
+    def close(self):
+        with self.lock:
+            channels = [self.checkout() for _ in self.channels]
+        for channel in channels:
+            try:
+                channel.close()
+            except (PublishError, *CONNECTION_ERRORS):
+                pass
+            self.pool.put(channel)
+
+
+_publisher = None
+_publisher_lock = threading.Lock()
+
+
+def get_publisher():
+    global _publisher
+    if _publisher is None or _publisher.pid != os.getpid():
+        with _publisher_lock:
+            if _publisher is None or _publisher.pid != os.getpid():
+                _publisher = Publisher()
+    return _publisher
+
+
+def _reset_after_fork():
+    # Sockets inherited from the parent belong to the parent's connections;
+    # the child must open its own instead of closing or reusing them.
+    global _publisher, _publisher_lock
+    _publisher = None
+    _publisher_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def flush():
+    if _publisher is not None and _publisher.pid == os.getpid():
+        _publisher.flush()
+
+
+def close():
+    global _publisher
+    if _publisher is not None and _publisher.pid == os.getpid():
+        publisher, _publisher = _publisher, None
+        publisher.close()
+
+
+atexit.register(close)
+
+
+def routing_key(object_id):
+    config = get_config()
+    return shard_queue(config['QUEUE'], config['SHARDS'], object_id)
+
+
+def queue_message(document, operation):
     message = {
         'operation': operation,
         'document': document
     }
-    connection = pika.BlockingConnection(pika.ConnectionParameters('localhost'))
-    channel = connection.channel()
-    channel.queue_declare(queue='index_queue')
-    channel.basic_publish(exchange='', routing_key='index_queue', body=json.dumps(message))
-    connection.close()
+    return json.dumps(message)
+
+
+def delta_message(object_id, delta, etag=None):
+    message = {
+        'operation': 'delta',
+        'document': {'objectId': object_id},
+        **delta
+    }
+    if etag:
+        # ETag of the patched plan, for the digest of its indexed document
+        message['etag'] = etag
+    return json.dumps(message)
+
+
+@timed('publish')
+def send_to_queue(document, operation):
+    get_publisher().publish(queue_message(document, operation), routing_key(document.get('objectId')))
+
+
+@timed('publish')
+def send_delta_to_queue(object_id, delta, etag=None):
+    get_publisher().publish(delta_message(object_id, delta, etag), routing_key(object_id))
+
+
+@timed('publish')
+def send_batch_to_queue(documents, operation, batch_size=100):
+    # Batches are split by shard so every plan still goes to its own queue
+    shards = {}
+    for document in documents:
+        shards.setdefault(routing_key(document.get('objectId')), []).append(document)
+    publisher = get_publisher()
+    for queue_name, shard_documents in shards.items():
+        for start in range(0, len(shard_documents), batch_size):
+            message = {
+                'operation': operation,
+                'documents': shard_documents[start:start + batch_size]
+            }
+            publisher.publish(json.dumps(message), queue_name)
@@ -0,0 +1,187 @@
+"""
+Drift detection between the plans in Redis and the plans index.
+
+Every plan document in Elasticsearch carries the planDigest of the version it
+was indexed from (see plan/consumer.py), and Redis keeps the ETag of every
+plan in plan_etags. Both sides are summarized per bucket of objectIds as
+(plan count, sum of digests): Elasticsearch with one histogram aggregation,
+Redis from the counts and sums the write scripts keep per bucket in
+plan_digests (see plan/storage.py), one HGETALL whatever the number of plans.
+Only the buckets whose summaries differ are compared plan by plan, reading
+the ETags of just their plans from the bucket sets, and only the plans that
+differ are queued for indexing again.
+
+The bucket sums are built once, by the first run after they were added; a
+bucket compared plan by plan is counted again from its set, which also
+repairs its sums.
+
+Plans written while a check runs, or still waiting in the queue, may show
+up as drift; queuing them again is harmless, as indexing is idempotent.
+"""
+from elasticsearch import helpers
+
+from plan import consumer, scripts
+from plan.codec import decode
+from plan.producer import flush, send_to_queue
+from plan.storage import (
+    DIGEST_BUCKET_BITS,
+    DIGEST_KEY,
+    ETAG_KEY,
+    STALE_ETAG_KEY,
+    bucket_key,
+    digest_bucket,
+)
+
+SCAN_COUNT = 10000
+
+# Bucket ranges per query when fetching the plans of mismatched buckets
+QUERY_BUCKETS = 500
+
+# Buckets counted per pipeline
+COUNT_BUCKETS = 1000
+
+# Field of plan_digests set once the bucket sums have been built
+BUILT_FIELD = 'built'
+
+
+def bucket_shift(buckets):
+    """
+    Right shift from planDigest.bucket to one of buckets buckets, a power of
+    two up to 2 ** DIGEST_BUCKET_BITS.
+    """
+    if buckets < 1 or buckets & (buckets - 1) or buckets > 1 << DIGEST_BUCKET_BITS:
+        raise ValueError(f"buckets must be a power of two up to {1 << DIGEST_BUCKET_BITS}")
+    return DIGEST_BUCKET_BITS - (buckets.bit_length() - 1)
+
+
+def count_buckets(redis_conn, buckets):
+    """
+    Counts buckets again from their sets and yields the (objectId, ETag) of
+    their plans; the ETag is empty for plans blanked by graph storage.
+    """
+    script = redis_conn.register_script(scripts.COUNT_BUCKET)
+    buckets = list(buckets)
+    for start in range(0, len(buckets), COUNT_BUCKETS):
+        pipe = redis_conn.pipeline(transaction=False)
+        for bucket in buckets[start:start + COUNT_BUCKETS]:
+            script(keys=[ETAG_KEY, DIGEST_KEY, bucket_key(bucket), STALE_ETAG_KEY], args=[bucket], client=pipe)
+        for result in pipe.execute():
+            for i in range(0, len(result), 2):
+                yield result[i].decode('utf-8'), result[i + 1].decode('utf-8')
+
+
+def build_digests(redis_conn):
+    """
+    Builds the bucket sets and sums from plan_etags, unless they have been
+    built before. Returns whether they were built. Writes made meanwhile
+    keep them up to date themselves.
+    """
+    if redis_conn.hexists(DIGEST_KEY, BUILT_FIELD):
+        return False
+    cursor = 0
+    while True:
+        cursor, etags = redis_conn.hscan(ETAG_KEY, cursor, count=SCAN_COUNT)
+        pipe = redis_conn.pipeline(transaction=False)
+        for pk in etags:
+            pipe.sadd(bucket_key(digest_bucket(pk.decode('utf-8'))), pk)
+        pipe.execute()
+        if not cursor:
+            break
+    for _ in count_buckets(redis_conn, range(1 << DIGEST_BUCKET_BITS)):
+        pass
+    redis_conn.hset(DIGEST_KEY, BUILT_FIELD, 1)
+    return True
+
+
+def stored_summary(redis_conn, shift):
+    summary = {}
+    for field, value in redis_conn.hgetall(DIGEST_KEY).items():
+        bucket, _, name = field.decode('utf-8').partition(':')
+        if not name:
+            continue
+        count, total = summary.get(int(bucket) >> shift, (0, 0))
+        if name == 'count':
+            count += int(value)
+        else:
+            total += int(value)
+        summary[int(bucket) >> shift] = (count, total)
+    return {bucket: value for bucket, value in summary.items() if value != (0, 0)}
+
+
+def indexed_summary(shift, index=None):
+    # Sums of 32-bit digests stay exact in the aggregation's doubles up to
+    # 2 ** 21 plans per bucket
+    response = consumer.retrying(
+        consumer.get_es().search,
+        index=index or consumer.index_name,
+        size=0,
+        query={"term": {"my_join_field": "plan"}},
+        aggs={"buckets": {
+            "histogram": {"field": "planDigest.bucket", "interval": 1 << shift, "min_doc_count": 1},
+            "aggs": {"digest": {"sum": {"field": "planDigest.value"}}},
+        }},
+    )
+    return {
+        int(bucket['key']) >> shift: (bucket['doc_count'], int(bucket['digest']['value']))
+        for bucket in response['aggregations']['buckets']['buckets']
+    }
+
+
+def indexed_etags(buckets, shift, index=None):
+    # objectId: indexed ETag of every plan document in buckets
+    etags = {}
+    buckets = sorted(buckets)
+    for start in range(0, len(buckets), QUERY_BUCKETS):
+        ranges = [
+            {"range": {"planDigest.bucket": {"gte": bucket << shift, "lt": (bucket + 1) << shift}}}
+            for bucket in buckets[start:start + QUERY_BUCKETS]
+        ]
+        query = {"bool": {"filter": [{"term": {"my_join_field": "plan"}}], "should": ranges, "minimum_should_match": 1}}
+        for hit in helpers.scan(
+                consumer.get_es(), index=index or consumer.index_name, query={"query": query}, _source=['planDigest.etag']):
+            etags[hit['_id']] = hit['_source']['planDigest']['etag']
+    return etags
+
+
+def mismatched_buckets(stored, indexed):
+    return {bucket for bucket in stored.keys() | indexed.keys() if stored.get(bucket) != indexed.get(bucket)}
+
+
+def differences(redis_conn, store, buckets, shift, index=None):
+    """
+    Returns the plans of buckets whose indexed version is not the stored one
+    (or that are not indexed), and the indexed plans no longer stored.
+    Compares with the plans alias unless given another index.
+    """
+    # The index is read first: a plan indexed by then was stored before, so
+    # it only counts as deleted if the scan below does not find it
+    indexed = indexed_etags(buckets, shift, index)
+    stored = {}
+    fine_buckets = (fine for bucket in buckets for fine in range(bucket << shift, (bucket + 1) << shift))
+    for pk, etag in count_buckets(redis_conn, fine_buckets):
+        # Graph storage blanks the ETag of plans whose shared objects
+        # changed; reading it computes it again
+        etag = etag or store.get_etag(pk)
+        if etag:
+            stored[pk] = etag
+    changed = [pk for pk, etag in stored.items() if indexed.get(pk) != etag]
+    deleted = [pk for pk in indexed if pk not in stored]
+    return changed, deleted
+
+
+def requeue(store, changed, deleted):
+    queued = 0
+    for pk in changed:
+        plan, _ = store.get(pk)
+        if plan:
+            send_to_queue(decode(plan), 'update')
+        else:
+            send_to_queue({'objectId': pk}, 'delete')
+        queued += 1
+    for pk in deleted:
+        # Recreated since the scan: its own create message indexes it
+        if store.get_etag(pk) is None:
+            send_to_queue({'objectId': pk}, 'delete')
+            queued += 1
+    flush()
+    return queued
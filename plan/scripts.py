@@ -0,0 +1,329 @@
+# Lua scripts for conditional plan writes. Each one checks and writes the
+# plans hash (KEYS[1]) and the plan_etags hash (KEYS[2]) atomically in a
+# single round trip, and returns a table whose first element is one of the
+# status codes below.
+#
+# With the outbox enabled (plan/outbox.py) the outbox ARGV of a write is the
+# queue message for it, which the script appends to the outbox stream
+# (KEYS[3]) together with the write; '' means no message.
+#
+# Writes also keep the per-bucket plan counts and ETag digest sums that
+# manage.py reconcile_plans compares with the index (see plan/reconcile.py):
+# KEYS[4] is the plan_digests hash, KEYS[5] the set of the objectIds in the
+# plan's bucket and the last ARGV the bucket.
+
+OK = 0
+NOT_FOUND = 1
+EXISTS = 2
+PRECONDITION_FAILED = 3
+# The plan predates stored ETags: the caller backfills the ETag and retries
+ETAG_MISSING = 4
+# Graph storage: the plan record is no longer the one whose object keys the
+# caller declared; the caller reads it again and retries
+RECORD_CHANGED = 5
+
+# Scripts that change or delete a plan publish its objectId on this channel
+# (the name is repeated in the Lua source below) so that in-process caches
+# can drop it; see plan/cache.py.
+INVALIDATION_CHANNEL = 'plan_invalidations'
+
+# Prepended to the scripts that change a plan's ETag. count_plan() moves the
+# plan's digest in its bucket from old_etag to new_etag (false when the plan
+# is deleted); a plan missing from the bucket set was never counted, so only
+# its new digest is. Empty ETags are counted but have no digest.
+DIGESTS = """
+local function etag_digest(etag)
+    if not etag or etag == '' then
+        return 0
+    end
+    return tonumber(string.sub(etag, 4, 11), 16)
+end
+
+local function count_plan(digests, members, bucket, pk, old_etag, new_etag)
+    if new_etag then
+        if redis.call('SADD', members, pk) == 1 then
+            redis.call('HINCRBY', digests, bucket .. ':count', 1)
+            old_etag = false
+        end
+    else
+        if redis.call('SREM', members, pk) == 0 then
+            return
+        end
+        redis.call('HINCRBY', digests, bucket .. ':count', -1)
+    end
+    local delta = etag_digest(new_etag) - etag_digest(old_etag)
+    if delta ~= 0 then
+        redis.call('HINCRBY', digests, bucket .. ':sum', string.format('%d', delta))
+    end
+end
+"""
+
+# ARGV: objectId, plan, etag, outbox message, bucket
+CREATE_PLAN = DIGESTS + """
+if redis.call('HEXISTS', KEYS[1], ARGV[1]) == 1 then
+    return {2}
+end
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+redis.call('HSET', KEYS[2], ARGV[1], ARGV[3])
+count_plan(KEYS[4], KEYS[5], ARGV[5], ARGV[1], false, ARGV[3])
+if ARGV[4] ~= '' then
+    redis.call('XADD', KEYS[3], '*', 'plan', ARGV[1], 'message', ARGV[4])
+end
+return {0}
+"""
+
+# ARGV: objectId, expected etag ('' for unconditional), plan, etag, outbox
+# message, bucket
+REPLACE_PLAN = DIGESTS + """
+if redis.call('HEXISTS', KEYS[1], ARGV[1]) == 0 then
+    return {1}
+end
+local current = redis.call('HGET', KEYS[2], ARGV[1])
+if ARGV[2] ~= '' then
+    if not current then
+        return {4}
+    end
+    if current ~= ARGV[2] then
+        return {3}
+    end
+end
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[3])
+redis.call('HSET', KEYS[2], ARGV[1], ARGV[4])
+count_plan(KEYS[4], KEYS[5], ARGV[6], ARGV[1], current, ARGV[4])
+if ARGV[5] ~= '' then
+    redis.call('XADD', KEYS[3], '*', 'plan', ARGV[1], 'message', ARGV[5])
+end
+redis.call('PUBLISH', 'plan_invalidations', ARGV[1])
+return {0}
+"""
+
+# ARGV: objectId, If-Match ('' if absent), If-None-Match ('' if absent),
+# outbox message, bucket. Returns the deleted plan as the second element on
+# success.
+DELETE_PLAN = DIGESTS + """
+local plan = redis.call('HGET', KEYS[1], ARGV[1])
+if not plan then
+    return {1}
+end
+local current = redis.call('HGET', KEYS[2], ARGV[1])
+if ARGV[2] ~= '' or ARGV[3] ~= '' then
+    if not current then
+        return {4}
+    end
+    if (ARGV[2] ~= '' and current ~= ARGV[2]) or (ARGV[3] ~= '' and current == ARGV[3]) then
+        return {3}
+    end
+end
+redis.call('HDEL', KEYS[1], ARGV[1])
+redis.call('HDEL', KEYS[2], ARGV[1])
+count_plan(KEYS[4], KEYS[5], ARGV[5], ARGV[1], current, false)
+if ARGV[4] ~= '' then
+    redis.call('XADD', KEYS[3], '*', 'plan', ARGV[1], 'message', ARGV[4])
+end
+redis.call('PUBLISH', 'plan_invalidations', ARGV[1])
+return {0, plan}
+"""
+
+# ARGV: objectId, current value, re-encoded value. Used by
+# migrate_plan_codec; the value is only swapped if no write happened since it
+# was read. The plan itself is unchanged, so its ETag is too.
+RECODE_PLAN = """
+if redis.call('HGET', KEYS[1], ARGV[1]) ~= ARGV[2] then
+    return {3}
+end
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[3])
+return {0}
+"""
+
+# Normalized storage (PLAN_STORAGE = 'graph'). KEYS[1] is plan_etags, which
+# also serves as the index of plan ids, KEYS[2] the plan's record, KEYS[3]
+# the outbox stream, KEYS[4] and KEYS[5] the digest hash and bucket set and
+# KEYS[6] plan_stale_etags. The record lists every object key the plan
+# references under "keys"; each object key has a "refs:<key>" set of the
+# plans referencing it. The n object keys a script may touch, those of the
+# plan record it was given and of the current record, follow as KEYS[7] to
+# KEYS[6 + n], then their refs sets in the same order. The caller reads the
+# current record to declare its keys and passes it along; if it changed in
+# the meantime the script returns RECORD_CHANGED without writing.
+#
+# An empty ETag marks a plan whose shared objects were changed by another
+# plan; until its ETag is computed again, its previous one is kept in
+# plan_stale_etags, which its bucket's digest sum still counts. The ids of
+# those plans are returned after the status code so that the caller queues
+# them for indexing; with the outbox enabled the script appends an entry
+# with a refresh field for each of them instead.
+
+# ARGV: objectId, 'create' or 'replace', expected etag ('' for
+# unconditional), etag, plan record, outbox message, bucket, current plan
+# record ('' if none), n, then the values of the objects to write, which
+# come first among the object keys.
+WRITE_GRAPH = DIGESTS + """
+local record = redis.call('GET', KEYS[2])
+local current = redis.call('HGET', KEYS[1], ARGV[1])
+if ARGV[2] == 'create' then
+    if record then
+        return {2}
+    end
+else
+    if not record then
+        return {1}
+    end
+    if ARGV[3] ~= '' then
+        if not current or current == '' then
+            return {4}
+        end
+        if current ~= ARGV[3] then
+            return {3}
+        end
+    end
+end
+if (record or '') ~= ARGV[8] then
+    return {5}
+end
+
+local n = tonumber(ARGV[9])
+local refs = {}
+for i = 1, n do
+    refs[KEYS[6 + i]] = KEYS[6 + n + i]
+end
+
+local result = {0}
+local affected = {}
+for i = 1, #ARGV - 9 do
+    local key = KEYS[6 + i]
+    local value = ARGV[9 + i]
+    if redis.call('GET', key) ~= value then
+        redis.call('SET', key, value)
+        for _, other in ipairs(redis.call('SMEMBERS', refs[key])) do
+            if other ~= ARGV[1] and not affected[other] then
+                affected[other] = true
+                table.insert(result, other)
+                local previous = redis.call('HGET', KEYS[1], other)
+                if previous and previous ~= '' then
+                    redis.call('HSET', KEYS[6], other, previous)
+                    redis.call('HSET', KEYS[1], other, '')
+                end
+                redis.call('PUBLISH', 'plan_invalidations', other)
+            end
+        end
+    end
+end
+
+local referenced = {}
+for _, key in ipairs(cjson.decode(ARGV[5])['keys']) do
+    referenced[key] = true
+    redis.call('SADD', refs[key], ARGV[1])
+end
+if record then
+    for _, key in ipairs(cjson.decode(record)['keys']) do
+        if not referenced[key] then
+            redis.call('SREM', refs[key], ARGV[1])
+            if redis.call('SCARD', refs[key]) == 0 then
+                redis.call('DEL', key)
+            end
+        end
+    end
+end
+
+if current == '' then
+    current = redis.call('HGET', KEYS[6], ARGV[1])
+    redis.call('HDEL', KEYS[6], ARGV[1])
+end
+redis.call('SET', KEYS[2], ARGV[5])
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[4])
+count_plan(KEYS[4], KEYS[5], ARGV[7], ARGV[1], current, ARGV[4])
+if ARGV[6] ~= '' then
+    redis.call('XADD', KEYS[3], '*', 'plan', ARGV[1], 'message', ARGV[6])
+    for i = 2, #result do
+        redis.call('XADD', KEYS[3], '*', 'plan', result[i], 'refresh', '1')
+    end
+end
+if record then
+    redis.call('PUBLISH', 'plan_invalidations', ARGV[1])
+end
+return result
+"""
+
+# Same KEYS as WRITE_GRAPH, with the object keys of the plan record. ARGV:
+# objectId, If-Match ('' if absent), If-None-Match ('' if absent), outbox
+# message, bucket, plan record ('' if none). Returns the values of the
+# plan's objects on success.
+DELETE_GRAPH = DIGESTS + """
+local record = redis.call('GET', KEYS[2])
+if not record then
+    return {1}
+end
+local current = redis.call('HGET', KEYS[1], ARGV[1])
+if ARGV[2] ~= '' or ARGV[3] ~= '' then
+    if not current or current == '' then
+        return {4}
+    end
+    if (ARGV[2] ~= '' and current ~= ARGV[2]) or (ARGV[3] ~= '' and current == ARGV[3]) then
+        return {3}
+    end
+end
+if record ~= ARGV[6] then
+    return {5}
+end
+
+local n = (#KEYS - 6) / 2
+local result = {0}
+for i = 1, n do
+    table.insert(result, redis.call('GET', KEYS[6 + i]))
+end
+for i = 1, n do
+    redis.call('SREM', KEYS[6 + n + i], ARGV[1])
+    if redis.call('SCARD', KEYS[6 + n + i]) == 0 then
+        redis.call('DEL', KEYS[6 + i])
+    end
+end
+if current == '' then
+    current = redis.call('HGET', KEYS[6], ARGV[1])
+    redis.call('HDEL', KEYS[6], ARGV[1])
+end
+redis.call('DEL', KEYS[2])
+redis.call('HDEL', KEYS[1], ARGV[1])
+count_plan(KEYS[4], KEYS[5], ARGV[5], ARGV[1], current, false)
+if ARGV[4] ~= '' then
+    redis.call('XADD', KEYS[3], '*', 'plan', ARGV[1], 'message', ARGV[4])
+end
+redis.call('PUBLISH', 'plan_invalidations', ARGV[1])
+return result
+"""
+
+# KEYS: plan_etags, plan_digests, bucket set, plan_stale_etags. ARGV:
+# objectId, etag, bucket. Fills in an ETag cleared by WRITE_GRAPH, unless the
+# plan has been written again in the meantime.
+FILL_GRAPH_ETAG = DIGESTS + """
+if redis.call('HGET', KEYS[1], ARGV[1]) == '' then
+    redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+    local previous = redis.call('HGET', KEYS[4], ARGV[1])
+    redis.call('HDEL', KEYS[4], ARGV[1])
+    count_plan(KEYS[2], KEYS[3], ARGV[3], ARGV[1], previous, ARGV[2])
+end
+return {0}
+"""
+
+# KEYS: plan_etags, plan_digests, bucket set, plan_stale_etags. ARGV:
+# bucket. Counts the bucket again from its set, dropping objectIds that are
+# no longer stored, and returns its objectIds and ETags as a flat list.
+COUNT_BUCKET = DIGESTS + """
+local count, sum, result = 0, 0, {}
+for _, pk in ipairs(redis.call('SMEMBERS', KEYS[3])) do
+    local etag = redis.call('HGET', KEYS[1], pk)
+    if not etag then
+        redis.call('SREM', KEYS[3], pk)
+    else
+        count = count + 1
+        if etag == '' then
+            sum = sum + etag_digest(redis.call('HGET', KEYS[4], pk))
+        else
+            sum = sum + etag_digest(etag)
+        end
+        table.insert(result, pk)
+        table.insert(result, etag)
+    end
+end
+redis.call('HSET', KEYS[2], ARGV[1] .. ':count', count, ARGV[1] .. ':sum', string.format('%d', sum))
+return result
+"""
@@ -0,0 +1,222 @@
+"""
+Plan search over the parent/child index built by plan/consumer.py.
+
+Pages are read from a point-in-time with search_after, so deep pages cost the
+same as the first one. Results are cached in Redis for a few seconds under
+a generation counter that is part of the cache key. The consumer bumps it
+(see plan/consumer.py) once the documents it wrote have become searchable,
+REFRESH_INTERVAL after its bulk request, which drops all cached results at
+once; bumping it on the write itself would let a search made before the
+change reached the index cache the old results again.
+"""
+import base64
+import binascii
+import hashlib
+import json
+
+from django.conf import settings
+from django_redis import get_redis_connection
+
+from plan import connections
+from plan.metrics import timed
+
+DEFAULTS = {
+    'INDEX': 'plans',
+    'PAGE_SIZE': 20,
+    'MAX_PAGE_SIZE': 500,
+    'PIT_KEEP_ALIVE': '2m',
+    'CACHE_TTL': 30,
+    # Seconds before indexed documents are searchable: the index's
+    # refresh_interval
+    'REFRESH_INTERVAL': 1.0,
+}
+
+GENERATION_KEY = 'plan_search:generation'
+CACHE_PREFIX = 'plan_search:'
+
+# Query parameter -> (planCostShares field, range operator)
+RANGE_FILTERS = {
+    'copay_min': ('copay', 'gte'),
+    'copay_max': ('copay', 'lte'),
+    'deductible_min': ('deductible', 'gte'),
+    'deductible_max': ('deductible', 'lte'),
+}
+
+FILTERS = ('planType', '_org', 'service', *RANGE_FILTERS)
+
+
+class SearchError(Exception):
+    status_code = 400
+
+
+class SearchUnavailable(SearchError):
+    status_code = 503
+
+
+def get_config():
+    config = dict(DEFAULTS)
+    config.update(getattr(settings, 'PLAN_SEARCH', {}))
+    return config
+
+
+def get_client():
+    return connections.get('elasticsearch')
+
+
+def parse_filters(params):
+    filters = {}
+    for name in FILTERS:
+        value = params.get(name)
+        if value in (None, ''):
+            continue
+        if name in RANGE_FILTERS:
+            try:
+                value = int(value)
+            except ValueError:
+                raise SearchError(f"{name} must be an integer")
+        filters[name] = value
+    return filters
+
+
+def build_query(filters):
+    # Plans are matched on their own fields; cost shares and services are
+    # matched on the child documents through the join field.
+    clauses = [{"term": {"my_join_field": "plan"}}]
+    for name in ('planType', '_org'):
+        if name in filters:
+            clauses.append({"match": {name: filters[name]}})
+
+    ranges = {}
+    for name, (field, operator) in RANGE_FILTERS.items():
+        if name in filters:
+            ranges.setdefault(field, {})[operator] = filters[name]
+    if ranges:
+        clauses.append({
+            "has_child": {
+                "type": "planCostShares",
+                "query": {"bool": {"filter": [{"range": {field: bounds}} for field, bounds in ranges.items()]}}
+            }
+        })
+
+    if 'service' in filters:
+        clauses.append({
+            "has_child": {
+                "type": "linkedPlanServices",
+                "query": {
+                    "has_child": {
+                        "type": "linkedService",
+                        "query": {"match": {"name": filters['service']}}
+                    }
+                }
+            }
+        })
+    return {"bool": {"filter": clauses}}
+
+
+def encode_cursor(pit_id, search_after, filters):
+    cursor = json.dumps({"pit": pit_id, "after": search_after, "filters": filters})
+    return base64.urlsafe_b64encode(cursor.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    try:
+        decoded = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        pit_id, search_after, filters = decoded['pit'], decoded['after'], decoded['filters']
+    except (ValueError, KeyError, TypeError, binascii.Error):
+        raise SearchError("Invalid search cursor")
+    if not isinstance(pit_id, str) or not isinstance(search_after, list) or not isinstance(filters, dict):
+        raise SearchError("Invalid search cursor")
+    return pit_id, search_after, filters
+
+
+def search_page(filters, size, cursor=None):
+    # Imported on first search rather than with the views
+    from elasticsearch import ApiError, NotFoundError, TransportError
+
+    config = get_config()
+    es = get_client()
+    try:
+        if cursor:
+            pit_id, search_after, filters = decode_cursor(cursor)
+        else:
+            pit_id = es.open_point_in_time(index=config['INDEX'], keep_alive=config['PIT_KEEP_ALIVE'])['id']
+            search_after = None
+
+        # _shard_doc is the cheapest total order within a point-in-time
+        response = es.search(
+            query=build_query(filters),
+            size=size,
+            sort=[{"_shard_doc": "asc"}],
+            pit={"id": pit_id, "keep_alive": config['PIT_KEEP_ALIVE']},
+            search_after=search_after,
+            track_total_hits=False,
+        )
+    except NotFoundError:
+        raise SearchError("Search cursor expired" if cursor else "Search index not found")
+    except ApiError as exc:
+        if exc.status_code == 429 or exc.status_code >= 500:
+            raise SearchUnavailable("Search is unavailable")
+        # A cursor whose point-in-time id or sort values Elasticsearch
+        # cannot use, e.g. one edited by the client
+        raise SearchError("Invalid search cursor" if cursor else "Invalid search request")
+    except TransportError:
+        raise SearchUnavailable("Search is unavailable")
+
+    hits = response['hits']['hits']
+    pit_id = response.get('pit_id', pit_id)
+    plans = []
+    for hit in hits:
+        plan = hit['_source']
+        plan.pop('my_join_field', None)
+        plan.pop('planDigest', None)
+        plans.append(plan)
+
+    next_cursor = None
+    if len(hits) == size:
+        next_cursor = encode_cursor(pit_id, hits[-1]['sort'], filters)
+    else:
+        try:
+            es.close_point_in_time(id=pit_id)
+        except (ApiError, TransportError):
+            # The page is complete; the point-in-time expires by itself
+            pass
+    return {"plans": plans, "next_cursor": next_cursor}
+
+
+def cache_key(generation, filters, size, cursor):
+    digest = hashlib.md5(json.dumps([filters, size, cursor], sort_keys=True).encode('utf-8')).hexdigest()
+    return f'{CACHE_PREFIX}{generation}:{digest}'
+
+
+@timed('search')
+def search_plans(params):
+    """
+    Returns one page of plans matching the query parameters, from the result
+    cache when the same page was served since the index last changed.
+    """
+    config = get_config()
+    try:
+        size = int(params.get('size') or config['PAGE_SIZE'])
+    except ValueError:
+        size = -1
+    if not 0 < size <= config['MAX_PAGE_SIZE']:
+        raise SearchError(f"size must be between 1 and {config['MAX_PAGE_SIZE']}")
+    cursor = params.get('cursor') or None
+    filters = parse_filters(params)
+
+    redis_conn = get_redis_connection("default")
+    generation = int(redis_conn.get(GENERATION_KEY) or 0)
+    key = cache_key(generation, filters, size, cursor)
+    cached = redis_conn.get(key)
+    if cached is not None:
+        return json.loads(cached)
+
+    page = search_page(filters, size, cursor)
+    if config['CACHE_TTL']:
+        redis_conn.set(key, json.dumps(page), ex=config['CACHE_TTL'])
+    return page
+
+
+@timed('redis')
+def invalidate():
+    get_redis_connection("default").incr(GENERATION_KEY)
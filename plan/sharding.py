@@ -0,0 +1,36 @@
+"""
+Partitioning of the index queue by plan.
+
+With RABBITMQ['SHARDS'] > 1 messages go to QUEUE.0 .. QUEUE.<SHARDS-1>, the
+shard picked by a jump consistent hash of the plan's objectId, and every
+shard queue is consumed by exactly one consumer process. All messages for a
+plan therefore go through one queue and one consumer, in publish order.
+
+Jump hashing moves only about 1/SHARDS of the plans when SHARDS grows by one,
+but messages already queued stay on their old shard: let the queues drain
+before changing SHARDS, or a plan's old and new messages may be indexed out
+of order.
+"""
+import zlib
+
+
+def jump_hash(key, buckets):
+    # Lamping and Veach, "A Fast, Minimal Memory, Consistent Hash Algorithm"
+    bucket, candidate = -1, 0
+    while candidate < buckets:
+        bucket = candidate
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        candidate = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+
+def shard_queues(queue, shards):
+    if shards <= 1:
+        return [queue]
+    return [f'{queue}.{shard}' for shard in range(shards)]
+
+
+def shard_queue(queue, shards, object_id):
+    if shards <= 1:
+        return queue
+    return f'{queue}.{jump_hash(zlib.crc32(str(object_id).encode("utf-8")), shards)}'
@@ -0,0 +1,408 @@
+import hashlib
+import json
+import zlib
+
+from django.conf import settings
+from django_redis import get_redis_connection
+
+from plan import codec, scripts
+from plan.metrics import timed
+from plan.producer import send_to_queue
+
+CACHE_KEY = 'plans'
+
+# ETags are computed once per write and kept in a parallel hash keyed by
+# objectId, so conditional requests never need to load the plan itself
+ETAG_KEY = 'plan_etags'
+
+# Record key prefix for plans in normalized storage
+PLAN_RECORD_PREFIX = 'plan:'
+
+# Key prefix of the set of plans referencing an object in normalized storage
+REFS_PREFIX = 'refs:'
+
+# Stream the write scripts append queue messages to (see plan/outbox.py)
+OUTBOX_KEY = 'plan_outbox'
+
+# Plans are grouped into buckets by the top DIGEST_BUCKET_BITS of the CRC-32
+# of their objectId. The write scripts keep, per bucket, the set of its
+# objectIds (BUCKET_PREFIX<bucket>) and its plan count and sum of ETag
+# digests ("<bucket>:count" and "<bucket>:sum" in DIGEST_KEY), which manage.py
+# reconcile_plans compares with the index (see plan/reconcile.py).
+DIGEST_BUCKET_BITS = 16
+DIGEST_KEY = 'plan_digests'
+BUCKET_PREFIX = 'plan_bucket:'
+
+# Previous ETags of the plans whose ETag graph storage blanked, still counted
+# in their bucket's sum until the ETag is computed again
+STALE_ETAG_KEY = 'plan_stale_etags'
+
+
+def etag_digest(etag):
+    # W/"<md5 hex>"
+    return int(etag[3:11], 16)
+
+
+def digest_bucket(pk):
+    return zlib.crc32(pk.encode('utf-8')) >> (32 - DIGEST_BUCKET_BITS)
+
+
+def bucket_key(bucket):
+    return f'{BUCKET_PREFIX}{bucket}'
+
+
+def blob_etag(blob):
+    etag = hashlib.md5(blob).hexdigest()
+    return f'W/"{etag}"'
+
+
+@timed('etag')
+def plan_etag(data):
+    # Always computed over the JSON text, whatever format the plan is stored
+    # in, so ETags do not change when the format does
+    return blob_etag(json.dumps(data).encode('utf-8'))
+
+
+@timed('etag')
+def encode_plan(data):
+    plan = json.dumps(data).encode('utf-8')
+    return codec.encode(data, plan), blob_etag(plan)
+
+
+class HashPlanStore:
+    """
+    Each plan is one value in the plans hash, keyed by objectId, in the
+    format selected by PLAN_CODEC (see plan/codec.py).
+    """
+
+    def __init__(self, redis_conn):
+        self.redis = redis_conn
+        self.create_script = redis_conn.register_script(scripts.CREATE_PLAN)
+        self.replace_script = redis_conn.register_script(scripts.REPLACE_PLAN)
+        self.delete_script = redis_conn.register_script(scripts.DELETE_PLAN)
+
+    def script_keys(self, bucket):
+        return [CACHE_KEY, ETAG_KEY, OUTBOX_KEY, DIGEST_KEY, bucket_key(bucket)]
+
+    def run(self, script, pk, *args):
+        bucket = digest_bucket(pk)
+        result = script(keys=self.script_keys(bucket), args=[pk, *args, bucket])
+        if result[0] == scripts.ETAG_MISSING:
+            self.get_etag(pk)
+            result = script(keys=self.script_keys(bucket), args=[pk, *args, bucket])
+        return result
+
+    def backfill_etag(self, pk, plan):
+        # Plans written before ETags were stored get theirs on first read
+        etag = blob_etag(codec.to_json(plan))
+        self.redis.hsetnx(ETAG_KEY, pk, etag)
+        return etag
+
+    @timed('redis')
+    def get_etag(self, pk):
+        etag = self.redis.hget(ETAG_KEY, pk)
+        if etag:
+            return etag.decode('utf-8')
+        plan = self.redis.hget(CACHE_KEY, pk)
+        if plan:
+            return self.backfill_etag(pk, plan)
+        return None
+
+    @timed('redis')
+    def get(self, pk):
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hget(CACHE_KEY, pk)
+        pipe.hget(ETAG_KEY, pk)
+        plan, etag = pipe.execute()
+        if not plan:
+            return None, None
+        if not etag:
+            return plan, self.backfill_etag(pk, plan)
+        return plan, etag.decode('utf-8')
+
+    @timed('redis')
+    def all(self):
+        return {key.decode('utf-8'): value for key, value in self.redis.hgetall(CACHE_KEY).items()}
+
+    @timed('redis')
+    def scan(self, cursor, count):
+        # Values are returned as stored, so they can be streamed without
+        # being decoded
+        next_cursor, plans = self.redis.hscan(CACHE_KEY, cursor, count=count)
+        return next_cursor, {key.decode('utf-8'): value for key, value in plans.items()}
+
+    @timed('redis')
+    def create(self, data, outbox=''):
+        plan, etag = encode_plan(data)
+        code, *_ = self.run(self.create_script, data['objectId'], plan, etag, outbox)
+        return code, etag
+
+    @timed('redis')
+    def create_many(self, documents, outbox=None):
+        pipe = self.redis.pipeline()
+        etags = []
+        for data, message in zip(documents, outbox or [''] * len(documents)):
+            plan, etag = encode_plan(data)
+            etags.append(etag)
+            bucket = digest_bucket(data['objectId'])
+            self.create_script(
+                keys=self.script_keys(bucket), args=[data['objectId'], plan, etag, message, bucket], client=pipe,
+            )
+        return [(code, etag) for (code, *_), etag in zip(pipe.execute(), etags)]
+
+    @timed('redis')
+    def replace(self, pk, data, expected_etag='', previous=None, outbox=''):
+        plan, etag = encode_plan(data)
+        code, *_ = self.run(self.replace_script, pk, expected_etag or '', plan, etag, outbox)
+        return code, etag
+
+    @timed('redis')
+    def delete(self, pk, if_match='', if_none_match='', outbox=''):
+        code, *deleted = self.run(self.delete_script, pk, if_match or '', if_none_match or '', outbox)
+        if code != scripts.OK:
+            return code, None
+        return code, codec.decode(deleted[0])
+
+
+def split_objects(value, objects, root=False):
+    """
+    Replaces every nested object that has an objectType and objectId with a
+    {"$ref": "objectType:objectId"} and collects it into objects.
+    """
+    if isinstance(value, dict):
+        split = {key: split_objects(child, objects) for key, child in value.items()}
+        if not root and isinstance(value.get('objectType'), str) and isinstance(value.get('objectId'), str):
+            key = f"{value['objectType']}:{value['objectId']}"
+            objects[key] = json.dumps(split)
+            return {'$ref': key}
+        return split
+    if isinstance(value, list):
+        return [split_objects(child, objects) for child in value]
+    return value
+
+
+def join_objects(value, objects):
+    if isinstance(value, dict):
+        if len(value) == 1 and '$ref' in value:
+            return join_objects(objects.get(value['$ref']), objects)
+        return {key: join_objects(child, objects) for key, child in value.items()}
+    if isinstance(value, list):
+        return [join_objects(child, objects) for child in value]
+    return value
+
+
+class GraphPlanStore:
+    """
+    Normalized storage: each plan is split into one key per object
+    (objectType:objectId), so objects shared by many plans are stored once
+    and a write only rewrites the objects that changed. The plan record
+    lists all the keys it references so reads need one MGET.
+
+    Objects are shared by key: writing a plan that contains an existing
+    object updates it for every plan referencing it. The write queues those
+    plans for indexing again, and their ETags are recomputed as they are
+    read for it.
+    """
+
+    def __init__(self, redis_conn):
+        self.redis = redis_conn
+        self.write_script = redis_conn.register_script(scripts.WRITE_GRAPH)
+        self.delete_script = redis_conn.register_script(scripts.DELETE_GRAPH)
+        self.fill_etag_script = redis_conn.register_script(scripts.FILL_GRAPH_ETAG)
+
+    def record_key(self, pk):
+        return f'{PLAN_RECORD_PREFIX}{pk}'
+
+    def script_keys(self, pk, object_keys=()):
+        # The fixed keys of the graph scripts, then the object keys they
+        # may touch and the refs sets of those
+        return [
+            ETAG_KEY, self.record_key(pk), OUTBOX_KEY, DIGEST_KEY, bucket_key(digest_bucket(pk)), STALE_ETAG_KEY,
+            *object_keys, *(f'{REFS_PREFIX}{key}' for key in object_keys),
+        ]
+
+    def record_keys(self, *records):
+        # Object keys referenced by any of records, each once
+        keys = {}
+        for record in records:
+            if record:
+                keys.update(dict.fromkeys(json.loads(record)['keys']))
+        return list(keys)
+
+    def split(self, data):
+        objects = {}
+        document = split_objects(data, objects, root=True)
+        record = json.dumps({'document': document, 'keys': list(objects)})
+        return record, objects
+
+    def load_objects(self, keys):
+        if not keys:
+            return {}
+        return {key: json.loads(value) for key, value in zip(keys, self.redis.mget(keys)) if value is not None}
+
+    def assemble(self, record, objects):
+        return join_objects(json.loads(record)['document'], objects)
+
+    def fill_etag_args(self, pk, plan):
+        etag = blob_etag(plan)
+        bucket = digest_bucket(pk)
+        return [ETAG_KEY, DIGEST_KEY, bucket_key(bucket), STALE_ETAG_KEY], [pk, etag, bucket], etag
+
+    def refresh_etag(self, pk, plan):
+        keys, args, etag = self.fill_etag_args(pk, plan)
+        self.fill_etag_script(keys=keys, args=args)
+        return etag
+
+    @timed('redis')
+    def get_etag(self, pk):
+        etag = self.redis.hget(ETAG_KEY, pk)
+        if etag is None:
+            return None
+        if etag:
+            return etag.decode('utf-8')
+        return self.get(pk)[1]
+
+    @timed('redis')
+    def get(self, pk):
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.get(self.record_key(pk))
+        pipe.hget(ETAG_KEY, pk)
+        record, etag = pipe.execute()
+        if not record:
+            return None, None
+        data = self.assemble(record, self.load_objects(json.loads(record)['keys']))
+        plan = json.dumps(data).encode('utf-8')
+        if not etag:
+            return plan, self.refresh_etag(pk, plan)
+        return plan, etag.decode('utf-8')
+
+    def load_plans(self, ids):
+        records = self.redis.mget([self.record_key(pk) for pk in ids]) if ids else []
+        records = {pk: record for pk, record in zip(ids, records) if record}
+        objects = self.load_objects(self.record_keys(*records.values()))
+        return {
+            pk: json.dumps(self.assemble(record, objects)).encode('utf-8')
+            for pk, record in records.items()
+        }
+
+    @timed('redis')
+    def scan(self, cursor, count):
+        next_cursor, etags = self.redis.hscan(ETAG_KEY, cursor, count=count)
+        return next_cursor, self.load_plans([key.decode('utf-8') for key in etags])
+
+    def queue_affected(self, ids, outbox):
+        """
+        Queues the plans whose shared objects a write changed for indexing
+        again, unless the write script appended them to the outbox, and
+        computes their ETags again.
+        """
+        if outbox or not ids:
+            return
+        plans = self.load_plans([pk.decode('utf-8') for pk in ids])
+        pipe = self.redis.pipeline(transaction=False)
+        for pk, plan in plans.items():
+            keys, args, _ = self.fill_etag_args(pk, plan)
+            self.fill_etag_script(keys=keys, args=args, client=pipe)
+        pipe.execute()
+        for plan in plans.values():
+            send_to_queue(json.loads(plan), 'update')
+
+    @timed('redis')
+    def all(self):
+        plans = {}
+        cursor = 0
+        while True:
+            cursor, page = self.scan(cursor, 500)
+            plans.update(page)
+            if not cursor:
+                return plans
+
+    def write_args(self, mode, pk, data, expected_etag='', previous=None, outbox='', current=None):
+        # current is the plan record read before the write, whose object
+        # keys the script may touch too
+        record, objects = self.split(data)
+        if previous is not None:
+            # Objects identical to the previous version are not sent at all
+            _, old_objects = self.split(previous)
+            objects = {key: value for key, value in objects.items() if old_objects.get(key) != value}
+        etag = plan_etag(data)
+        object_keys = [*objects, *(key for key in self.record_keys(record, current) if key not in objects)]
+        keys = self.script_keys(pk, object_keys)
+        args = [
+            pk, mode, expected_etag or '', etag, record, outbox, digest_bucket(pk), current or '', len(object_keys),
+            *objects.values(),
+        ]
+        return keys, args, etag
+
+    def delete_args(self, pk, if_match='', if_none_match='', outbox='', current=None):
+        keys = self.script_keys(pk, self.record_keys(current))
+        args = [pk, if_match or '', if_none_match or '', outbox, digest_bucket(pk), current or '']
+        return keys, args
+
+    def write(self, mode, pk, data, expected_etag='', previous=None, outbox=''):
+        refreshed = False
+        while True:
+            current = self.redis.get(self.record_key(pk)) if mode == 'replace' else None
+            keys, args, etag = self.write_args(mode, pk, data, expected_etag, previous, outbox, current)
+            code, *affected = self.write_script(keys=keys, args=args)
+            if code == scripts.ETAG_MISSING and not refreshed:
+                self.get(pk)
+                refreshed = True
+            elif code != scripts.RECORD_CHANGED:
+                break
+        self.queue_affected(affected, outbox)
+        return code, etag
+
+    @timed('redis')
+    def create(self, data, outbox=''):
+        return self.write('create', data['objectId'], data, outbox=outbox)
+
+    @timed('redis')
+    def create_many(self, documents, outbox=None):
+        pipe = self.redis.pipeline()
+        etags = []
+        outbox = outbox or [''] * len(documents)
+        for data, message in zip(documents, outbox):
+            keys, args, etag = self.write_args('create', data['objectId'], data, outbox=message)
+            etags.append(etag)
+            self.write_script(keys=keys, args=args, client=pipe)
+        results = pipe.execute()
+        for (_, *affected), message in zip(results, outbox):
+            self.queue_affected(affected, message)
+        return [(code, etag) for (code, *_), etag in zip(results, etags)]
+
+    @timed('redis')
+    def replace(self, pk, data, expected_etag='', previous=None, outbox=''):
+        return self.write('replace', pk, data, expected_etag, previous, outbox)
+
+    @timed('redis')
+    def delete(self, pk, if_match='', if_none_match='', outbox=''):
+        refreshed = False
+        while True:
+            current = self.redis.get(self.record_key(pk))
+            keys, args = self.delete_args(pk, if_match, if_none_match, outbox, current)
+            code, *values = self.delete_script(keys=keys, args=args)
+            if code == scripts.ETAG_MISSING and not refreshed:
+                self.get(pk)
+                refreshed = True
+            elif code != scripts.RECORD_CHANGED:
+                break
+        if code != scripts.OK:
+            return code, None
+        objects = {key: json.loads(value) for key, value in zip(self.record_keys(current), values) if value is not None}
+        return code, self.assemble(current, objects)
+
+
+STORES = {
+    'hash': HashPlanStore,
+    'graph': GraphPlanStore,
+}
+
+_store = None
+
+
+def get_plan_store():
+    global _store
+    if _store is None:
+        _store = STORES[getattr(settings, 'PLAN_STORAGE', 'hash')](get_redis_connection("default"))
+    return _store
@@ -0,0 +1,96 @@
+import json
+import unittest
+from unittest import mock
+
+from django.test import SimpleTestCase, override_settings
+
+from benchmarks.plans import build_plan
+from plan import async_producer, async_views, codec, metrics
+from plan.async_storage import AsyncHashPlanStore
+from plan.storage import CACHE_KEY
+
+try:
+    import fakeredis
+    import lupa  # noqa: F401 (fakeredis runs Lua scripts with it)
+except ImportError:
+    fakeredis = None
+
+
+def train_dictionary():
+    plans = []
+    for i in range(200):
+        plan = build_plan(f'plan-{i}', 2)
+        plan['planCostShares']['copay'] = i
+        plans.append(codec.msgpack.packb(plan))
+    return codec.zstandard.train_dictionary(4096, plans)
+
+
+@unittest.skipUnless(fakeredis, "needs fakeredis with Lua support")
+class AsyncViewTests(SimpleTestCase):
+    def setUp(self):
+        self.plan = build_plan('plan-1')
+        self.registry = metrics.Registry(metrics.DEFAULTS['BUCKETS'])
+        self.publisher = mock.Mock(publish=mock.AsyncMock())
+        for patcher in (
+            mock.patch.object(metrics, '_registry', self.registry),
+            mock.patch.object(async_producer, 'get_async_publisher', return_value=self.publisher),
+            # Nothing in the event loop may reach for the sync Redis client
+            mock.patch.object(codec, 'get_redis_connection', side_effect=AssertionError("sync Redis in an async view")),
+            mock.patch.object(codec, 'dictionaries', codec.Dictionaries()),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def use_store(self):
+        # fakeredis' async client belongs to the event loop of the test
+        self.redis = fakeredis.FakeAsyncRedis()
+        patcher = mock.patch.object(async_views, 'get_async_plan_store', return_value=AsyncHashPlanStore(self.redis))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def request(self, method, path, data=None):
+        return await getattr(self.async_client, method)(
+            f'/async/v1/plan/{path}', data and json.dumps(data), content_type='application/json',
+            headers={'Authorization': 'Bearer token'},
+        )
+
+    @override_settings(PLAN_CODEC={'FORMAT': 'zstd'})
+    async def test_zstd_dictionaries_are_loaded_through_the_async_client(self):
+        self.use_store()
+        dictionary = train_dictionary()
+        await self.redis.hset(codec.DICTIONARIES_KEY, dictionary.dict_id(), dictionary.as_bytes())
+        await self.redis.set(codec.CURRENT_DICTIONARY_KEY, dictionary.dict_id())
+
+        self.assertEqual((await self.request('post', '', self.plan)).status_code, 201)
+        value = await self.redis.hget(CACHE_KEY, 'plan-1')
+        self.assertEqual(codec.dictionary_id(value), dictionary.dict_id())
+
+        # A process that has not loaded the dictionary yet, reading it back
+        stored = dict(self.plan, creationDate='2017-12-12')
+        codec.dictionaries.dictionaries.clear()
+        self.assertEqual((await self.request('get', 'plan-1/')).json(), stored)
+        codec.dictionaries.dictionaries.clear()
+        self.assertEqual((await self.request('get', '?limit=10')).json()['plans'], {'plan-1': stored})
+        codec.dictionaries.dictionaries.clear()
+        self.assertEqual((await self.request('delete', 'plan-1/')).status_code, 204)
+        self.assertEqual(json.loads(self.publisher.publish.call_args[0][0])['document'], stored)
+
+    async def test_requests_are_timed(self):
+        self.use_store()
+        await self.request('post', '', self.plan)
+        await self.request('get', 'plan-1/')
+        await self.request('get', 'plan-2/')
+        await self.request('put', 'plan-1/', {})
+        self.assertEqual(set(self.registry.requests.series), {
+            ('create', '201'), ('retrieve', '200'), ('retrieve', '404'), ('update', '400'),
+        })
+        self.assertEqual(
+            {name for action, status, name in self.registry.stages.series if (action, status) == ('create', '201')},
+            {'auth', 'validate', 'etag', 'redis', 'publish', 'other'},
+        )
+
+    @override_settings(PLAN_METRICS={'ENABLED': False})
+    async def test_timing_can_be_turned_off(self):
+        self.use_store()
+        self.assertEqual((await self.request('get', 'plan-1/')).status_code, 404)
+        self.assertEqual(self.registry.requests.series, {})
@@ -0,0 +1,103 @@
+import time
+from unittest import mock
+
+import jwt
+from django.test import SimpleTestCase, override_settings
+
+from plan import auth
+
+SECRET = 'test-secret-' * 4
+
+
+def token(scope='plans:read plans:write', expires_in=3600, key=SECRET, kid='k1', algorithm='HS256', **claims):
+    claims = {'aud': 'plans', **claims}
+    if scope is not None:
+        claims['scope'] = scope
+    if expires_in is not None:
+        claims['exp'] = int(time.time()) + expires_in
+    return 'Bearer ' + jwt.encode(claims, key, algorithm=algorithm, headers={'kid': kid})
+
+
+@override_settings(PLAN_AUTH={
+    'ENABLED': True, 'KEYS': {'k1': SECRET}, 'ALGORITHMS': ['HS256'], 'AUDIENCE': 'plans', 'LEEWAY': 0,
+    'SCOPES': {'bulk': 'plans:bulk'},
+})
+class AuthenticateTests(SimpleTestCase):
+    def setUp(self):
+        # A token cache of its own for each test
+        patcher = mock.patch.object(auth, '_cache', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def assertRejected(self, authorization, action='list', method='GET', status_code=401, message=None):
+        with self.assertRaises(auth.AuthenticationError) as raised:
+            auth.authenticate(authorization, action, method)
+        self.assertEqual(raised.exception.status_code, status_code)
+        if message:
+            self.assertEqual(raised.exception.message, message)
+        return raised.exception
+
+    def test_scopes_by_method_and_action(self):
+        auth.authenticate(token(), 'list', 'GET')
+        auth.authenticate(token(), 'create', 'POST')
+        auth.authenticate(token('plans:read'), 'retrieve', 'GET')
+        error = self.assertRejected(token('plans:read'), 'create', 'POST', 403, 'Authorization token lacks the plans:write scope')
+        self.assertEqual(error.headers['WWW-Authenticate'], 'Bearer error="insufficient_scope", scope="plans:write"')
+        self.assertRejected(token(), 'bulk', 'POST', 403)
+        auth.authenticate(token('plans:bulk'), 'bulk', 'POST')
+
+    def test_scope_claim_forms(self):
+        auth.authenticate(token(['plans:read']), 'list', 'GET')
+        auth.authenticate(token(None, scp='plans:read'), 'list', 'GET')
+        for scope in (5, ['plans:read', 3], {'plans:read': True}):
+            with self.subTest(scope=scope):
+                self.assertRejected(token(scope), message='Authorization token missing or invalid')
+
+    def test_invalid_tokens(self):
+        self.assertRejected(None)
+        self.assertRejected('Basic dXNlcg==')
+        self.assertRejected(token(key='other-secret-' * 4))
+        self.assertRejected(token(kid='k2'))
+        self.assertRejected(token(aud='other'))
+        self.assertRejected(token(expires_in=None))
+        self.assertRejected(token(algorithm='HS512'))
+        error = self.assertRejected(token(expires_in=-10), message='Authorization token has expired')
+        self.assertEqual(error.headers['WWW-Authenticate'], 'Bearer error="invalid_token"')
+
+    def test_verified_token_is_cached(self):
+        authorization = token('plans:read')
+        with mock.patch.object(jwt, 'decode', wraps=jwt.decode) as decode:
+            auth.authenticate(authorization, 'list', 'GET')
+            auth.authenticate(authorization, 'retrieve', 'GET')
+            # Scopes are still checked against the cached token
+            self.assertRejected(authorization, 'create', 'POST', 403)
+        self.assertEqual(decode.call_count, 1)
+
+    def test_rejected_token_is_not_cached(self):
+        authorization = token(kid='k2')
+        self.assertRejected(authorization)
+        self.assertEqual(auth.get_token_cache(auth.get_config()).entries, {})
+
+    @override_settings(PLAN_AUTH={'ENABLED': False})
+    def test_disabled_accepts_any_bearer_token(self):
+        auth.authenticate('Bearer anything', 'create', 'POST')
+        self.assertRejected(None)
+
+
+class TokenCacheTests(SimpleTestCase):
+    def test_expired_entries_are_dropped(self):
+        cache = auth.TokenCache(10)
+        cache.put(b'live', time.time() + 60, frozenset({'a'}))
+        cache.put(b'expired', time.time() - 1, frozenset({'a'}))
+        self.assertEqual(cache.get(b'live'), frozenset({'a'}))
+        self.assertIsNone(cache.get(b'expired'))
+        self.assertNotIn(b'expired', cache.entries)
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = auth.TokenCache(2)
+        expires = time.time() + 60
+        cache.put(b'first', expires, frozenset())
+        cache.put(b'second', expires, frozenset())
+        cache.get(b'first')
+        cache.put(b'third', expires, frozenset())
+        self.assertEqual(list(cache.entries), [b'first', b'third'])
@@ -0,0 +1,123 @@
+import unittest
+from unittest import mock
+
+import redis
+from django.test import SimpleTestCase
+
+from benchmarks.plans import build_plan
+from plan import cache, scripts
+from plan.storage import HashPlanStore
+
+try:
+    import fakeredis
+    import lupa  # noqa: F401 (fakeredis runs Lua scripts with it)
+except ImportError:
+    fakeredis = None
+
+
+class Stop(Exception):
+    pass
+
+
+class FakePubSub:
+    """Delivers one invalidation, recording the cache as it goes, then loses the connection."""
+
+    def __init__(self, plan_cache):
+        self.cache = plan_cache
+        self.seen = {}
+
+    def subscribe(self, channel):
+        pass
+
+    def listen(self):
+        yield {'type': 'subscribe', 'data': 1}
+        self.seen['subscribed'] = (self.cache.listening, list(self.cache.entries))
+        for pk in ('plan-1', 'plan-2'):
+            self.cache.put(pk, b'{}', 'W/"1"', self.cache.generation)
+        yield {'type': 'message', 'data': b'plan-1'}
+        self.seen['invalidated'] = list(self.cache.entries)
+        raise redis.ConnectionError("Connection lost")
+
+    def close(self):
+        pass
+
+
+class PlanCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.cache = cache.PlanCache(max_entries=3, max_bytes=100, ttl=60)
+        self.cache.listening = True
+
+    def test_hit_and_miss(self):
+        self.assertIsNone(self.cache.get('plan-1'))
+        self.cache.put('plan-1', b'{}', 'W/"1"', self.cache.generation)
+        self.assertEqual(self.cache.get('plan-1'), (b'{}', 'W/"1"'))
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_nothing_is_cached_while_not_listening(self):
+        self.cache.listening = False
+        self.cache.put('plan-1', b'{}', 'W/"1"', self.cache.generation)
+        self.assertIsNone(self.cache.get('plan-1'))
+
+    def test_invalidation_drops_the_entry(self):
+        self.cache.put('plan-1', b'{}', 'W/"1"', self.cache.generation)
+        self.cache.invalidate('plan-1')
+        self.assertIsNone(self.cache.get('plan-1'))
+        self.assertEqual(self.cache.invalidations, 1)
+
+    def test_read_before_an_invalidation_is_not_cached(self):
+        generation = self.cache.generation
+        # A write lands between reading the plan from Redis and caching it
+        self.cache.invalidate('plan-1')
+        self.cache.put('plan-1', b'{"old": 1}', 'W/"1"', generation)
+        self.assertIsNone(self.cache.get('plan-1'))
+
+    def test_least_recently_used_entries_are_evicted(self):
+        for pk in ('plan-1', 'plan-2', 'plan-3'):
+            self.cache.put(pk, b'{}', 'W/"1"', self.cache.generation)
+        self.cache.get('plan-1')
+        self.cache.put('plan-4', b'{}', 'W/"1"', self.cache.generation)
+        self.assertEqual(list(self.cache.entries), ['plan-3', 'plan-1', 'plan-4'])
+        self.cache.put('plan-5', b'x' * 99, 'W/"1"', self.cache.generation)
+        self.assertEqual(list(self.cache.entries), ['plan-5'])
+        self.assertEqual(self.cache.size, 99)
+        self.cache.put('plan-6', b'x' * 101, 'W/"1"', self.cache.generation)
+        self.assertIsNone(self.cache.get('plan-6'))
+
+    def test_expired_entry_is_a_miss(self):
+        expiring = cache.PlanCache(max_entries=3, max_bytes=100, ttl=0)
+        expiring.listening = True
+        expiring.put('plan-1', b'{}', 'W/"1"', expiring.generation)
+        self.assertIsNone(expiring.get('plan-1'))
+        self.assertEqual(expiring.expirations, 1)
+
+    @mock.patch.object(cache.time, 'sleep', side_effect=Stop)
+    def test_listener(self, sleep):
+        self.cache.put('plan-0', b'{}', 'W/"1"', self.cache.generation)
+        self.cache.listening = False
+        pubsub = FakePubSub(self.cache)
+        with self.assertRaises(Stop):
+            self.cache.listen(mock.Mock(pubsub=mock.Mock(return_value=pubsub)))
+        # Caching starts over from empty once subscribed, and stops when
+        # the connection is lost, as invalidations could be missed
+        self.assertEqual(pubsub.seen, {'subscribed': (True, []), 'invalidated': ['plan-2']})
+        self.assertFalse(self.cache.listening)
+        self.assertEqual(self.cache.entries, {})
+        sleep.assert_called_once_with(cache.RECONNECT_DELAY)
+
+
+@unittest.skipUnless(fakeredis, "needs fakeredis with Lua support")
+class InvalidationTests(SimpleTestCase):
+    def test_writes_publish_the_plan_id(self):
+        redis_conn = fakeredis.FakeRedis()
+        store = HashPlanStore(redis_conn)
+        pubsub = redis_conn.pubsub()
+        pubsub.subscribe(scripts.INVALIDATION_CHANNEL)
+        pubsub.get_message(timeout=1)
+
+        # Creating needs none: a missing plan is not cached
+        plan = build_plan('plan-1')
+        _, etag = store.create(plan)
+        store.replace('plan-1', dict(plan, planType='outOfNetwork'), etag)
+        store.delete('plan-1')
+        messages = [pubsub.get_message(timeout=0.1) for _ in range(3)]
+        self.assertEqual([message and message['data'] for message in messages], [b'plan-1', b'plan-1', None])
@@ -0,0 +1,46 @@
+import copy
+
+from django.test import SimpleTestCase
+
+from benchmarks.plans import build_plan
+from plan.changes import plan_delta
+
+
+class PlanDeltaTests(SimpleTestCase):
+    def setUp(self):
+        self.previous = build_plan('plan-1', 2)
+
+    def test_unchanged_plan_has_no_delta(self):
+        self.assertIsNone(plan_delta(self.previous, copy.deepcopy(self.previous)))
+
+    def test_top_level_field(self):
+        current = dict(copy.deepcopy(self.previous), planType='outOfNetwork')
+        self.assertEqual(plan_delta(self.previous, current), {
+            'plan': {'planType': 'outOfNetwork'}, 'upserts': [], 'deletes': [],
+        })
+
+    def test_changed_service_child(self):
+        current = copy.deepcopy(self.previous)
+        current['linkedPlanServices'][1]['planserviceCostShares']['copay'] = 7
+        delta = plan_delta(self.previous, current)
+        self.assertEqual(list(delta['plan']), ['linkedPlanServices'])
+        self.assertEqual(
+            [(upsert['relation'], upsert['parent'], upsert['document']['objectId']) for upsert in delta['upserts']],
+            [('linkedPlanServices', 'plan-1', 'plan-1-ps-1'), ('planserviceCostShares', 'plan-1-ps-1', 'plan-1-mcs-1')],
+        )
+        self.assertEqual(delta['deletes'], [])
+
+    def test_replaced_children_are_deleted(self):
+        current = copy.deepcopy(self.previous)
+        current['planCostShares']['objectId'] = 'new-cost-shares'
+        current['linkedPlanServices'][0]['linkedService']['objectId'] = 'new-service'
+        delta = plan_delta(self.previous, current)
+        self.assertEqual(delta['deletes'], [self.previous['planCostShares']['objectId'], 'plan-1-s-0'])
+        self.assertIn('new-cost-shares', [upsert['document']['objectId'] for upsert in delta['upserts']])
+
+    def test_removed_service_deletes_leaves_first(self):
+        current = copy.deepcopy(self.previous)
+        del current['linkedPlanServices'][0]
+        delta = plan_delta(self.previous, current)
+        self.assertEqual(delta['upserts'], [])
+        self.assertEqual(delta['deletes'], ['plan-1-s-0', 'plan-1-mcs-0', 'plan-1-ps-0'])
@@ -0,0 +1,55 @@
+import json
+from unittest import mock
+
+from django.core.exceptions import ImproperlyConfigured
+from django.test import SimpleTestCase, override_settings
+
+from benchmarks.plans import build_plan
+from plan import codec
+
+
+class CodecTests(SimpleTestCase):
+    def setUp(self):
+        self.plan = build_plan('plan-1', 3)
+        # No trained dictionary, without asking Redis
+        patcher = mock.patch.object(codec.dictionaries, 'current_id', return_value=0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_round_trips(self):
+        for fmt in codec.FORMATS:
+            with self.subTest(fmt=fmt):
+                value = codec.encode(self.plan, fmt=fmt)
+                self.assertEqual(codec.decode(value), self.plan)
+                self.assertEqual(json.loads(codec.to_json(value)), self.plan)
+
+    def test_formats_are_tagged(self):
+        self.assertEqual(codec.value_format(codec.encode(self.plan, fmt='json')), 'json')
+        self.assertEqual(codec.value_format(codec.encode(self.plan, fmt='orjson')), 'json')
+        self.assertEqual(codec.value_format(codec.encode(self.plan, fmt='msgpack')), 'msgpack')
+        self.assertEqual(codec.value_format(codec.encode(self.plan, fmt='zstd')), 'zstd')
+
+    def test_json_value_is_reused(self):
+        self.assertIs(codec.encode(self.plan, b'{"given": 1}', fmt='json'), b'{"given": 1}')
+
+    def test_unrepresentable_plans_fall_back_to_json(self):
+        plan = dict(self.plan, big=10 ** 30)
+        for fmt in ('orjson', 'msgpack', 'zstd'):
+            with self.subTest(fmt=fmt):
+                value = codec.encode(plan, fmt=fmt)
+                self.assertEqual(codec.value_format(value), 'json')
+                self.assertEqual(codec.decode(value), plan)
+
+    def test_long_integers_keep_their_value(self):
+        for number in (2 ** 63, -2 ** 64, 10 ** 30):
+            with self.subTest(number=number):
+                self.assertEqual(codec.json_loads(json.dumps({'n': number}).encode()), {'n': number})
+
+    @override_settings(PLAN_CODEC={'FORMAT': 'msgpack'})
+    def test_configured_format(self):
+        self.assertEqual(codec.value_format(codec.encode(self.plan)), 'msgpack')
+
+    @override_settings(PLAN_CODEC={'FORMAT': 'bson'})
+    def test_unknown_format(self):
+        with self.assertRaises(ImproperlyConfigured):
+            codec.encode(self.plan)
@@ -0,0 +1,341 @@
+import json
+from unittest import mock
+
+import pika
+
+from django.test import SimpleTestCase, override_settings
+
+from benchmarks.plans import build_plan
+from plan import consumer
+
+
+class FakeElasticsearch:
+    """
+    Just enough of the client for the consumer: _bulk writes documents that
+    search only sees after a refresh, like a real index between refreshes.
+    """
+
+    def __init__(self):
+        self.documents = {}
+        self.searchable = {}
+        self.bulk_requests = []
+        self.refreshes = 0
+        self.indices = mock.Mock()
+        self.indices.refresh.side_effect = self.refresh
+        # document id: error object, or 429 to throttle it once
+        self.refuse = {}
+
+    def refresh(self, index=None):
+        self.refreshes += 1
+        self.searchable = dict(self.documents)
+
+    def bulk(self, operations):
+        self.bulk_requests.append(operations)
+        items, errors = [], False
+        lines = iter(operations)
+        for line in lines:
+            (operation, header), = json.loads(line).items()
+            body = json.loads(next(lines)) if operation != 'delete' else None
+            refused = self.refuse.get(header['_id'])
+            if refused == 429:
+                del self.refuse[header['_id']]
+                result = {'_id': header['_id'], 'status': 429, 'error': {'type': 'es_rejected_execution_exception'}}
+            elif refused:
+                result = {'_id': header['_id'], 'status': 400, 'error': refused}
+            elif operation == 'delete':
+                found = self.documents.pop(header['_id'], None)
+                result = {'_id': header['_id'], 'status': 200 if found else 404}
+            else:
+                if operation == 'update':
+                    body = dict(self.documents.get(header['_id'], {}), **body['doc'])
+                self.documents[header['_id']] = dict(body, _routing=header.get('routing', header['_id']))
+                result = {'_id': header['_id'], 'status': 201}
+            errors = errors or 'error' in result
+            items.append({operation: result})
+        return {'errors': errors, 'items': items}
+
+    def search(self, index, query, routing, size, source):
+        # Every document of a plan is routed by the plan id
+        hits = [{'_id': _id} for _id, document in self.searchable.items() if document['_routing'] == routing]
+        return {'hits': {'hits': hits[:size]}}
+
+
+class FakeAcknowledger:
+    def __init__(self):
+        self.acked = []
+        self.failed = {}
+        self.dead = []
+
+    def ack(self, message_id):
+        self.acked.append(message_id)
+
+    def fail(self, message_id, error, retry=True):
+        self.failed[message_id] = error
+        if not retry:
+            self.dead.append(message_id)
+
+
+class ConsumerTestCase(SimpleTestCase):
+    def setUp(self):
+        self.es = FakeElasticsearch()
+        for patcher in (
+            mock.patch.object(consumer, 'get_es', return_value=self.es),
+            mock.patch.object(consumer, 'print', create=True),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.acknowledger = FakeAcknowledger()
+        self.indexer = consumer.BulkIndexer(self.acknowledger)
+
+    def handle(self, message_id, document, operation):
+        consumer.handle_message(self.indexer, message_id, json.loads(json.dumps({
+            'operation': operation, 'document': document,
+        })))
+
+
+class CascadeDeleteTests(ConsumerTestCase):
+    def test_create_and_delete_in_one_batch(self):
+        self.handle(1, build_plan('plan-1', 2), 'create')
+        self.handle(2, {'objectId': 'plan-1'}, 'delete')
+        self.indexer.flush()
+        self.assertEqual(self.es.documents, {})
+        self.assertEqual(self.acknowledger.acked, [1, 2])
+
+    def test_delete_right_after_an_update(self):
+        plan = build_plan('plan-1', 2)
+        self.handle(1, plan, 'create')
+        self.indexer.flush()
+        self.es.refresh()
+        # The update replaces a service, whose documents are not refreshed yet
+        plan['linkedPlanServices'][1] = build_plan('plan-1-new', 1)['linkedPlanServices'][0]
+        self.handle(2, plan, 'update')
+        self.indexer.flush()
+        self.handle(3, {'objectId': 'plan-1'}, 'delete')
+        self.indexer.flush()
+        self.assertEqual(self.es.documents, {})
+
+    def test_no_refresh_once_writes_are_searchable(self):
+        self.handle(1, build_plan('plan-1'), 'create')
+        self.indexer.flush()
+        self.indexer.unrefreshed_until = 0
+        self.handle(2, {'objectId': 'plan-2'}, 'delete')
+        self.assertEqual(self.es.refreshes, 0)
+
+
+class BulkIndexerTests(ConsumerTestCase):
+    def test_messages_share_one_bulk_request(self):
+        for i in range(3):
+            self.handle(i, build_plan(f'plan-{i}'), 'create')
+        self.assertEqual(self.es.bulk_requests, [])
+        self.indexer.flush()
+        self.assertEqual(len(self.es.bulk_requests), 1)
+        self.assertEqual(self.acknowledger.acked, [0, 1, 2])
+
+    def test_full_batch_is_flushed(self):
+        self.indexer.max_actions = 10
+        # Five join documents per plan with one service
+        self.handle(1, build_plan('plan-1'), 'create')
+        self.assertEqual(self.es.bulk_requests, [])
+        self.handle(2, build_plan('plan-2'), 'create')
+        self.assertEqual(len(self.es.bulk_requests), 1)
+        self.assertEqual(self.acknowledger.acked, [1, 2])
+
+    def test_partial_failure_settles_only_its_message(self):
+        self.es.refuse['plan-2-s-0'] = {'type': 'mapper_parsing_exception'}
+        for i in range(3):
+            self.handle(i, build_plan(f'plan-{i}'), 'create')
+        failures = self.indexer.flush()
+        self.assertEqual(list(failures), [2])
+        self.assertEqual(self.acknowledger.acked, [0, 1])
+        self.assertEqual(list(self.acknowledger.failed), [2])
+        self.assertIn('plan-2-s-0', self.acknowledger.failed[2])
+        self.assertIn('mapper_parsing_exception', self.acknowledger.failed[2])
+        # The rest of the failed message's documents were still written
+        self.assertIn('plan-2', self.es.documents)
+
+    @mock.patch.object(consumer, 'RETRY_DELAY', 0)
+    def test_throttled_actions_are_sent_again(self):
+        self.es.refuse['plan-1-s-0'] = 429
+        self.handle(1, build_plan('plan-1'), 'create')
+        self.indexer.flush()
+        self.assertEqual(len(self.es.bulk_requests), 2)
+        self.assertEqual(len(self.es.bulk_requests[1]), 2)
+        self.assertEqual(self.acknowledger.acked, [1])
+        self.assertIn('plan-1-s-0', self.es.documents)
+
+    def test_newer_version_coalesces_earlier_ones(self):
+        plan = build_plan('plan-1')
+        self.handle(1, plan, 'create')
+        self.handle(2, dict(plan, planType='outOfNetwork'), 'update')
+        self.handle(3, build_plan('plan-2'), 'create')
+        self.handle(4, dict(plan, planType='inNetwork'), 'update')
+        self.indexer.flush()
+        # Only the last version of plan-1 was sent, and every message acked
+        self.assertEqual(len(self.es.bulk_requests[0]), 2 * 2 * 5)
+        self.assertEqual(self.es.documents['plan-1']['planType'], 'inNetwork')
+        self.assertEqual(sorted(self.acknowledger.acked), [1, 2, 3, 4])
+        self.assertEqual(self.acknowledger.failed, {})
+
+    def test_delta_with_deletes_is_not_coalesced(self):
+        plan = build_plan('plan-1')
+        self.handle(1, plan, 'create')
+        consumer.handle_message(self.indexer, 2, {
+            'operation': 'delta', 'document': {'objectId': 'plan-1'},
+            'plan': {}, 'upserts': [], 'deletes': ['plan-1-s-0'],
+        })
+        self.handle(3, plan, 'update')
+        self.indexer.flush()
+        deleted = [json.loads(line)['delete']['_id'] for line in self.es.bulk_requests[0] if '"delete"' in line]
+        self.assertEqual(deleted, ['plan-1-s-0'])
+
+    def test_failed_request_retries_every_message(self):
+        self.handle(1, build_plan('plan-1'), 'create')
+        self.handle(2, build_plan('plan-2'), 'create')
+        with mock.patch.object(self.es, 'bulk', side_effect=RuntimeError('boom')):
+            self.indexer.flush()
+        self.assertEqual(self.acknowledger.acked, [])
+        self.assertEqual(list(self.acknowledger.failed), [1, 2])
+
+
+class FakeChannel:
+    def __init__(self):
+        self.published = []
+        self.acked = []
+        self.rejected = []
+        self.publish_error = None
+
+    def confirm_delivery(self):
+        pass
+
+    def basic_publish(self, exchange, routing_key, body, properties):
+        if self.publish_error:
+            raise self.publish_error
+        self.published.append((routing_key, body, properties.headers))
+
+    def basic_ack(self, delivery_tag):
+        self.acked.append(delivery_tag)
+
+    def basic_reject(self, delivery_tag, requeue):
+        self.rejected.append((delivery_tag, requeue))
+
+
+class FakeConnection:
+    def __init__(self):
+        self.publish_channel = FakeChannel()
+        self.callbacks = []
+
+    def channel(self):
+        return self.publish_channel
+
+    def add_callback_threadsafe(self, callback):
+        self.callbacks.append(callback)
+
+    def process_data_events(self):
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback()
+
+
+class ChannelAcknowledgerTestCase(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch.object(consumer, 'print', create=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.connection = FakeConnection()
+        self.channel = FakeChannel()
+        self.acknowledger = consumer.ChannelAcknowledger(
+            self.connection, self.channel, consumer.retry_delays(2, 5.0),
+        )
+
+    def deliver(self, delivery_tag, headers=None):
+        self.acknowledger.track(delivery_tag, 'index_queue', b'{"operation": "create"}', headers)
+
+
+class ChannelAcknowledgerTests(ChannelAcknowledgerTestCase):
+    def test_acks_run_on_the_connection_thread(self):
+        self.deliver(1)
+        self.acknowledger.ack(1)
+        self.assertEqual(self.channel.acked, [])
+        self.connection.process_data_events()
+        self.assertEqual(self.channel.acked, [1])
+
+    def test_split_delivery_is_acked_after_every_part(self):
+        self.deliver(1)
+        self.acknowledger.expect_parts(1, 2)
+        self.acknowledger.ack((1, 0))
+        self.connection.process_data_events()
+        self.assertEqual(self.channel.acked, [])
+        self.acknowledger.ack((1, 3))
+        self.connection.process_data_events()
+        self.assertEqual(self.channel.acked, [1])
+        self.assertEqual(self.connection.publish_channel.published, [])
+
+    def test_failed_message_goes_to_a_retry_queue(self):
+        self.deliver(1)
+        self.acknowledger.fail(1, 'refused')
+        self.connection.process_data_events()
+        (queue_name, body, headers), = self.connection.publish_channel.published
+        self.assertEqual(queue_name, 'index_queue.retry.5000')
+        self.assertEqual(body, b'{"operation": "create"}')
+        self.assertEqual(headers[consumer.ATTEMPTS_HEADER], 1)
+        self.assertEqual(headers[consumer.ERROR_HEADER], 'refused')
+        self.assertEqual(headers[consumer.QUEUE_HEADER], 'index_queue')
+        self.assertEqual(self.channel.acked, [1])
+
+    def test_retries_back_off(self):
+        self.deliver(1, {consumer.ATTEMPTS_HEADER: 1})
+        self.acknowledger.fail(1, 'refused')
+        self.connection.process_data_events()
+        self.assertEqual(self.connection.publish_channel.published[0][0], 'index_queue.retry.10000')
+
+    def test_message_out_of_retries_goes_to_the_dead_queue(self):
+        self.deliver(1, {consumer.ATTEMPTS_HEADER: 2})
+        self.acknowledger.fail(1, 'refused')
+        self.connection.process_data_events()
+        (queue_name, _, headers), = self.connection.publish_channel.published
+        self.assertEqual(queue_name, 'index_queue.dead')
+        self.assertEqual(headers[consumer.ATTEMPTS_HEADER], 3)
+        self.assertEqual(self.channel.acked, [1])
+
+    def test_split_delivery_takes_the_worst_outcome(self):
+        self.deliver(1)
+        self.acknowledger.expect_parts(1, 3)
+        self.acknowledger.fail((1, 0), 'malformed', retry=False)
+        self.acknowledger.fail((1, 1), 'refused')
+        self.acknowledger.ack((1, 2))
+        self.connection.process_data_events()
+        (queue_name, _, headers), = self.connection.publish_channel.published
+        self.assertEqual((queue_name, headers[consumer.ERROR_HEADER]), ('index_queue.dead', 'malformed'))
+
+    def test_unconfirmed_move_requeues_the_delivery(self):
+        self.connection.publish_channel.publish_error = pika.exceptions.NackError([])
+        self.deliver(1)
+        self.acknowledger.fail(1, 'refused')
+        self.connection.process_data_events()
+        self.assertEqual(self.channel.acked, [])
+        self.assertEqual(self.channel.rejected, [(1, True)])
+
+
+# Without cached search results the worker does not wait for a refresh to stop
+@override_settings(PLAN_SEARCH={'CACHE_TTL': 0})
+class WorkerTests(ConsumerTestCase):
+    def test_messages_are_indexed_in_order(self):
+        worker = consumer.Worker(self.acknowledger)
+        worker.indexer = self.indexer
+        worker.queue.put((1, {'operation': 'create', 'document': build_plan('plan-1')}))
+        worker.queue.put((2, {'operation': 'delete', 'document': {'objectId': 'plan-1'}}))
+        worker.queue.put(consumer.STOP)
+        worker.run()
+        self.assertEqual(self.acknowledger.acked, [1, 2])
+        self.assertEqual(self.es.documents, {})
+
+    def test_worker_survives_a_malformed_message(self):
+        worker = consumer.Worker(self.acknowledger)
+        worker.indexer = self.indexer
+        # A message without a document
+        worker.queue.put((1, {'operation': 'delete'}))
+        worker.queue.put((2, {'operation': 'create', 'document': build_plan('plan-1')}))
+        worker.queue.put(consumer.STOP)
+        worker.run()
+        self.assertEqual(self.acknowledger.dead, [1])
+        self.assertEqual(self.acknowledger.acked, [2])
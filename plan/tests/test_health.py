@@ -0,0 +1,88 @@
+import threading
+from unittest import mock
+
+from django.test import SimpleTestCase, override_settings
+
+from plan import connections
+
+
+class HealthTests(SimpleTestCase):
+    def setUp(self):
+        self.down = set()
+        self.released = threading.Event()
+        self.addCleanup(self.released.set)
+        self.services = {name: connections.Service(lambda name=name: name, self.ping) for name in connections.SERVICES}
+        for patcher in (
+            mock.patch.object(connections, 'SERVICES', self.services),
+            mock.patch.object(connections, '_clients', {}),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def ping(self, client, timeout):
+        if client == 'stuck':
+            self.released.wait()
+        if client in self.down:
+            raise ConnectionError(f"{client} is down")
+
+    def readiness(self):
+        response = self.client.get('/readyz')
+        return response.status_code, response.json()
+
+    def test_liveness_checks_no_service(self):
+        self.down.update(self.services)
+        response = self.client.get('/healthz')
+        self.assertEqual((response.status_code, response.json()), (200, {'status': 'ok'}))
+
+    def test_ready(self):
+        status_code, body = self.readiness()
+        self.assertEqual((status_code, body['status']), (200, 'ready'))
+        self.assertEqual({name: service['status'] for name, service in body['services'].items()}, dict.fromkeys(self.services, 'ok'))
+        self.assertEqual(
+            {name: service['required'] for name, service in body['services'].items()},
+            {'redis': True, 'rabbitmq': True, 'elasticsearch': False},
+        )
+
+    def test_required_service_down(self):
+        self.down.add('redis')
+        status_code, body = self.readiness()
+        self.assertEqual((status_code, body['status']), (503, 'unavailable'))
+        self.assertEqual(body['services']['redis'], {'status': 'error', 'error': 'ConnectionError: redis is down', 'required': True})
+
+    def test_optional_service_down(self):
+        self.down.add('elasticsearch')
+        status_code, body = self.readiness()
+        self.assertEqual(status_code, 200)
+        self.assertEqual(body['services']['elasticsearch']['status'], 'error')
+
+    @override_settings(PLAN_OUTBOX={'ENABLED': True})
+    def test_broker_is_optional_with_the_outbox(self):
+        self.down.add('rabbitmq')
+        self.assertEqual(self.readiness()[0], 200)
+
+    @override_settings(PLAN_HEALTH={'REQUIRED': ['redis', 'elasticsearch']})
+    def test_configured_required_services(self):
+        self.down.add('rabbitmq')
+        self.assertEqual(self.readiness()[0], 200)
+        self.down.add('elasticsearch')
+        self.assertEqual(self.readiness()[0], 503)
+
+    @override_settings(PLAN_HEALTH={'TIMEOUT': 0.05})
+    def test_unanswered_check_times_out(self):
+        self.services['redis'] = connections.Service(lambda: 'stuck', self.ping)
+        status_code, body = self.readiness()
+        self.assertEqual(status_code, 503)
+        self.assertEqual(body['services']['redis']['error'], 'No answer within 0.05s')
+
+
+class ConnectionsTests(SimpleTestCase):
+    def test_clients_are_created_on_first_use_only(self):
+        connect = mock.Mock(side_effect=object)
+        services = {'cached': connections.Service(connect, None), 'own': connections.Service(connect, None, cached=False)}
+        with mock.patch.object(connections, 'SERVICES', services), mock.patch.object(connections, '_clients', {}):
+            connect.assert_not_called()
+            self.assertIs(connections.get('cached'), connections.get('cached'))
+            self.assertEqual(connect.call_count, 1)
+            # Services that keep their own client are asked every time
+            self.assertIsNot(connections.get('own'), connections.get('own'))
+            self.assertEqual(connect.call_count, 3)
@@ -0,0 +1,121 @@
+import copy
+import json
+import unittest
+from unittest import mock
+
+from django.test import SimpleTestCase, override_settings
+
+from benchmarks.plans import build_plan
+from plan import outbox
+from plan.producer import PublishError
+from plan.storage import OUTBOX_KEY, GraphPlanStore, HashPlanStore
+
+try:
+    import fakeredis
+    import lupa  # noqa: F401 (fakeredis runs Lua scripts with it)
+except ImportError:
+    fakeredis = None
+
+
+class FakePublisher:
+    def __init__(self):
+        self.published = []
+        self.unconfirmed = False
+
+    def publish(self, body, routing_key):
+        message = json.loads(body)
+        self.published.append((message['document']['objectId'], message['operation']))
+
+    def flush(self):
+        if self.unconfirmed:
+            self.unconfirmed = False
+            raise PublishError("Broker did not confirm 1 message")
+
+
+@unittest.skipUnless(fakeredis, "needs fakeredis with Lua support")
+@override_settings(PLAN_OUTBOX={'ENABLED': True, 'BLOCK_MS': None})
+class RelayTests(SimpleTestCase):
+    store_class = HashPlanStore
+
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis()
+        self.store = self.store_class(self.redis)
+        patcher = mock.patch('plan.storage._store', self.store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.publisher = FakePublisher()
+        self.relay = outbox.Relay(self.redis, self.publisher, 'relay-1')
+        self.relay.ensure_group()
+
+    def create(self, plan):
+        return self.store.create(plan, outbox=outbox.entry(plan, 'create'))
+
+    def test_entries_are_published_in_order_and_trimmed(self):
+        first, second = build_plan('plan-1'), build_plan('plan-2')
+        self.create(first)
+        self.create(second)
+        changed = dict(first, planType='outOfNetwork')
+        self.store.replace('plan-1', changed, outbox=outbox.entry(changed, 'update'))
+        self.store.delete('plan-2', outbox=outbox.entry({'objectId': 'plan-2'}, 'delete'))
+
+        self.assertEqual(self.relay.relay_batch(), 4)
+        self.assertEqual(self.publisher.published, [
+            ('plan-1', 'create'), ('plan-2', 'create'), ('plan-1', 'update'), ('plan-2', 'delete'),
+        ])
+        self.assertEqual(self.redis.xlen(OUTBOX_KEY), 0)
+        self.assertEqual(self.redis.xpending(OUTBOX_KEY, 'relay')['pending'], 0)
+
+    def test_unconfirmed_batch_is_published_again(self):
+        self.create(build_plan('plan-1'))
+        self.publisher.unconfirmed = True
+        with self.assertRaises(PublishError):
+            self.relay.relay_batch()
+        self.assertEqual(self.redis.xlen(OUTBOX_KEY), 1)
+
+        self.create(build_plan('plan-2'))
+        # The pending entry goes out on its own, before any new one
+        self.assertEqual(self.relay.relay_batch(), 1)
+        self.assertEqual(self.relay.relay_batch(), 1)
+        self.assertEqual(self.publisher.published, [('plan-1', 'create'), ('plan-1', 'create'), ('plan-2', 'create')])
+        self.assertEqual(self.redis.xlen(OUTBOX_KEY), 0)
+
+    def test_disabled_outbox_records_nothing(self):
+        with override_settings(PLAN_OUTBOX={'ENABLED': False}):
+            self.assertEqual(outbox.entry(build_plan('plan-1'), 'create'), '')
+
+
+class GraphRelayTests(RelayTests):
+    store_class = GraphPlanStore
+
+    def test_refresh_of_deleted_plan_is_skipped(self):
+        first, second = build_plan('plan-1'), build_plan('plan-2')
+        second['planCostShares'] = copy.deepcopy(first['planCostShares'])
+        self.create(first)
+        self.create(second)
+        # Changing the shared object appends a refresh entry for plan-1
+        second['planCostShares']['copay'] = 99
+        self.store.replace('plan-2', second, outbox=outbox.entry(second, 'update'))
+        self.store.delete('plan-1', outbox=outbox.entry({'objectId': 'plan-1'}, 'delete'))
+        fields = [fields for _, fields in self.redis.xrange(OUTBOX_KEY)]
+        self.assertIn({b'plan': b'plan-1', b'refresh': b'1'}, fields)
+
+        self.assertEqual(self.relay.relay_batch(), 5)
+        self.assertEqual(self.publisher.published, [
+            ('plan-1', 'create'), ('plan-2', 'create'), ('plan-2', 'update'), ('plan-1', 'delete'),
+        ])
+
+    def test_refresh_publishes_the_stored_plan(self):
+        first, second = build_plan('plan-1'), build_plan('plan-2')
+        second['planCostShares'] = copy.deepcopy(first['planCostShares'])
+        self.create(first)
+        self.create(second)
+        second['planCostShares']['copay'] = 99
+        self.store.replace('plan-2', second, outbox=outbox.entry(second, 'update'))
+        with mock.patch.object(self.publisher, 'publish', wraps=self.publisher.publish) as publish:
+            self.relay.relay_batch()
+        messages = [json.loads(call.args[0]) for call in publish.call_args_list]
+        self.assertEqual(
+            [(message['document']['objectId'], message['operation']) for message in messages],
+            [('plan-1', 'create'), ('plan-2', 'create'), ('plan-2', 'update'), ('plan-1', 'update')],
+        )
+        self.assertEqual(messages[-1]['document']['planCostShares']['copay'], 99)
@@ -0,0 +1,66 @@
+import copy
+
+from django.test import SimpleTestCase
+
+from plan.patch import PatchError, json_patch, merge_patch
+
+
+class MergePatchTests(SimpleTestCase):
+    def test_merges_nested_objects_and_removes_nulls(self):
+        target = {'a': 1, 'b': {'c': 2, 'd': 3}, 'e': [1, 2]}
+        patched = merge_patch(target, {'a': None, 'b': {'c': 4}, 'e': [3], 'f': {'g': None}})
+        self.assertEqual(patched, {'b': {'c': 4, 'd': 3}, 'e': [3], 'f': {}})
+        self.assertEqual(target, {'a': 1, 'b': {'c': 2, 'd': 3}, 'e': [1, 2]})
+
+    def test_non_object_patch_replaces_target(self):
+        self.assertEqual(merge_patch({'a': 1}, ['x']), ['x'])
+        self.assertEqual(merge_patch('text', {'a': 1}), {'a': 1})
+
+
+class JSONPatchTests(SimpleTestCase):
+    def setUp(self):
+        self.document = {'a': {'b': [1, 2, 3]}, 'c': 'x', 'd~/e': 1}
+
+    def test_operations(self):
+        patched = json_patch(self.document, [
+            {'op': 'add', 'path': '/a/b/-', 'value': 4},
+            {'op': 'add', 'path': '/a/b/0', 'value': 0},
+            {'op': 'remove', 'path': '/a/b/1'},
+            {'op': 'replace', 'path': '/c', 'value': 'y'},
+            {'op': 'copy', 'from': '/c', 'path': '/f'},
+            {'op': 'move', 'from': '/d~0~1e', 'path': '/g'},
+            {'op': 'test', 'path': '/a/b', 'value': [0, 2, 3, 4]},
+        ])
+        self.assertEqual(patched, {'a': {'b': [0, 2, 3, 4]}, 'c': 'y', 'f': 'y', 'g': 1})
+
+    def test_replace_whole_document(self):
+        self.assertEqual(json_patch(self.document, [{'op': 'replace', 'path': '', 'value': {'z': 1}}]), {'z': 1})
+
+    def test_failing_patch_leaves_document_unchanged(self):
+        original = copy.deepcopy(self.document)
+        with self.assertRaises(PatchError):
+            json_patch(self.document, [
+                {'op': 'replace', 'path': '/c', 'value': 'y'},
+                {'op': 'test', 'path': '/c', 'value': 'x'},
+            ])
+        self.assertEqual(self.document, original)
+
+    def test_invalid_patches(self):
+        invalid = [
+            {'op': 'add', 'path': '/a'},
+            [{'op': 'add', 'path': 'a', 'value': 1}],
+            [{'op': 'add', 'path': '/a/b/01', 'value': 1}],
+            [{'op': 'add', 'path': '/a/b/5', 'value': 1}],
+            [{'op': 'replace', 'path': '/a/b/3', 'value': 1}],
+            [{'op': 'remove', 'path': '/missing'}],
+            [{'op': 'remove', 'path': ''}],
+            [{'op': 'add', 'path': '/c/x', 'value': 1}],
+            [{'op': 'move', 'from': '/a', 'path': '/a/b/0'}],
+            [{'op': 'copy', 'path': '/x'}],
+            [{'op': 'replace', 'path': '/c'}],
+            [{'op': 'frobnicate', 'path': '/c'}],
+            [{'path': '/c'}],
+        ]
+        for operations in invalid:
+            with self.subTest(operations=operations), self.assertRaises(PatchError):
+                json_patch(self.document, operations)
@@ -0,0 +1,109 @@
+from unittest import mock
+
+import pika
+import pika.channel
+from django.test import SimpleTestCase
+from pika.adapters.blocking_connection import BlockingChannel
+
+from plan import producer
+
+
+def confirm_frame(method_class, delivery_tag, multiple=False):
+    return pika.frame.Method(1, method_class(delivery_tag=delivery_tag, multiple=multiple))
+
+
+class PooledChannelTests(SimpleTestCase):
+    def setUp(self):
+        self.config = dict(producer.DEFAULTS, CONFIRM_TIMEOUT=0.5)
+        self.channel = producer.PooledChannel(self.config)
+
+    def test_confirms_are_enabled_without_blocking_publishes(self):
+        # PooledChannel relies on BlockingChannel._impl being the pika
+        # Channel, whose confirm_delivery takes a callback for acks and nacks
+        impl = mock.create_autospec(pika.channel.Channel, instance=True)
+        impl.channel_number = 1
+        impl.confirm_delivery.side_effect = lambda ack_nack_callback, callback: callback(mock.sentinel.select_ok)
+        connection = mock.Mock()
+        connection.channel.return_value = channel = BlockingChannel(impl, connection)
+        with mock.patch.object(pika, 'BlockingConnection', return_value=connection), \
+                mock.patch.object(channel, 'queue_declare'):
+            self.channel.connect()
+        impl.confirm_delivery.assert_called_once_with(ack_nack_callback=self.channel.on_confirm, callback=mock.ANY)
+        connection.process_data_events.assert_not_called()
+
+    def test_confirm_bookkeeping(self):
+        self.channel.unconfirmed = {tag: ('index_queue', f'message-{tag}', None) for tag in range(1, 5)}
+        self.channel.on_confirm(confirm_frame(pika.spec.Basic.Ack, 2, multiple=True))
+        self.assertEqual(list(self.channel.unconfirmed), [3, 4])
+        self.channel.on_confirm(confirm_frame(pika.spec.Basic.Nack, 4))
+        self.assertEqual(list(self.channel.unconfirmed), [3])
+        self.assertEqual(self.channel.nacked, [('index_queue', 'message-4', None)])
+
+
+class FakeConnection:
+    """Loses the connection on every wait for confirms, after lost_after seconds."""
+
+    def __init__(self, clock, lost_after):
+        self.clock = clock
+        self.lost_after = lost_after
+        self.is_open = True
+        self.waits = []
+
+    def process_data_events(self, time_limit):
+        self.waits.append(time_limit)
+        self.clock.now += min(time_limit, self.lost_after)
+        self.is_open = False
+        raise pika.exceptions.StreamLostError("Connection lost")
+
+    def close(self):
+        pass
+
+
+class Clock:
+    now = 0.0
+
+    def monotonic(self):
+        return self.now
+
+
+class WaitForConfirmsTests(SimpleTestCase):
+    def setUp(self):
+        self.clock = Clock()
+        patcher = mock.patch.object(producer.time, 'monotonic', self.clock.monotonic)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.channel = producer.PooledChannel(dict(producer.DEFAULTS, CONFIRM_TIMEOUT=5.0))
+        self.connections = []
+
+        def connect():
+            self.channel.connection = FakeConnection(self.clock, lost_after=2.0)
+            self.channel.channel = mock.Mock(is_open=True)
+            self.connections.append(self.channel.connection)
+
+        self.channel.connect = connect
+        connect()
+        self.channel.unconfirmed = {1: ('index_queue', 'message-1', None)}
+
+    def test_reconnects_within_one_deadline(self):
+        with mock.patch.object(self.channel, 'basic_publish', wraps=self.channel.basic_publish) as basic_publish, \
+                self.assertRaisesMessage(producer.PublishError, "1 message(s) not confirmed by the broker"):
+            self.channel.wait_for_confirms()
+        # Three waits of 2s, the last cut to what was left of the 5s
+        self.assertEqual([connection.waits for connection in self.connections[:3]], [[5.0], [3.0], [1.0]])
+        self.assertEqual(self.clock.now, 5.0)
+        # Published again on each new connection
+        self.assertEqual(basic_publish.call_args_list, [mock.call('index_queue', 'message-1', None)] * 3)
+
+
+class PublisherTests(SimpleTestCase):
+    def test_background_confirm_failure_is_logged_and_kept_for_flush(self):
+        publisher = producer.Publisher(dict(producer.DEFAULTS, CHANNEL_POOL_SIZE=1))
+        channel = publisher.checkout()
+        error = producer.PublishError("1 message(s) rejected by the broker")
+        channel.wait_for_confirms = mock.Mock(side_effect=error)
+        with self.assertLogs('plan.producer', 'WARNING') as logs:
+            publisher.confirm_in_background(channel)
+            # Back in the pool once its confirms were awaited
+            self.assertIs(publisher.checkout(), channel)
+        self.assertEqual(logs.output, [f"WARNING:plan.producer:Publishing to RabbitMQ failed: {error!r}"])
+        self.assertEqual(publisher.errors, [error])
@@ -0,0 +1,191 @@
+import io
+import json
+import unittest
+from unittest import mock
+
+from django.core.management import call_command
+from django.test import SimpleTestCase
+
+from benchmarks.plans import build_plan
+from plan import consumer, reconcile
+from plan.storage import DIGEST_KEY, HashPlanStore
+
+try:
+    import fakeredis
+    import lupa  # noqa: F401 (fakeredis runs Lua scripts with it)
+except ImportError:
+    fakeredis = None
+
+
+class FakeIndices:
+    def __init__(self):
+        self.indices = {}
+        self.aliases = {}
+
+    def resolve(self, name):
+        return next(iter(self.aliases[name])) if name in self.aliases else name
+
+    def exists(self, index):
+        return index in self.indices or index in self.aliases
+
+    def exists_alias(self, name):
+        return name in self.aliases
+
+    def get_alias(self, name):
+        return {index: {} for index in self.aliases[name]}
+
+    def create(self, index, body):
+        self.indices[index] = {}
+        for alias in body.get('aliases', {}):
+            self.aliases.setdefault(alias, set()).add(index)
+
+    def put_settings(self, index, settings):
+        pass
+
+    def refresh(self, index):
+        pass
+
+    def delete(self, index):
+        del self.indices[index]
+
+    def update_aliases(self, actions):
+        for action in actions:
+            (operation, target), = action.items()
+            if operation == 'add':
+                self.aliases.setdefault(target['alias'], set()).add(target['index'])
+            elif operation == 'remove':
+                self.aliases[target['alias']].discard(target['index'])
+
+
+class FakeElasticsearch:
+    """
+    The index and alias calls of the reindex, the plan tree lookup of
+    consumer.delete_actions and the plan digest queries of plan/reconcile.py.
+    """
+
+    def __init__(self):
+        self.indices = FakeIndices()
+
+    def documents(self, index):
+        return self.indices.indices[self.indices.resolve(index)]
+
+    def plans(self, index):
+        return {
+            _id: document for _id, document in self.documents(index).items()
+            if document['my_join_field']['name'] == 'plan'
+        }
+
+    def bulk(self, operations):
+        items = []
+        lines = iter(operations)
+        for line in lines:
+            (operation, header), = json.loads(line).items()
+            documents = self.documents(header['_index'])
+            if operation == 'delete':
+                documents.pop(header['_id'], None)
+            else:
+                documents[header['_id']] = dict(json.loads(next(lines)), _routing=header.get('routing', header['_id']))
+            items.append({operation: {'_id': header['_id'], 'status': 200}})
+        return {'errors': False, 'items': items}
+
+    def search(self, index, size, query, aggs=None, routing=None, source=None):
+        if aggs is None:
+            # The plan tree lookup of consumer.delete_actions
+            hits = [{'_id': _id} for _id, document in self.documents(index).items() if document['_routing'] == routing]
+            return {'hits': {'hits': hits}}
+        interval = aggs['buckets']['histogram']['interval']
+        buckets = {}
+        for document in self.plans(index).values():
+            key = document['planDigest']['bucket'] // interval * interval
+            count, total = buckets.get(key, (0, 0))
+            buckets[key] = (count + 1, total + document['planDigest']['value'])
+        return {'aggregations': {'buckets': {'buckets': [
+            {'key': float(key), 'doc_count': count, 'digest': {'value': float(total)}}
+            for key, (count, total) in sorted(buckets.items())
+        ]}}}
+
+    def scan(self, client, index, query, _source):
+        # elasticsearch.helpers.scan over the bucket ranges of indexed_etags
+        ranges = [should['range']['planDigest.bucket'] for should in query['query']['bool']['should']]
+        for _id, document in self.plans(index).items():
+            if any(r['gte'] <= document['planDigest']['bucket'] < r['lt'] for r in ranges):
+                yield {'_id': _id, '_source': {'planDigest': {'etag': document['planDigest']['etag']}}}
+
+
+@unittest.skipUnless(fakeredis, "needs fakeredis with Lua support")
+class ReindexTests(SimpleTestCase):
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis()
+        self.store = HashPlanStore(self.redis)
+        # The bucket sums are kept by the writes below
+        self.redis.hset(DIGEST_KEY, reconcile.BUILT_FIELD, 1)
+        self.es = FakeElasticsearch()
+        self.send_to_queue = mock.Mock()
+        for patcher in (
+            mock.patch('plan.storage._store', self.store),
+            mock.patch('plan.management.commands.reindex_plans.get_redis_connection', return_value=self.redis),
+            mock.patch.object(consumer, 'get_es', return_value=self.es),
+            mock.patch.object(reconcile.helpers, 'scan', self.es.scan),
+            mock.patch.object(reconcile, 'send_to_queue', self.send_to_queue),
+            mock.patch.object(reconcile, 'flush'),
+            mock.patch('plan.search.invalidate'),
+            mock.patch.object(consumer, 'versioned_index_name', return_value='plans-new'),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.es.indices.create('plans-old', {'aliases': {'plans': {}}})
+        for i in range(30):
+            plan = build_plan(f'plan-{i}')
+            self.store.create(plan)
+            self.es.bulk([line for action in consumer.plan_actions(plan) for line in action])
+
+    def indexed_etags(self):
+        return {_id: document['planDigest']['etag'] for _id, document in self.es.plans('plans').items()}
+
+    def stored_etags(self):
+        return {pk.decode(): etag.decode() for pk, etag in self.redis.hgetall('plan_etags').items()}
+
+    def reindex(self):
+        call_command('reindex_plans', batch=7, workers=2, stdout=io.StringIO())
+
+    def test_rebuild_switches_the_alias(self):
+        self.reindex()
+        self.assertEqual(self.es.indices.aliases['plans'], {'plans-new'})
+        self.assertEqual(self.indexed_etags(), self.stored_etags())
+        self.send_to_queue.assert_not_called()
+
+    def test_writes_during_the_load_are_caught_up(self):
+        scan = self.store.scan
+
+        def racing_scan(cursor, count):
+            next_cursor, plans = scan(cursor, count)
+            if not next_cursor:
+                # Written after the scan read them; the consumers only index
+                # these into the old index
+                changed = dict(build_plan('plan-5'), planType='outOfNetwork')
+                self.store.replace('plan-5', changed)
+                self.store.delete('plan-6')
+                self.store.create(build_plan('plan-new'))
+            return next_cursor, plans
+
+        with mock.patch.object(self.store, 'scan', racing_scan):
+            self.reindex()
+        indexed = self.indexed_etags()
+        self.assertEqual(indexed, self.stored_etags())
+        self.assertNotIn('plan-6', indexed)
+        self.assertNotIn('plan-6-ps-0', self.es.documents('plans'))
+        self.send_to_queue.assert_not_called()
+
+    def test_writes_during_the_switch_are_queued(self):
+        switch_alias = consumer.switch_alias
+
+        def racing_switch(name):
+            # Indexed into the old index, after the new one was caught up
+            self.store.create(build_plan('plan-late'))
+            return switch_alias(name)
+
+        with mock.patch.object(consumer, 'switch_alias', racing_switch):
+            self.reindex()
+        document, operation = self.send_to_queue.call_args.args
+        self.assertEqual((document['objectId'], operation), ('plan-late', 'update'))
@@ -0,0 +1,73 @@
+import base64
+import json
+from unittest import mock
+
+import elasticsearch
+from django.test import SimpleTestCase
+from elastic_transport import ApiResponseMeta, HttpHeaders, NodeConfig
+
+from plan import search
+
+
+def api_error(error_class, status):
+    meta = ApiResponseMeta(status=status, http_version='1.1', headers=HttpHeaders(), duration=0.0,
+                           node=NodeConfig('http', 'localhost', 9200))
+    return error_class('error', meta, {'error': {'type': 'error'}})
+
+
+def cursor(value):
+    return base64.urlsafe_b64encode(json.dumps(value).encode('utf-8')).decode('ascii')
+
+
+class SearchPageTests(SimpleTestCase):
+    def setUp(self):
+        self.es = mock.Mock()
+        self.es.open_point_in_time.return_value = {'id': 'pit-1'}
+        self.es.search.return_value = {'pit_id': 'pit-1', 'hits': {'hits': [
+            {'_source': {'objectId': 'plan-1', 'my_join_field': {'name': 'plan'}, 'planDigest': {}}, 'sort': [7]},
+        ]}}
+        patcher = mock.patch.object(search, 'get_client', return_value=self.es)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def assertSearchError(self, status_code, message, cursor=None):
+        with self.assertRaises(search.SearchError) as raised:
+            search.search_page({}, 1, cursor)
+        self.assertEqual((raised.exception.status_code, str(raised.exception)), (status_code, message))
+
+    def test_pages(self):
+        page = search.search_page({'planType': 'inNetwork'}, 1)
+        self.assertEqual(page['plans'], [{'objectId': 'plan-1'}])
+        self.assertEqual(search.decode_cursor(page['next_cursor']), ('pit-1', [7], {'planType': 'inNetwork'}))
+        self.assertEqual(search.search_page({}, 2, page['next_cursor'])['next_cursor'], None)
+        self.es.close_point_in_time.assert_called_once_with(id='pit-1')
+
+    def test_malformed_cursor(self):
+        for value in ('not base64!', cursor([1, 2]), cursor({'pit': 'pit-1', 'after': 'x', 'filters': {}}),
+                      cursor({'pit': 5, 'after': [1], 'filters': {}}), cursor({'pit': 'p', 'after': [1], 'filters': []})):
+            with self.subTest(cursor=value):
+                self.assertSearchError(400, 'Invalid search cursor', value)
+        self.es.search.assert_not_called()
+
+    def test_cursor_rejected_by_elasticsearch(self):
+        self.es.search.side_effect = api_error(elasticsearch.BadRequestError, 400)
+        self.assertSearchError(400, 'Invalid search cursor', cursor({'pit': 'tampered', 'after': ['x'], 'filters': {}}))
+
+    def test_request_rejected_by_elasticsearch(self):
+        self.es.search.side_effect = api_error(elasticsearch.ApiError, 403)
+        self.assertSearchError(400, 'Invalid search request')
+
+    def test_expired_cursor(self):
+        self.es.search.side_effect = api_error(elasticsearch.NotFoundError, 404)
+        self.assertSearchError(400, 'Search cursor expired', cursor({'pit': 'pit-1', 'after': [7], 'filters': {}}))
+
+    def test_unavailable(self):
+        for error in (api_error(elasticsearch.ApiError, 503), api_error(elasticsearch.ApiError, 429),
+                      elasticsearch.ConnectionError('refused'), elasticsearch.ConnectionTimeout('timed out')):
+            with self.subTest(error=error):
+                self.es.open_point_in_time.side_effect = error
+                self.assertSearchError(503, 'Search is unavailable')
+
+    def test_failed_close_does_not_fail_the_page(self):
+        self.es.close_point_in_time.side_effect = elasticsearch.ConnectionError('refused')
+        self.assertEqual(search.search_page({}, 2)['plans'], [{'objectId': 'plan-1'}])
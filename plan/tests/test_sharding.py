@@ -0,0 +1,28 @@
+from django.test import SimpleTestCase
+
+from plan.sharding import jump_hash, shard_queue, shard_queues
+
+
+class ShardingTests(SimpleTestCase):
+    def test_jump_hash_range_and_stability(self):
+        for key in range(1000):
+            self.assertEqual(jump_hash(key, 1), 0)
+            self.assertIn(jump_hash(key, 7), range(7))
+            self.assertEqual(jump_hash(key, 7), jump_hash(key, 7))
+
+    def test_growing_moves_keys_only_to_the_new_bucket(self):
+        moved = 0
+        for key in range(10000):
+            before, after = jump_hash(key, 8), jump_hash(key, 9)
+            if before != after:
+                self.assertEqual(after, 8)
+                moved += 1
+        # About 1/9 of the keys
+        self.assertLess(abs(moved - 10000 / 9), 300)
+
+    def test_shard_queues(self):
+        self.assertEqual(shard_queues('index_queue', 1), ['index_queue'])
+        self.assertEqual(shard_queues('index_queue', 3), ['index_queue.0', 'index_queue.1', 'index_queue.2'])
+        self.assertEqual(shard_queue('index_queue', 1, 'plan-1'), 'index_queue')
+        self.assertIn(shard_queue('index_queue', 3, 'plan-1'), shard_queues('index_queue', 3))
+        self.assertEqual(shard_queue('index_queue', 3, 'plan-1'), shard_queue('index_queue', 3, 'plan-1'))
@@ -0,0 +1,145 @@
+import copy
+import json
+import unittest
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from benchmarks.plans import build_plan
+from plan import reconcile, scripts
+from plan.storage import (
+    BUCKET_PREFIX, CACHE_KEY, DIGEST_KEY, GraphPlanStore, HashPlanStore, digest_bucket, etag_digest,
+)
+
+try:
+    import fakeredis
+    import lupa  # noqa: F401 (fakeredis runs Lua scripts with it)
+except ImportError:
+    fakeredis = None
+
+
+@unittest.skipUnless(fakeredis, "needs fakeredis with Lua support")
+class HashScriptTests(SimpleTestCase):
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis()
+        self.store = HashPlanStore(self.redis)
+        self.plan = build_plan('plan-1')
+
+    def stored_digests(self):
+        # The bucket of plan-1 counts it, with its current ETag, only while it is stored
+        bucket = digest_bucket('plan-1')
+        digests = self.redis.hgetall(DIGEST_KEY)
+        etag = self.store.get_etag('plan-1')
+        self.assertEqual(int(digests.get(f'{bucket}:count'.encode(), 0)), 1 if etag else 0)
+        self.assertEqual(int(digests.get(f'{bucket}:sum'.encode(), 0)), etag_digest(etag) if etag else 0)
+
+    def test_create(self):
+        code, etag = self.store.create(self.plan)
+        self.assertEqual(code, scripts.OK)
+        self.assertEqual(self.store.get('plan-1'), (json.dumps(self.plan).encode('utf-8'), etag))
+        self.assertEqual(self.store.create(self.plan)[0], scripts.EXISTS)
+        self.stored_digests()
+
+    def test_replace(self):
+        self.assertEqual(self.store.replace('plan-1', self.plan)[0], scripts.NOT_FOUND)
+        _, etag = self.store.create(self.plan)
+        changed = dict(self.plan, planType='outOfNetwork')
+        self.assertEqual(self.store.replace('plan-1', changed, 'W/"other"')[0], scripts.PRECONDITION_FAILED)
+        code, new_etag = self.store.replace('plan-1', changed, etag)
+        self.assertEqual(code, scripts.OK)
+        self.assertEqual(self.store.get_etag('plan-1'), new_etag)
+        self.stored_digests()
+
+    def test_delete(self):
+        self.assertEqual(self.store.delete('plan-1')[0], scripts.NOT_FOUND)
+        _, etag = self.store.create(self.plan)
+        self.assertEqual(self.store.delete('plan-1', if_match='W/"other"')[0], scripts.PRECONDITION_FAILED)
+        self.assertEqual(self.store.delete('plan-1', if_none_match=etag)[0], scripts.PRECONDITION_FAILED)
+        self.assertEqual(self.store.delete('plan-1', if_match=etag), (scripts.OK, self.plan))
+        self.assertEqual(self.store.get('plan-1'), (None, None))
+        self.stored_digests()
+
+    def test_missing_etag_is_backfilled(self):
+        self.redis.hset(CACHE_KEY, 'plan-1', json.dumps(self.plan))
+        result = self.store.replace_script(
+            keys=self.store.script_keys(0), args=['plan-1', 'W/"any"', '{}', 'W/"new"', '', 0],
+        )
+        self.assertEqual(result, [scripts.ETAG_MISSING])
+        etag = self.store.get_etag('plan-1')
+        code, _ = self.store.replace('plan-1', dict(self.plan, planType='x'), etag)
+        self.assertEqual(code, scripts.OK)
+        self.stored_digests()
+
+
+@unittest.skipUnless(fakeredis, "needs fakeredis with Lua support")
+class GraphScriptTests(SimpleTestCase):
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis()
+        self.store = GraphPlanStore(self.redis)
+        patcher = mock.patch('plan.storage.send_to_queue')
+        self.send_to_queue = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_status_codes(self):
+        plan = build_plan('plan-1')
+        self.assertEqual(self.store.replace('plan-1', plan)[0], scripts.NOT_FOUND)
+        _, etag = self.store.create(plan)
+        self.assertEqual(self.store.create(plan)[0], scripts.EXISTS)
+        self.assertEqual(self.store.replace('plan-1', plan, 'W/"other"')[0], scripts.PRECONDITION_FAILED)
+        self.assertEqual(self.store.replace('plan-1', plan, etag)[0], scripts.OK)
+        self.assertEqual(self.store.delete('plan-1', if_match='W/"other"')[0], scripts.PRECONDITION_FAILED)
+        self.assertEqual(self.store.delete('plan-1', if_match=etag), (scripts.OK, plan))
+        self.assertEqual(self.store.delete('plan-1')[0], scripts.NOT_FOUND)
+        self.assertEqual(self.redis.keys('refs:*'), [])
+
+    def test_changed_record_is_retried(self):
+        plan = build_plan('plan-1')
+        self.store.create(plan)
+        keys, args, _ = self.store.write_args('replace', 'plan-1', plan, current=b'{"document": {}, "keys": []}')
+        self.assertEqual(self.store.write_script(keys=keys, args=args), [scripts.RECORD_CHANGED])
+
+    def test_shared_object_change_queues_other_plans(self):
+        first, second = build_plan('plan-1'), build_plan('plan-2')
+        second['planCostShares'] = copy.deepcopy(first['planCostShares'])
+        self.store.create(first)
+        self.store.create(second)
+        self.send_to_queue.reset_mock()
+
+        second['planCostShares']['copay'] = 99
+        self.assertEqual(self.store.replace('plan-2', second)[0], scripts.OK)
+        self.send_to_queue.assert_called_once()
+        document, operation = self.send_to_queue.call_args.args
+        self.assertEqual((document['objectId'], document['planCostShares']['copay'], operation), ('plan-1', 99, 'update'))
+        plan, etag = self.store.get('plan-1')
+        self.assertEqual(self.store.get_etag('plan-1'), etag)
+        self.assertEqual(json.loads(plan)['planCostShares']['copay'], 99)
+
+
+@unittest.skipUnless(fakeredis, "needs fakeredis with Lua support")
+class DigestTests(SimpleTestCase):
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis()
+
+    # Counting all 2**16 buckets is slow with fakeredis's Lua
+    @mock.patch('plan.storage.DIGEST_BUCKET_BITS', 4)
+    @mock.patch('plan.reconcile.DIGEST_BUCKET_BITS', 4)
+    def test_built_digests_match_maintained_ones(self):
+        store = HashPlanStore(self.redis)
+        for i in range(20):
+            store.create(build_plan(f'plan-{i}'))
+        store.delete('plan-3')
+        maintained = reconcile.stored_summary(self.redis, 0)
+
+        self.redis.delete(DIGEST_KEY, *self.redis.keys(f'{BUCKET_PREFIX}*'))
+        self.assertTrue(reconcile.build_digests(self.redis))
+        self.assertFalse(reconcile.build_digests(self.redis))
+        self.assertEqual(reconcile.stored_summary(self.redis, 0), maintained)
+        self.assertEqual(sum(count for count, _ in maintained.values()), 19)
+
+    def test_graph_writes_keep_digests(self):
+        store = GraphPlanStore(self.redis)
+        with mock.patch('plan.storage.send_to_queue'):
+            _, etag = store.create(build_plan('plan-1'))
+            self.assertEqual(reconcile.stored_summary(self.redis, 0), {digest_bucket('plan-1'): (1, etag_digest(etag))})
+            store.delete('plan-1')
+        self.assertEqual(reconcile.stored_summary(self.redis, 0), {})
@@ -0,0 +1,62 @@
+import copy
+import json
+
+from django.test import SimpleTestCase
+
+from benchmarks.plans import build_plan
+from plan.serializers import PlanSerializer
+from plan.validation import CompiledValidator, drf_validate
+
+
+# Single-field mutations the compiled validator must treat like the DRF one
+BAD_VALUES = [
+    None, True, False, 0, -1, 1.5, 10 ** 30, '', '   ', ' padded ', '12', 'x\x00y', '\ud800', 'ok\udfff',
+    '2017-12-12', '31-02-2017', '12-12-2017', [], [{}], {}, {'objectId': 'x'},
+]
+
+
+def leaf_paths(value, path=()):
+    yield path
+    if isinstance(value, dict):
+        for key, child in value.items():
+            yield from leaf_paths(child, path + (key,))
+    elif isinstance(value, list):
+        for index, child in enumerate(value):
+            yield from leaf_paths(child, path + (index,))
+
+
+def mutations(plan):
+    for path in leaf_paths(plan):
+        if not path:
+            continue
+        for bad in BAD_VALUES:
+            mutated = copy.deepcopy(plan)
+            target = mutated
+            for key in path[:-1]:
+                target = target[key]
+            target[path[-1]] = copy.deepcopy(bad)
+            yield mutated
+        if isinstance(path[-1], str):
+            mutated = copy.deepcopy(plan)
+            target = mutated
+            for key in path[:-1]:
+                target = target[key]
+            del target[path[-1]]
+            yield mutated
+    yield [plan]
+    yield 'plan'
+    yield {'extra': 1, **plan}
+
+
+class ValidationParityTests(SimpleTestCase):
+    def test_compiled_validator_matches_drf(self):
+        compiled = CompiledValidator(PlanSerializer)
+        corpus = [build_plan(f'parity-{n}', n) for n in (1, 10, 100)]
+        corpus += [mutated for plan in corpus[:2] for mutated in mutations(plan)]
+        for data in corpus:
+            for partial in (False, True):
+                expected = drf_validate(PlanSerializer, copy.deepcopy(data), partial)
+                actual = compiled(copy.deepcopy(data), partial)
+                with self.subTest(partial=partial, data=json.dumps(data, default=str)[:200]):
+                    self.assertEqual(actual, expected)
+                    self.assertEqual(json.dumps(actual, default=str), json.dumps(expected, default=str))
@@ -0,0 +1,125 @@
+import json
+import unittest
+from unittest import mock
+
+from django.test import SimpleTestCase, override_settings
+from rest_framework.test import APIClient
+
+from benchmarks.plans import build_plan
+from plan import views
+from plan.storage import HashPlanStore
+
+try:
+    import fakeredis
+    import lupa  # noqa: F401 (fakeredis runs Lua scripts with it)
+except ImportError:
+    fakeredis = None
+
+
+@unittest.skipUnless(fakeredis, "needs fakeredis with Lua support")
+class PlanViewTestCase(SimpleTestCase):
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis()
+        self.store = HashPlanStore(self.redis)
+        patcher = mock.patch('plan.storage._store', self.store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer token')
+
+
+class BulkViewTests(PlanViewTestCase):
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(views, 'send_batch_to_queue')
+        self.send_batch_to_queue = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def post(self, lines):
+        body = b''.join(
+            (line if isinstance(line, bytes) else json.dumps(line).encode('utf-8')) + b'\n' for line in lines
+        )
+        return self.client.post('/v1/plan/_bulk/', body, content_type='application/x-ndjson')
+
+    def test_results_in_request_order(self):
+        self.store.create(build_plan('plan-3'))
+        invalid = dict(build_plan('plan-2'), planType=5)
+        response = self.post([build_plan('plan-1'), b'{not json', invalid, b'', build_plan('plan-3'), build_plan('plan-4')])
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertEqual(body['message'], '2 of 5 plans saved')
+        self.assertTrue(body['errors'])
+        self.assertEqual(
+            [(item.get('objectId'), item['status'], item['status_code']) for item in body['items']],
+            [('plan-1', 'created', 201), (None, 'invalid', 400), ('plan-2', 'invalid', 400),
+             ('plan-3', 'conflict', 409), ('plan-4', 'created', 201)],
+        )
+        self.assertIn('planType', body['items'][2]['errors'])
+        self.assertEqual(body['items'][0]['etag'], self.store.get_etag('plan-1'))
+
+        self.send_batch_to_queue.assert_called_once()
+        documents, operation = self.send_batch_to_queue.call_args.args
+        self.assertEqual(([document['objectId'] for document in documents], operation), (['plan-1', 'plan-4'], 'create'))
+
+    @mock.patch.object(views, 'BULK_PIPELINE_SIZE', 2)
+    def test_plans_are_written_in_chunks(self):
+        with mock.patch.object(self.store, 'create_many', wraps=self.store.create_many) as create_many:
+            response = self.post([build_plan(f'plan-{i}') for i in range(5)])
+        self.assertEqual(response.json()['message'], '5 of 5 plans saved')
+        self.assertEqual([len(call.args[0]) for call in create_many.call_args_list], [2, 2, 1])
+        self.assertEqual(self.redis.hlen('plans'), 5)
+
+    @mock.patch.object(views, 'BULK_MAX_ITEMS', 3)
+    def test_too_many_plans_writes_none(self):
+        response = self.post([build_plan(f'plan-{i}') for i in range(4)])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['message'], 'Request body must contain between 1 and 3 NDJSON plans')
+        self.assertEqual(self.redis.hlen('plans'), 0)
+        self.send_batch_to_queue.assert_not_called()
+
+    def test_empty_body(self):
+        self.assertEqual(self.post([b'', b'  ']).status_code, 400)
+
+    # The body is streamed, not read whole through request.body
+    @override_settings(DATA_UPLOAD_MAX_MEMORY_SIZE=1024)
+    def test_body_beyond_upload_limit(self):
+        response = self.post([build_plan(f'plan-{i}', 3) for i in range(3)])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['message'], '3 of 3 plans saved')
+
+
+class ListViewTests(PlanViewTestCase):
+    def setUp(self):
+        super().setUp()
+        self.plans = {f'plan-{i}': build_plan(f'plan-{i}') for i in range(25)}
+        for plan in self.plans.values():
+            self.store.create(plan)
+
+    def test_pages_cover_every_plan(self):
+        seen = {}
+        cursor = None
+        while True:
+            params = {'limit': 10, **({'cursor': cursor} if cursor else {})}
+            response = self.client.get('/v1/plan/', params)
+            self.assertEqual(response.status_code, 200)
+            page = response.json()
+            seen.update(page['plans'])
+            cursor = page['next_cursor']
+            if cursor is None:
+                break
+        self.assertEqual(seen, self.plans)
+
+    def test_invalid_cursor_or_limit(self):
+        for params in ({'cursor': 'x'}, {'cursor': -1}, {'limit': 0}, {'limit': views.MAX_PAGE_SIZE + 1}):
+            with self.subTest(params=params):
+                self.assertEqual(self.client.get('/v1/plan/', params).status_code, 400)
+
+    def test_ndjson_stream(self):
+        response = self.client.get('/v1/plan/', HTTP_ACCEPT='application/x-ndjson')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = b''.join(response.streaming_content).splitlines()
+        self.assertEqual({plan['objectId']: plan for plan in map(json.loads, lines)}, self.plans)
+
+    def test_whole_list(self):
+        self.assertEqual(self.client.get('/v1/plan/').json(), self.plans)
@@ -0,0 +1,170 @@
+"""
+Plan validation engines.
+
+The default engine runs PlanSerializer as-is. The "compiled" engine walks the
+serializer's declared fields once and generates a flat Python function per
+nested serializer, so a valid payload is checked without building DRF field
+objects or error containers. Any payload the compiled function rejects is
+handed to the serializer, so error responses are exactly DRF's.
+"""
+import datetime
+import re
+
+from django.conf import settings
+from rest_framework import serializers
+from rest_framework.fields import empty
+
+from plan.metrics import timed
+from plan.serializers import PlanSerializer, StrictIntegerField, StrictStringField
+
+_SURROGATES = re.compile('[\ud800-\udfff]')
+
+
+class Invalid(Exception):
+    pass
+
+
+class SchemaCompiler:
+    def __init__(self, partial):
+        self.partial = partial
+        self.functions = {}
+        self.lines = []
+
+    def compile(self, serializer):
+        name = self.function_for(serializer)
+        namespace = {
+            'Invalid': Invalid,
+            'empty': empty,
+            'strptime': datetime.datetime.strptime,
+            'surrogates': _SURROGATES,
+        }
+        code = compile('\n'.join(self.lines), f'<compiled {type(serializer).__name__}>', 'exec')
+        exec(code, namespace)
+        return namespace[name]
+
+    def function_for(self, serializer):
+        key = type(serializer)
+        if key not in self.functions:
+            self.functions[key] = f'validate_{key.__name__}'
+            self.emit_function(self.functions[key], serializer)
+        return self.functions[key]
+
+    def emit_function(self, name, serializer):
+        if serializer.validators or type(serializer).validate is not serializers.Serializer.validate:
+            raise TypeError(f'{type(serializer).__name__} has validators and cannot be compiled')
+
+        body = [
+            f'def {name}(data):',
+            '    if data.__class__ is not dict:',
+            '        raise Invalid',
+            '    ret = {}',
+        ]
+        for field_name, field in serializer.fields.items():
+            if getattr(serializer, f'validate_{field_name}', None) is not None:
+                raise TypeError(f'{type(serializer).__name__}.validate_{field_name} cannot be compiled')
+            if field.read_only or field.source != field_name or field.allow_null or not field.required:
+                raise TypeError(f'{type(serializer).__name__}.{field_name} options cannot be compiled')
+
+            body.append(f'    value = data.get({field_name!r}, empty)')
+            body.append('    if value is empty:')
+            body.append('        pass' if self.partial else '        raise Invalid')
+            body.append('    else:')
+            body.extend('        ' + line for line in self.field_checks(field))
+            body.append(f'        ret[{field_name!r}] = value')
+        body.append('    return ret')
+        self.lines.extend(body + [''])
+
+    def field_checks(self, field):
+        if isinstance(field, serializers.ListSerializer):
+            lengths = (getattr(field, 'max_length', None), getattr(field, 'min_length', None))
+            if field.validators or not field.allow_empty or lengths != (None, None):
+                raise TypeError(f'{field.field_name} list options cannot be compiled')
+            child = self.function_for(field.child)
+            return [
+                'if value.__class__ is not list:',
+                '    raise Invalid',
+                f'value = [{child}(item) for item in value]',
+            ]
+
+        if isinstance(field, serializers.Serializer):
+            return [f'value = {self.function_for(field)}(value)']
+
+        if type(field) is StrictIntegerField:
+            if field.validators:
+                raise TypeError(f'{field.field_name} validators cannot be compiled')
+            return [
+                'if value.__class__ is not int:',
+                '    raise Invalid',
+            ]
+
+        if type(field) is StrictStringField:
+            if len(field.validators) != 2 or not field.trim_whitespace or field.allow_blank:
+                raise TypeError(f'{field.field_name} options cannot be compiled')
+            return [
+                'if not isinstance(value, str):',
+                '    raise Invalid',
+                'value = value.strip()',
+                "if not value or '\\x00' in value or (not value.isascii() and surrogates.search(value)):",
+                '    raise Invalid',
+            ]
+
+        if type(field) is serializers.DateField:
+            formats = getattr(field, 'input_formats', None)
+            if field.validators or not formats or any(fmt.lower() == 'iso-8601' for fmt in formats):
+                raise TypeError(f'{field.field_name} date options cannot be compiled')
+            checks = ['parsed = None']
+            for fmt in formats:
+                checks += [
+                    'if parsed is None:',
+                    '    try:',
+                    f'        parsed = strptime(value, {fmt!r}).date()',
+                    '    except (ValueError, TypeError):',
+                    '        pass',
+                ]
+            return checks + [
+                'if parsed is None:',
+                '    raise Invalid',
+                'value = parsed',
+            ]
+
+        raise TypeError(f'{type(field).__name__} fields cannot be compiled')
+
+
+class CompiledValidator:
+    def __init__(self, serializer_class):
+        self.serializer_class = serializer_class
+        self.full = SchemaCompiler(partial=False).compile(serializer_class())
+        self.partial = SchemaCompiler(partial=True).compile(serializer_class())
+
+    def __call__(self, data, partial=False):
+        try:
+            return (self.partial if partial else self.full)(data), None
+        except Invalid:
+            pass
+        # Rejected or not a plain dict (e.g. form data): let DRF decide and
+        # build the error response.
+        return drf_validate(self.serializer_class, data, partial)
+
+
+def drf_validate(serializer_class, data, partial=False):
+    serializer = serializer_class(data=data, partial=partial)
+    if serializer.is_valid():
+        return serializer.validated_data, None
+    return None, serializer.errors
+
+
+_compiled = None
+
+
+@timed('validate')
+def validate_plan(data, partial=False):
+    """
+    Returns (validated_data, None) or (None, errors) for a plan payload,
+    using the engine selected by PLAN_VALIDATION_ENGINE.
+    """
+    global _compiled
+    if getattr(settings, 'PLAN_VALIDATION_ENGINE', 'drf') != 'compiled':
+        return drf_validate(PlanSerializer, data, partial)
+    if _compiled is None:
+        _compiled = CompiledValidator(PlanSerializer)
+    return _compiled(data, partial)
@@ -1,50 +1,255 @@
 from rest_framework.viewsets import ViewSet
 from rest_framework.response import Response
-from django_redis import get_redis_connection
+from rest_framework.settings import api_settings
+from rest_framework.decorators import action
+from rest_framework.renderers import JSONRenderer
+from django.http import HttpResponse, StreamingHttpResponse
 from rest_framework import status
 from plan.serializers import PlanSerializer
+from plan.renderers import NDJSONRenderer
+from plan.parsers import MergePatchParser, JSONPatchParser
+from plan.patch import PatchError, merge_patch, json_patch
+from plan.validation import validate_plan
+from plan.storage import get_plan_store
+from plan.codec import decode, to_json
+from plan.cache import get_plan_cache
+from plan import auth, metrics, outbox, scripts
 import json
 from datetime import date
-import hashlib
 from rest_framework import serializers
-from .producer import send_to_queue
-
-redis_conn = get_redis_connection("default")
+from plan.changes import plan_delta
+from plan.search import SearchError, search_plans
+from .producer import send_to_queue, send_batch_to_queue, send_delta_to_queue
+
+# Page size bounds for cursor pagination in list
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# HSCAN batch size used while streaming NDJSON
+STREAM_BATCH_SIZE = 500
+
+# Limits for NDJSON bulk ingestion
+BULK_MAX_ITEMS = 50000
+BULK_PIPELINE_SIZE = 500
+
+# Read, merge and write rounds a PATCH without If-Match makes before giving
+# up with 409 when other writes keep landing in between
+PATCH_ATTEMPTS = 3
+
+
+def input_document(plan_data):
+    # Patch documents apply to the plan as clients send it, with
+    # creationDate in the %d-%m-%Y input format rather than stored ISO
+    document = dict(plan_data)
+    try:
+        document['creationDate'] = date.fromisoformat(document['creationDate']).strftime('%d-%m-%Y')
+    except (KeyError, TypeError, ValueError):
+        pass
+    return document
+
+
+def merge_object(existing, incoming):
+    """
+    Merges incoming into existing field by field, recursing into nested
+    objects that keep their objectId. Anything else is replaced.
+    """
+    if not isinstance(existing, dict) or not isinstance(incoming, dict):
+        return incoming
+    if incoming.get('objectId', existing.get('objectId')) != existing.get('objectId'):
+        return incoming
+    merged = dict(existing)
+    for key, value in incoming.items():
+        merged[key] = merge_object(existing.get(key), value)
+    return merged
+
+
+def apply_patch(pk, plan_data, media_type, data):
+    """
+    Applies a PATCH body to the stored plan_data. Returns the patched plan,
+    or None and the 400 response body. Changing an objectId raises
+    serializers.ValidationError.
+    """
+    is_patch_document = media_type in (MergePatchParser.media_type, JSONPatchParser.media_type)
+    if is_patch_document:
+        # The patched plan is validated in full, like a PUT
+        try:
+            if media_type == MergePatchParser.media_type:
+                patched = merge_patch(input_document(plan_data), data)
+            else:
+                patched = json_patch(input_document(plan_data), data)
+        except PatchError as exc:
+            return None, {
+                "message": f"Invalid patch document: {exc}",
+                "status_code": 400
+            }
+        validated_data, errors = validate_plan(patched)
+    else:
+        validated_data, errors = validate_plan(data, partial=True)
+    if errors:
+        return None, {
+            "message": "Missing or invalid fields in request body",
+            "status_code": 400,
+            "errors": errors
+        }
+
+    # Convert date objects to strings
+    for key, value in validated_data.items():
+        if isinstance(value, date):
+            validated_data[key] = value.isoformat()
+
+    if validated_data.get('objectId', pk) != pk:
+        raise serializers.ValidationError({
+            'objectId': 'Updating objectId is not allowed.'
+        })
+
+    # Handle unique key constraint for planCostShares["objectId"]
+    if 'planCostShares' in validated_data:
+        plan_cost_shares_data = validated_data['planCostShares']
+        if 'objectId' in plan_cost_shares_data and plan_cost_shares_data['objectId'] != plan_data['planCostShares']['objectId']:
+            raise serializers.ValidationError({
+                'planCostShares': {
+                    'objectId': 'Updating objectId is not allowed.'
+                }
+            })
+
+    if is_patch_document:
+        plan_data.update(validated_data)
+        return plan_data, None
+
+    # Merge linkedPlanServices by objectId: known services are merged
+    # field by field, new ones are appended
+    if 'linkedPlanServices' in validated_data:
+        existing_services = plan_data.get('linkedPlanServices', [])
+        positions = {service.get('objectId'): index for index, service in enumerate(existing_services)}
+
+        for service_data in validated_data['linkedPlanServices']:
+            index = positions.get(service_data.get('objectId'))
+            if index is None:
+                # Without an objectId it cannot match, and fails validation
+                # below as incomplete
+                positions.setdefault(service_data.get('objectId'), len(existing_services))
+                existing_services.append(service_data)
+            else:
+                existing_services[index] = merge_object(existing_services[index], service_data)
+
+        validated_data['linkedPlanServices'] = existing_services
+
+    for key, value in validated_data.items():
+        plan_data[key] = merge_object(plan_data.get(key), value)
+
+    # Partial validation skips required nested fields, so the merged plan is
+    # validated in full: a new service must be complete
+    _, errors = validate_plan(input_document(plan_data))
+    if errors:
+        return None, {
+            "message": "Missing or invalid fields in request body",
+            "status_code": 400,
+            "errors": errors
+        }
+    return plan_data, None
 
-CACHE_KEY = 'plans'
 
 class PlanViewSet(ViewSet):
     serializer_class = PlanSerializer
+    renderer_classes = [*api_settings.DEFAULT_RENDERER_CLASSES, NDJSONRenderer]
+    parser_classes = [*api_settings.DEFAULT_PARSER_CLASSES, MergePatchParser, JSONPatchParser]
+
+    def dispatch(self, request, *args, **kwargs):
+        timer = metrics.start_request()
+        if timer is None:
+            return super().dispatch(request, *args, **kwargs)
+        status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
+        try:
+            response = super().dispatch(request, *args, **kwargs)
+            status_code = response.status_code
+            return response
+        finally:
+            metrics.finish_request(timer, getattr(self, 'action', None) or request.method.lower(), status_code)
 
     def check_bearer_token(self, request):
-        auth_header = request.headers.get('Authorization')
-        if not auth_header or not auth_header.startswith('Bearer '):
-            return Response(
-                {
-                    "message": "Authorization token missing or invalid",
-                    "status_code": 401
-                },
-                status=status.HTTP_401_UNAUTHORIZED
-            )
-        return None
-
-    def generate_etag(self, data):
-        data_json = json.dumps(data)
-        etag = hashlib.md5(data_json.encode('utf-8')).hexdigest()
-        return f'W/"{etag}"'
+        with metrics.stage('auth'):
+            try:
+                auth.authenticate(request.headers.get('Authorization'), self.action, request.method)
+            except auth.AuthenticationError as exc:
+                return Response(
+                    {
+                        "message": exc.message,
+                        "status_code": exc.status_code
+                    },
+                    status=exc.status_code,
+                    headers=exc.headers
+                )
+            return None
+
+    def script_error_response(self, code, pk):
+        message, status_code = {
+            scripts.NOT_FOUND: ("Plan not found", status.HTTP_404_NOT_FOUND),
+            scripts.EXISTS: (f"Plan with ID: {pk} already exists", status.HTTP_409_CONFLICT),
+            scripts.PRECONDITION_FAILED: ("Precondition Failed", status.HTTP_412_PRECONDITION_FAILED),
+        }[code]
+        return Response(
+            {
+                "message": message,
+                "status_code": status_code
+            },
+            status=status_code
+        )
 
     def list(self, request):
         auth_response = self.check_bearer_token(request)
         if auth_response:
             return auth_response
 
-        plans = redis_conn.hgetall(CACHE_KEY)
+        if request.accepted_renderer.format == 'ndjson':
+            return StreamingHttpResponse(self.stream_plans(), content_type=NDJSONRenderer.media_type)
+
+        if 'cursor' in request.query_params or 'limit' in request.query_params:
+            return self.list_page(request)
+
+        plans = get_plan_store().all()
         plans_data = {}
         for key, value in plans.items():
-            plan_data = json.loads(value)
-            plans_data[key.decode('utf-8')] = plan_data
+            plan_data = decode(value)
+            plans_data[key] = plan_data
         return Response(plans_data)
 
+    def list_page(self, request):
+        try:
+            cursor = int(request.query_params.get('cursor') or 0)
+            limit = int(request.query_params.get('limit') or DEFAULT_PAGE_SIZE)
+        except ValueError:
+            cursor = limit = -1
+        if cursor < 0 or not 0 < limit <= MAX_PAGE_SIZE:
+            return Response(
+                {
+                    "message": f"cursor must be a non-negative integer and limit between 1 and {MAX_PAGE_SIZE}",
+                    "status_code": 400
+                },
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        # COUNT is only a hint to Redis, so a page may hold more or fewer
+        # than limit plans; a next_cursor of None means the scan is complete.
+        next_cursor, plans = get_plan_store().scan(cursor, limit)
+        plans_data = {}
+        for key, value in plans.items():
+            plans_data[key] = decode(value)
+        return Response({
+            "plans": plans_data,
+            "next_cursor": str(next_cursor) if next_cursor else None
+        })
+
+    def stream_plans(self):
+        # Values stored as JSON are written out one per line as they are;
+        # only plans stored in a binary format are decoded and re-encoded.
+        cursor = 0
+        while True:
+            cursor, plans = get_plan_store().scan(cursor, STREAM_BATCH_SIZE)
+            if plans:
+                yield b'\n'.join(to_json(value) for value in plans.values()) + b'\n'
+            if not cursor:
+                break
+
     def retrieve(self, request, pk):
         auth_response = self.check_bearer_token(request)
         if auth_response:
@@ -58,14 +263,17 @@ class PlanViewSet(ViewSet):
                 },
                 status=status.HTTP_400_BAD_REQUEST
             )
-        plan = redis_conn.hget(CACHE_KEY, pk)
-        if plan:
-            plan_data = json.loads(plan)
-            weak_etag = self.generate_etag(plan_data)
+        cache = get_plan_cache()
+        if cache is not None and request.accepted_renderer.format == 'json':
+            return self.retrieve_cached(request, pk, cache)
 
-            if_none_match = request.headers.get('If-None-Match')
-            if if_none_match == weak_etag:
-                return Response(status=status.HTTP_304_NOT_MODIFIED)
+        if_none_match = request.headers.get('If-None-Match')
+        if if_none_match and if_none_match == get_plan_store().get_etag(pk):
+            return Response(status=status.HTTP_304_NOT_MODIFIED)
+
+        plan, weak_etag = get_plan_store().get(pk)
+        if plan:
+            plan_data = decode(plan)
 
             if_match = request.headers.get('If-Match')
             if if_match and if_match != weak_etag:
@@ -89,42 +297,73 @@ class PlanViewSet(ViewSet):
                 status=status.HTTP_404_NOT_FOUND
             )
 
+    def retrieve_cached(self, request, pk, cache):
+        # Serves the rendered body straight from the in-process cache; a miss
+        # renders it exactly as Response(plan_data) would and caches it.
+        cached = cache.get(pk)
+        if cached is None:
+            generation = cache.generation
+            plan, weak_etag = get_plan_store().get(pk)
+            if not plan:
+                return Response(
+                    {
+                        "message": "Plan not found",
+                        "status_code": 404
+                    },
+                    status=status.HTTP_404_NOT_FOUND
+                )
+            body = JSONRenderer().render(decode(plan))
+            cache.put(pk, body, weak_etag, generation)
+        else:
+            body, weak_etag = cached
+
+        if_none_match = request.headers.get('If-None-Match')
+        if if_none_match and if_none_match == weak_etag:
+            return Response(status=status.HTTP_304_NOT_MODIFIED)
+
+        if_match = request.headers.get('If-Match')
+        if if_match and if_match != weak_etag:
+            return Response(
+                {
+                    "message": "Precondition Failed",
+                    "status_code": 412
+                },
+                status=status.HTTP_412_PRECONDITION_FAILED
+            )
+
+        response = HttpResponse(body, content_type=JSONRenderer.media_type)
+        response['ETag'] = weak_etag
+        return response
+
     def create(self, request):
         auth_response = self.check_bearer_token(request)
         if auth_response:
             return auth_response
 
-        serializer = self.serializer_class(data=request.data)
-        if not serializer.is_valid():
+        validated_data, errors = validate_plan(request.data)
+        if errors:
             return Response(
                 {
                     "message": "Missing or invalid fields in request body",
                     "status_code": 400,
-                    "errors": serializer.errors
+                    "errors": errors
                 },
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        validated_data = serializer.validated_data
-
         # Convert date objects to strings
         for key, value in validated_data.items():
             if isinstance(value, date):
                 validated_data[key] = value.isoformat()
 
         object_id = validated_data['objectId']
-        if redis_conn.hexists(CACHE_KEY, object_id):
-            return Response(
-                {
-                    "message": f"Plan with ID: {object_id} already exists",
-                    "status_code": 409
-                },
-                status=status.HTTP_409_CONFLICT
-            )
+        message = outbox.entry(validated_data, 'create')
+        code, weak_etag = get_plan_store().create(validated_data, outbox=message)
+        if code != scripts.OK:
+            return self.script_error_response(code, object_id)
 
-        weak_etag = self.generate_etag(validated_data)
-        redis_conn.hset(CACHE_KEY, object_id, json.dumps(validated_data))
-        send_to_queue(validated_data, 'create')  # Send create operation to RabbitMQ
+        if not message:
+            send_to_queue(validated_data, 'create')  # Send create operation to RabbitMQ
 
         response = Response(
             {
@@ -150,50 +389,31 @@ class PlanViewSet(ViewSet):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        plan = redis_conn.hget(CACHE_KEY, pk)
-        if not plan:
-            return Response(
-                {
-                    "message": "Plan not found",
-                    "status_code": 404
-                },
-                status=status.HTTP_404_NOT_FOUND
-            )
-
-        plan_data = json.loads(plan)
-        weak_etag = self.generate_etag(plan_data)
-
-        if_match = request.headers.get('If-Match')
-        if if_match and if_match != weak_etag:
-            return Response(
-                {
-                    "message": "Precondition Failed",
-                    "status_code": 412
-                },
-                status=status.HTTP_412_PRECONDITION_FAILED
-            )
-
-        serializer = self.serializer_class(data=request.data)
-        if not serializer.is_valid():
+        validated_data, errors = validate_plan(request.data)
+        if errors:
             return Response(
                 {
                     "message": "Missing or invalid fields in request body",
                     "status_code": 400,
-                    "errors": serializer.errors
+                    "errors": errors
                 },
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        validated_data = serializer.validated_data
-
         # Convert date objects to strings
         for key, value in validated_data.items():
             if isinstance(value, date):
                 validated_data[key] = value.isoformat()
 
-        weak_etag = self.generate_etag(validated_data)
-        redis_conn.hset(CACHE_KEY, pk, json.dumps(validated_data))
-        send_to_queue(validated_data, 'update')  # Send update operation to RabbitMQ
+        # Existence and If-Match are checked by the script, atomically with the write
+        if_match = request.headers.get('If-Match')
+        message = outbox.entry(validated_data, 'update')
+        code, weak_etag = get_plan_store().replace(pk, validated_data, if_match, outbox=message)
+        if code != scripts.OK:
+            return self.script_error_response(code, pk)
+
+        if not message:
+            send_to_queue(validated_data, 'update')  # Send update operation to RabbitMQ
 
         response = Response(
             {
@@ -219,78 +439,59 @@ class PlanViewSet(ViewSet):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        plan = redis_conn.hget(CACHE_KEY, pk)
-        if not plan:
-            return Response(
-                {
-                    "message": "Plan not found",
-                    "status_code": 404
-                },
-                status=status.HTTP_404_NOT_FOUND
-            )
+        if_match = request.headers.get('If-Match')
+        media_type = request.content_type.split(';')[0].strip()
+        # Without If-Match the patch is applied to the latest version: if
+        # another write lands between the read and the write, it is read,
+        # merged and written again
+        for _ in range(PATCH_ATTEMPTS):
+            plan, weak_etag = get_plan_store().get(pk)
+            if not plan:
+                return Response(
+                    {
+                        "message": "Plan not found",
+                        "status_code": 404
+                    },
+                    status=status.HTTP_404_NOT_FOUND
+                )
 
-        plan_data = json.loads(plan)
-        weak_etag = self.generate_etag(plan_data)
+            if if_match and if_match != weak_etag:
+                return Response(
+                    {
+                        "message": "Precondition Failed",
+                        "status_code": 412
+                    },
+                    status=status.HTTP_412_PRECONDITION_FAILED
+                )
 
-        if_match = request.headers.get('If-Match')
-        if if_match and if_match != weak_etag:
-            return Response(
-                {
-                    "message": "Precondition Failed",
-                    "status_code": 412
-                },
-                status=status.HTTP_412_PRECONDITION_FAILED
-            )
+            plan_data, errors = apply_patch(pk, decode(plan), media_type, request.data)
+            if errors:
+                return Response(errors, status=status.HTTP_400_BAD_REQUEST)
 
-        serializer = self.serializer_class(plan_data, data=request.data, partial=True)
-        if not serializer.is_valid():
+            previous = decode(plan)
+
+            # Only the join documents that changed are sent for indexing
+            delta = plan_delta(previous, plan_data)
+            message = outbox.delta_entry(pk, delta, plan_data) if delta else ''
+
+            # Only write if nobody replaced the plan since it was read above
+            code, weak_etag = get_plan_store().replace(pk, plan_data, weak_etag, previous=previous, outbox=message)
+            if code != scripts.PRECONDITION_FAILED or if_match:
+                break
+        else:
             return Response(
                 {
-                    "message": "Missing or invalid fields in request body",
-                    "status_code": 400,
-                    "errors": serializer.errors
+                    "message": f"Plan with ID: {pk} was modified concurrently, retry the request",
+                    "status_code": 409
                 },
-                status=status.HTTP_400_BAD_REQUEST
+                status=status.HTTP_409_CONFLICT
             )
+        if code != scripts.OK:
+            return self.script_error_response(code, pk)
 
-        validated_data = serializer.validated_data
-
-        # Convert date objects to strings
-        for key, value in validated_data.items():
-            if isinstance(value, date):
-                validated_data[key] = value.isoformat()
-
-        # Handle unique key constraint for planCostShares["objectId"]
-        if 'planCostShares' in validated_data:
-            plan_cost_shares_data = validated_data['planCostShares']
-            if 'objectId' in plan_cost_shares_data and plan_cost_shares_data['objectId'] != plan_data['planCostShares']['objectId']:
-                raise serializers.ValidationError({
-                    'planCostShares': {
-                        'objectId': 'Updating objectId is not allowed.'
-                    }
-                })
-
-        # Compare and add new linkedPlanServices
-        if 'linkedPlanServices' in validated_data:
-            existing_services = plan_data.get('linkedPlanServices', [])
-            incoming_services = validated_data['linkedPlanServices']
-
-            # Convert existing services to a set of tuples for easy comparison
-            existing_services_set = {tuple(sorted((k, tuple(v.items())) if isinstance(v, dict) else (k, v) for k, v in service.items())) for service in existing_services}
-
-            for service_data in incoming_services:
-                service_tuple = tuple(sorted((k, tuple(v.items())) if isinstance(v, dict) else (k, v) for k, v in service_data.items()))
-                if service_tuple not in existing_services_set:
-                    # Add the new service data to the existing list
-                    existing_services.append(service_data)
-    
-            validated_data['linkedPlanServices'] = existing_services
-
-        plan_data.update(validated_data)
-        weak_etag = self.generate_etag(plan_data)
-
-        redis_conn.hset(CACHE_KEY, pk, json.dumps(plan_data))
-        send_to_queue(plan_data, 'update')  # Send update operation to RabbitMQ
+        if delta:
+            if not message:
+                send_delta_to_queue(pk, delta, weak_etag)
 
         response = Response(
             {
@@ -316,41 +517,129 @@ class PlanViewSet(ViewSet):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        plan = redis_conn.hget(CACHE_KEY, pk)
-        if not plan:
-            return Response(
-                {
-                    "message": "Plan not found",
-                    "status_code": 404
-                },
-                status=status.HTTP_404_NOT_FOUND
-            )
+        if_match = request.headers.get('If-Match')
+        if_not_match = request.headers.get('If-None-Match')
+        # The plan is not read before deleting it; the consumer looks its
+        # indexed documents up by objectId, once the index has caught up
+        # with its earlier messages
+        message = outbox.entry({'objectId': pk}, 'delete')
+        code, plan_data = get_plan_store().delete(pk, if_match, if_not_match, outbox=message)
+        if code != scripts.OK:
+            return self.script_error_response(code, pk)
+
+        if not message:
+            send_to_queue(plan_data, 'delete')  # Send delete operation to RabbitMQ
+        return Response(
+            status=status.HTTP_204_NO_CONTENT
+        )
 
-        plan_data = json.loads(plan)
-        weak_etag = self.generate_etag(plan_data)
+    @action(detail=False, methods=['get'], url_path='_search')
+    def search(self, request):
+        auth_response = self.check_bearer_token(request)
+        if auth_response:
+            return auth_response
 
-        if_match = request.headers.get('If-Match')
-        if if_match and if_match != weak_etag:
+        try:
+            page = search_plans(request.query_params)
+        except SearchError as exc:
             return Response(
                 {
-                    "message": "Precondition Failed",
-                    "status_code": 412
+                    "message": str(exc),
+                    "status_code": exc.status_code
                 },
-                status=status.HTTP_412_PRECONDITION_FAILED
+                status=exc.status_code
             )
+        return Response(page)
 
-        if_not_match = request.headers.get('If-None-Match')
-        if if_not_match and if_not_match == weak_etag:
-            return Response(
-                {
-                    "message": "Precondition Failed",
-                    "status_code": 412
-                },
-                status=status.HTTP_412_PRECONDITION_FAILED
-            )
+    @action(detail=False, methods=['get'], url_path='_cache')
+    def cache_stats(self, request):
+        auth_response = self.check_bearer_token(request)
+        if auth_response:
+            return auth_response
+
+        cache = get_plan_cache()
+        return Response({"enabled": cache is not None, **(cache.stats() if cache else {})})
 
-        redis_conn.hdel(CACHE_KEY, pk)
-        send_to_queue(plan_data, 'delete')  # Send delete operation to RabbitMQ
+    def bulk_size_error(self):
         return Response(
-            status=status.HTTP_204_NO_CONTENT
+            {
+                "message": f"Request body must contain between 1 and {BULK_MAX_ITEMS} NDJSON plans",
+                "status_code": 400
+            },
+            status=status.HTTP_400_BAD_REQUEST
+        )
+
+    @action(detail=False, methods=['post'], url_path='_bulk')
+    def bulk(self, request):
+        auth_response = self.check_bearer_token(request)
+        if auth_response:
+            return auth_response
+
+        # The body is read line by line rather than through request.body,
+        # which is capped by DATA_UPLOAD_MAX_MEMORY_SIZE and would be kept
+        # in memory whole. Results are kept in input order; valid plans are
+        # written once the body is read, so an oversized request writes none.
+        items = []
+        pending = []
+        for line in request.stream or ():
+            if not line.strip():
+                continue
+            if len(items) == BULK_MAX_ITEMS:
+                return self.bulk_size_error()
+            try:
+                data = json.loads(line)
+            except ValueError as exc:
+                items.append({
+                    "status": "invalid",
+                    "status_code": 400,
+                    "errors": {"non_field_errors": [f"Invalid JSON: {exc}"]}
+                })
+                continue
+
+            validated_data, errors = validate_plan(data)
+            if errors:
+                items.append({
+                    "objectId": data.get('objectId') if isinstance(data, dict) else None,
+                    "status": "invalid",
+                    "status_code": 400,
+                    "errors": errors
+                })
+                continue
+
+            # Convert date objects to strings
+            for key, value in validated_data.items():
+                if isinstance(value, date):
+                    validated_data[key] = value.isoformat()
+
+            item = {"objectId": validated_data['objectId']}
+            items.append(item)
+            pending.append((item, validated_data))
+
+        if not items:
+            return self.bulk_size_error()
+
+        created = []
+        for start in range(0, len(pending), BULK_PIPELINE_SIZE):
+            chunk = pending[start:start + BULK_PIPELINE_SIZE]
+            documents = [validated_data for _, validated_data in chunk]
+            messages = [outbox.entry(validated_data, 'create') for validated_data in documents]
+            results = get_plan_store().create_many(documents, outbox=messages)
+            for (item, validated_data), (code, weak_etag) in zip(chunk, results):
+                if code == scripts.OK:
+                    item.update({"etag": weak_etag, "status": "created", "status_code": 201})
+                    created.append(validated_data)
+                else:
+                    item.update({"status": "conflict", "status_code": 409})
+
+        if created and not outbox.enabled():
+            send_batch_to_queue(created, 'create')  # Send create operations to RabbitMQ in batches
+
+        return Response(
+            {
+                "message": f"{len(created)} of {len(items)} plans saved",
+                "status_code": 200,
+                "errors": len(created) != len(items),
+                "items": items
+            },
+            status=status.HTTP_200_OK
         )